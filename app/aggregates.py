@@ -0,0 +1,41 @@
+import typing
+
+from app.metrics import MetricsRegistry
+from app.model import Account
+
+# Totals of one payer, {"available": points, "spent": points}.
+PayerTotal = typing.Dict[str, int]
+
+
+class PayerTotals:
+    """
+    Points available and spent per payer summed over every account of a service, updated as transactions are applied
+    rather than summed from the accounts when read.
+
+    Updates are recorded into the calling thread's own cells of a `MetricsRegistry`, so writers to different accounts
+    never contend on a payer's total, and a read sums the cells of the live threads, which costs O(payers) per thread
+    however many accounts there are. A read does not wait for writers, so it may count part of a spend that is still
+    being applied.
+    """
+
+    def __init__(self):
+        self.registry = MetricsRegistry()
+        self._available = self.registry.counter("available", "Points available per payer.", ["payer"])
+        self._spent = self.registry.counter("spent", "Points spent per payer.", ["payer"])
+
+    def add(self, payer: str, available: int, spent: int = 0):
+        self._available.inc(payer, amount=available)
+        if spent:
+            self._spent.inc(payer, amount=spent)
+
+    def add_account(self, account: Account, sign: int = 1):
+        # Counts a whole account in, or out with a `sign` of -1, when it is inserted or removed.
+        for payer, available in account.available_points_by_payer.items():
+            self.add(payer, sign * available, sign * account.spent_points_by_payer.get(payer, 0))
+
+    def totals(self) -> typing.Dict[str, PayerTotal]:
+        # Payers in name order, leaving out those whose accounts have all been removed.
+        totals: typing.Dict[str, PayerTotal] = {}
+        for (name, (payer,)), (points,) in self.registry.collect().items():
+            totals.setdefault(payer, {"available": 0, "spent": 0})[name] = points
+        return {payer: total for payer, total in sorted(totals.items()) if total["available"] or total["spent"]}
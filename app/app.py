@@ -1,42 +1,72 @@
 import logging
+import time
 
 from json import JSONEncoder
 from flask import Flask
+from flask import Response
+from flask import g
 from flask import request
 from flask import jsonify
-from pydantic import ValidationError
 
-from app.schema import AddPointsRequest, SpendPointsRequest
-from app.model import NotEnoughPointsException, AccountDoesntExistException
-from app.service import PointsService
+from app import handlers
+from app.config import create_points_service, profiling_enabled
+from app.logs import configure_logging
+from app.metrics import HTTP_REQUEST_SECONDS
+from app.profiling import PROFILE_HEADER, RequestProfile
 
 
 # Simple Dict JSON Encoder
 class ObjectDictJSONEncoder(JSONEncoder):
     def default(self, obj):
+        if hasattr(obj, "to_dict"):
+            return obj.to_dict()
         return obj.__dict__
 
 
-logging.basicConfig(level=logging.INFO)
+configure_logging(logging.INFO)
 logger = logging.getLogger(__name__)
 app = Flask(__name__)
 app.json_encoder = ObjectDictJSONEncoder
-points_service = PointsService()
+points_service = create_points_service()
+profiling = profiling_enabled()
 
 
 # Request/Response Access and Logging
 @app.before_request
 def before_request():
-    logger.info(f'REQUEST: {request.remote_addr} - "{request.method} {request.full_path} {request.scheme}"')
+    g.request_started = time.perf_counter()
+    logger.info('REQUEST: %s - "%s %s %s"', request.remote_addr, request.method, request.full_path, request.scheme)
+    profile_header = request.headers.get(PROFILE_HEADER) if profiling else None
+    if profile_header is not None:
+        g.request_profile = RequestProfile.begin(profile_header)
+        if g.request_profile is None:
+            return encoded_response(*handlers.request_profile_busy())
+        g.request_profile.enable()
 
 
 @app.after_request
 def after_request(resp):
-    logger.info(f'RESPONSE: {request.remote_addr} - "{request.method} {request.full_path} {request.scheme}" '
-                f'{resp.status_code} ')
+    request_profile = g.pop("request_profile", None)
+    if request_profile is not None:
+        request_profile.disable()
+        resp = encoded_response(*handlers.request_profile_response(request_profile, resp.status_code))
+    logger.info('RESPONSE: %s - "%s %s %s" %s ', request.remote_addr, request.method, request.full_path,
+                request.scheme, resp.status_code)
+    route = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+    HTTP_REQUEST_SECONDS.observe(time.perf_counter() - g.request_started, route, request.method,
+                                 str(resp.status_code))
     return resp
 
 
+@app.teardown_request
+def teardown_request(exception):
+    # Ends the profile of a request that failed before its response was made.
+    request_profile = g.pop("request_profile", None)
+    if request_profile is not None:
+        request_profile.disable()
+        request_profile.finish()
+
+
 # Exception Handling
 @app.errorhandler(Exception)
 def handle_unexpected_exception(exception):
@@ -46,82 +76,67 @@ def handle_unexpected_exception(exception):
     return jsonify(response), status_code
 
 
+# Response Helpers
+def encoded_response(response, status_code: int):
+    # Handlers return streamed and pre-encoded bodies as objects, anything else is encoded like jsonify would.
+    if isinstance(response, handlers.NDJSONStream):
+        return Response(iter(response), status=status_code, mimetype=response.media_type)
+    if isinstance(response, handlers.EncodedResponse):
+        flask_response = Response(response.body, status=status_code, content_type=response.media_type)
+        if response.etag:
+            flask_response.headers["ETag"] = response.etag
+        return flask_response
+    return Response(handlers.encode_json(response), status=status_code, mimetype="application/json")
+
+
 # Application Routes
 @app.route('/points', methods=['GET'])
 def get_points():
-    accounts = []
-    for account_id in points_service.get_account_ids():
-        points_balances = points_service.get_points_balances(account_id)
-        account = {"account_id": account_id, "points": points_balances}
-        accounts.append(account)
-    response = {"accounts": accounts}
-    return jsonify(response), 200
+    response, status_code = handlers.get_points(points_service, request.args.to_dict(),
+                                                request.headers.get("If-None-Match"))
+    return encoded_response(response, status_code)
 
 
 @app.route('/points/<account_id>', methods=['GET'])
 def get_points_for_account(account_id: str):
-    if points_service.get_account(account_id) is not None:
-        response = points_service.get_points_balances(account_id)
-        status_code = 200
-    else:
-        status_code = 404
-        response = {"message": f"Account {account_id} not found.", "status_code": status_code}
-    return jsonify(response), status_code
+    response, status_code = handlers.get_points_for_account(points_service, account_id,
+                                                            request.headers.get("If-None-Match"),
+                                                            request.args.to_dict())
+    return encoded_response(response, status_code)
+
+
+@app.route('/points/<account_id>/transactions', methods=['GET'])
+def get_account_transactions(account_id: str):
+    response, status_code = handlers.get_account_transactions(points_service, account_id, request.args.to_dict())
+    return encoded_response(response, status_code)
 
 
 @app.route('/points/<account_id>/add', methods=['POST'])
 def add_points(account_id: str):
-    try:
-        add_points_request = AddPointsRequest.from_dict_or_json(request.json)
-        logger.debug(f"Add Points Request for '{account_id}': {add_points_request}")
-        if add_points_request.points == 0:
-            status_code = 400
-            response = {
-                "message": f"Cannot add a transaction with zero points for account {account_id}: {add_points_request}",
-                "status_code": status_code
-            }
-        else:
-            transaction = points_service.add_transaction(account_id,
-                                                         add_points_request.payer,
-                                                         add_points_request.points,
-                                                         add_points_request.timestamp)
-            status_code = 200
-            response_timestamp = transaction.timestamp.strftime("'%Y-%m-%dT%H:%M:%SZ")
-            response = {"payer": transaction.payer, "points": transaction.points, "timestamp": response_timestamp}
-    except ValidationError:
-        logger.warning(f"Request Validation Error for {AddPointsRequest.__name__}", exc_info=True)
-        status_code = 400
-        response = {"message": f"Bad Request", "status_code": status_code}
-    return jsonify(response), status_code
+    response, status_code = handlers.add_points(points_service, account_id, request.json,
+                                                request.headers.get("Idempotency-Key"))
+    return encoded_response(response, status_code)
+
+
+@app.route('/points/<account_id>/add/batch', methods=['POST'])
+def add_points_batch(account_id: str):
+    response, status_code = handlers.add_points_batch(points_service, account_id, request.json,
+                                                      request.headers.get("Idempotency-Key"))
+    return encoded_response(response, status_code)
 
 
 @app.route('/points/<account_id>/spend', methods=['POST'])
 def spend_points(account_id: str):
-    points = 0
-    try:
-        spend_points_request = SpendPointsRequest.from_dict_or_json(request.json)
-        logger.debug(f"Spend Points Request for '{account_id}': {spend_points_request}")
-        points = spend_points_request.points
-        spend_transactions = points_service.spend_points(account_id, points)
-        status_code = 200
-        response = []
-        for spend_transaction in spend_transactions:
-            response.append({"payer": spend_transaction.payer, "points": spend_transaction.points})
-    except NotEnoughPointsException:
-        error_message = f"Account {account_id} did not have enough points to spend {points}."
-        logger.error(error_message)
-        status_code = 400
-        response = {"message": error_message, "status_code": status_code}
-    except AccountDoesntExistException:
-        error_message = f"Account {account_id} that does not exist. Cannot spend against it."
-        logger.error(error_message)
-        status_code = 404
-        response = {"message": error_message, "status_code": status_code}
-    except ValidationError:
-        logger.warning(f"Request Validation Error for {SpendPointsRequest.__name__}", exc_info=True)
-        status_code = 400
-        response = {"message": f"Bad Request", "status_code": status_code}
-    return jsonify(response), status_code
+    response, status_code = handlers.spend_points(points_service, account_id, request.json,
+                                                  request.headers.get("Idempotency-Key"))
+    return encoded_response(response, status_code)
+
+
+@app.route('/points/spend/batch', methods=['POST'])
+def spend_points_batch():
+    response, status_code = handlers.spend_points_batch(points_service, request.json,
+                                                        request.headers.get("Idempotency-Key"))
+    return encoded_response(response, status_code)
 
 
 # Application Testing Routes
@@ -129,24 +144,43 @@ def spend_points(account_id: str):
 #  though it is not the only way to accomplish it.
 @app.route('/points/<account_id>', methods=['DELETE'])
 def remove_account(account_id: str):
-    if points_service.get_account(account_id) is not None:
-        points_service.remove_account(account_id)
-        response = {}
-        status_code = 204
-    else:
-        status_code = 404
-        response = {"message": f"Account {account_id} not found.", "status_code": status_code}
-    return jsonify(response), status_code
+    response, status_code = handlers.remove_account(points_service, account_id)
+    return encoded_response(response, status_code)
 
 
 @app.route('/points', methods=['DELETE'])
 def remove_accounts():
-    accounts_removed = []
-    for account_id in points_service.get_account_ids():
-        accounts_removed.append(account_id)
-        points_service.remove_account(account_id)
-    response = {"accounts_removed": accounts_removed}
-    return jsonify(response), 200
+    response, status_code = handlers.remove_accounts(points_service)
+    return encoded_response(response, status_code)
+
+
+# Application Monitoring Routes
+@app.route('/payers', methods=['GET'])
+def get_payers():
+    response, status_code = handlers.get_payers(points_service)
+    return encoded_response(response, status_code)
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    response, status_code = handlers.get_metrics(points_service)
+    return encoded_response(response, status_code)
+
+
+@app.route('/admin/profiler', methods=['GET'])
+def get_profiler():
+    if not profiling:
+        return encoded_response(*handlers.profiling_disabled())
+    response, status_code = handlers.get_profiler(points_service)
+    return encoded_response(response, status_code)
+
+
+@app.route('/admin/profiler', methods=['POST'])
+def set_profiler():
+    if not profiling:
+        return encoded_response(*handlers.profiling_disabled())
+    response, status_code = handlers.set_profiler(points_service, request.json)
+    return encoded_response(response, status_code)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,215 @@
+import asyncio
+import json
+import logging
+import time
+import typing
+import urllib.parse
+
+from app import handlers
+from app.config import create_points_service, profiling_enabled
+from app.locks import AsyncStripedLocks
+from app.logs import configure_logging
+from app.metrics import HTTP_REQUEST_SECONDS
+from app.profiling import PROFILE_HEADER, RequestProfile
+from app.service import PointsService
+
+logger = logging.getLogger(__name__)
+
+# (method, path with the account id replaced by <account_id>) -> (handler, the request parts it takes in order)
+ROUTES = {
+    ("GET", "/points"): (handlers.get_points, ("query", "if_none_match")),
+    ("DELETE", "/points"): (handlers.remove_accounts, ()),
+    ("GET", "/points/<account_id>"): (handlers.get_points_for_account, ("if_none_match", "query")),
+    ("DELETE", "/points/<account_id>"): (handlers.remove_account, ()),
+    ("GET", "/points/<account_id>/transactions"): (handlers.get_account_transactions, ("query",)),
+    ("POST", "/points/<account_id>/add"): (handlers.add_points, ("body", "idempotency_key")),
+    ("POST", "/points/<account_id>/add/batch"): (handlers.add_points_batch, ("body", "idempotency_key")),
+    ("POST", "/points/<account_id>/spend"): (handlers.spend_points, ("body", "idempotency_key")),
+    ("POST", "/points/spend/batch"): (handlers.spend_points_batch, ("body", "idempotency_key")),
+    ("GET", "/payers"): (handlers.get_payers, ()),
+    ("GET", "/metrics"): (handlers.get_metrics, ()),
+    ("GET", "/admin/profiler"): (handlers.get_profiler, ()),
+    ("POST", "/admin/profiler"): (handlers.set_profiler, ("body",)),
+}
+ROUTE_PATHS = {path for _, path in ROUTES}
+# Only served with profiling enabled.
+PROFILER_PATH = "/admin/profiler"
+STATIC_ROUTE_PATHS = {path for path in ROUTE_PATHS if "<account_id>" not in path}
+
+
+def match_route(path: str) -> typing.Tuple[str, typing.Optional[str]]:
+    # Splits a request path into its route template and account id, mirroring Flask's <account_id> converter. Like
+    # Flask, a route without an account id takes precedence over reading the path as one with an account id.
+    if path in STATIC_ROUTE_PATHS:
+        return path, None
+    parts = path.split("/")
+    if len(parts) >= 3 and parts[1] == "points" and parts[2]:
+        return "/".join(["", "points", "<account_id>"] + parts[3:]), parts[2]
+    return path, None
+
+
+class PointsApplication:
+    """
+    ASGI front-end for the points routes, serving the same handlers as the Flask app from a single event loop.
+
+    Requests are coroutines rather than threads, so idle keep-alive connections cost no more than their socket.
+    Mutations are serialized per account through striped asyncio locks, so concurrent writers to one account queue
+    up on the loop instead of each holding a thread. An in-memory `PointsService` is called on the loop directly, as
+    its calls never block. A journaled or sharded service waits on disk or another process, so its calls are
+    offloaded to the default executor and the per-account locks keep them from piling onto one account's thread
+    lock.
+
+    With `profiling` the profiler routes are served and requests with an `X-Profile` header are profiled, otherwise
+    the routes are not found and the header is ignored.
+    """
+
+    def __init__(self, points_service, offload: typing.Optional[bool] = None, profiling: bool = False):
+        self.points_service = points_service
+        self.profiling = profiling
+        if offload is None:
+            offload = not isinstance(points_service, PointsService) or points_service.journal is not None
+        self.offload = offload
+        self.account_locks = AsyncStripedLocks()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    @staticmethod
+    async def _lifespan(receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope, receive, send):
+        started = time.perf_counter()
+        method = scope["method"]
+        full_path = f'{scope["path"]}?{scope["query_string"].decode("latin-1")}'
+        client = scope["client"][0] if scope.get("client") else None
+        logger.info('REQUEST: %s - "%s %s %s"', client, method, full_path, scope["scheme"])
+        profile_header = self._header(scope, PROFILE_HEADER.lower().encode("ascii")) if self.profiling else None
+        request_profile = RequestProfile.begin(profile_header) if profile_header is not None else None
+        try:
+            if profile_header is not None and request_profile is None:
+                response, status_code = handlers.request_profile_busy()
+            else:
+                response, status_code = await self._dispatch(scope, receive, request_profile)
+        except Exception as exception:
+            logger.error(f"Exception on {full_path} [{method}] with {exception}", exc_info=True)
+            status_code = 500
+            response = {"error": f"Unexpected Exception: {repr(exception)}", "status_code": status_code}
+        except BaseException:
+            if request_profile is not None:
+                request_profile.finish()
+            raise
+        if request_profile is not None:
+            response, status_code = handlers.request_profile_response(request_profile, status_code)
+        if isinstance(response, handlers.NDJSONStream):
+            await self._stream(response, status_code, send)
+        else:
+            await self._send(response, status_code, send)
+        logger.info('RESPONSE: %s - "%s %s %s" %s ', client, method, full_path, scope["scheme"], status_code)
+        template, _ = match_route(scope["path"])
+        route = template if template in ROUTE_PATHS else "<unmatched>"
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, route, method, str(status_code))
+
+    @staticmethod
+    async def _send(response, status_code: int, send):
+        if isinstance(response, handlers.EncodedResponse):
+            body = response.body
+            headers = [(b"content-type", response.media_type.encode("ascii"))]
+            if response.etag:
+                headers.append((b"etag", response.etag.encode("latin-1")))
+        else:
+            # Like werkzeug, a 204 is sent without a body.
+            body = b"" if status_code == 204 else handlers.encode_json(response)
+            headers = [(b"content-type", b"application/json")]
+        if status_code != 304:
+            headers.append((b"content-length", str(len(body)).encode("ascii")))
+        await send({"type": "http.response.start", "status": status_code, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+    async def _stream(self, response: handlers.NDJSONStream, status_code: int, send):
+        # Sent without a content length, the server frames the body as chunks as they are generated.
+        await send({"type": "http.response.start",
+                    "status": status_code,
+                    "headers": [(b"content-type", response.media_type.encode("ascii"))]})
+        chunks = iter(response)
+        while True:
+            chunk = await self._call(next, chunks, None)
+            if chunk is None:
+                break
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def _dispatch(self, scope, receive, request_profile: typing.Optional[RequestProfile] = None
+                        ) -> handlers.HandlerResponse:
+        method, path = scope["method"], scope["path"]
+        template, account_id = match_route(path)
+        served = self.profiling or template != PROFILER_PATH
+        route = ROUTES.get((method, template)) if served else None
+        if route is None:
+            status_code = 405 if served and template in ROUTE_PATHS else 404
+            message = "Method Not Allowed" if status_code == 405 else "Not Found"
+            return {"message": message, "status_code": status_code}, status_code
+        handler, takes = route
+        args = [] if account_id is None else [account_id]
+        body = idempotency_key = None
+        for part in takes:
+            if part == "query":
+                args.append(dict(urllib.parse.parse_qsl(scope["query_string"].decode("latin-1"))))
+            elif part == "if_none_match":
+                args.append(self._header(scope, b"if-none-match"))
+            elif part == "idempotency_key":
+                idempotency_key = self._header(scope, b"idempotency-key")
+                args.append(idempotency_key)
+            elif part == "body":
+                try:
+                    body = json.loads(await self._read_body(receive))
+                    args.append(body)
+                except ValueError:
+                    logger.warning("Request body for %s %s is not valid JSON", method, path, exc_info=True)
+                    return {"message": f"Bad Request", "status_code": 400}, 400
+        if account_id is not None and method != "GET":
+            # A retry of a completed request is answered without queueing behind the account's other writers.
+            stored = handlers.stored_response(handler, account_id, body, idempotency_key)
+            if stored is not None:
+                return stored
+            async with self.account_locks[account_id]:
+                return await self._call(handler, self.points_service, *args, profile=request_profile)
+        return await self._call(handler, self.points_service, *args, profile=request_profile)
+
+    @staticmethod
+    def _header(scope, name: bytes) -> typing.Optional[str]:
+        # Repeated headers are joined with commas, as Flask does.
+        values = [value for header, value in scope["headers"] if header == name]
+        return b",".join(values).decode("latin-1") if values else None
+
+    async def _call(self, function, *args, profile: typing.Optional[RequestProfile] = None):
+        # A profiled call is profiled in the thread that runs it.
+        if profile is not None:
+            function, args = profile.run, (function, *args)
+        if self.offload:
+            return await asyncio.to_thread(function, *args)
+        return function(*args)
+
+    @staticmethod
+    async def _read_body(receive) -> bytes:
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                raise ConnectionError("Client disconnected before sending the request body.")
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                return b"".join(chunks)
+
+
+configure_logging(logging.INFO)
+app = PointsApplication(create_points_service(), profiling=profiling_enabled())
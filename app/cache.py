@@ -0,0 +1,69 @@
+import collections
+import json
+import threading
+import typing
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def encode_fragment(value) -> bytes:
+    # Same key order, separators and escaping as Flask's jsonify, without its trailing newline so fragments can be
+    # embedded in larger bodies. orjson produces the same bytes except that it leaves DEL and non-ASCII characters
+    # unescaped, those values and any it cannot encode go through json.
+    if orjson is not None:
+        try:
+            encoded = orjson.dumps(value, option=orjson.OPT_SORT_KEYS)
+        except TypeError:
+            encoded = None
+        if encoded is not None and encoded.isascii() and b"\x7f" not in encoded:
+            return encoded
+    return json.dumps(value, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+class EncodedBalanceCache:
+    """
+    Bounded LRU cache of account balances already encoded as JSON.
+
+    An entry is only returned for the balance version it was encoded at, so a change to an account's balances
+    invalidates its entry without the writer touching the cache.
+    """
+
+    CAPACITY = 65536
+
+    def __init__(self, capacity: typing.Optional[int] = None):
+        self.capacity = capacity or self.CAPACITY
+        self._entries: "collections.OrderedDict[str, typing.Tuple[int, bytes]]" = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, account_id: str, version: int) -> typing.Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(account_id)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(account_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, account_id: str, version: int, encoded: bytes):
+        with self._lock:
+            entry = self._entries.get(account_id)
+            # Versions of an account only increase, a slow reader must not replace a newer entry.
+            if entry is not None and entry[0] > version:
+                return
+            self._entries[account_id] = (version, encoded)
+            self._entries.move_to_end(account_id)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def discard(self, account_id: str):
+        with self._lock:
+            self._entries.pop(account_id, None)
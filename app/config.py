@@ -0,0 +1,41 @@
+import os
+
+from app.persistence import Persistence
+from app.service import PointsService
+from app.sharding import ShardedPointsService
+from app.tiering import create_account_store
+
+
+def profiling_enabled() -> bool:
+    # Setting POINTS_PROFILING=1 serves /admin/profiler and runs requests sent with an X-Profile header under cProfile.
+    # Both let any client see into the process and slow it down, so they are off unless asked for.
+    return bool(int(os.environ.get("POINTS_PROFILING", "0")))
+
+
+def create_points_service():
+    # Setting POINTS_SHARDS partitions accounts across that many worker processes. Setting POINTS_DATA_DIR makes the
+    # service durable, it is recovered from and journaled to that directory. Account ledgers are compacted once they
+    # reach POINTS_COMPACTION_THRESHOLD entries, 0 turns compaction off. Setting POINTS_HOT_ACCOUNTS keeps that many
+    # accounts in memory per process and spills the rest to POINTS_COLD_STORE_DIR, the data directory by default.
+    commit_latency = float(os.environ.get("POINTS_COMMIT_LATENCY", "0.002"))
+    snapshot_interval = float(os.environ.get("POINTS_SNAPSHOT_INTERVAL", "300"))
+    compaction_threshold = int(os.environ.get("POINTS_COMPACTION_THRESHOLD", "100000")) or None
+    hot_accounts = int(os.environ.get("POINTS_HOT_ACCOUNTS", "0")) or None
+    cold_store_directory = os.environ.get("POINTS_COLD_STORE_DIR") or os.environ.get("POINTS_DATA_DIR")
+    if os.environ.get("POINTS_SHARDS"):
+        return ShardedPointsService(int(os.environ["POINTS_SHARDS"]),
+                                    data_directory=os.environ.get("POINTS_DATA_DIR"),
+                                    commit_latency=commit_latency,
+                                    snapshot_interval=snapshot_interval,
+                                    compaction_threshold=compaction_threshold,
+                                    hot_accounts=hot_accounts,
+                                    cold_store_directory=cold_store_directory)
+    account_store = create_account_store(hot_accounts, cold_store_directory)
+    if os.environ.get("POINTS_DATA_DIR"):
+        persistence = Persistence(os.environ["POINTS_DATA_DIR"],
+                                  commit_latency=commit_latency,
+                                  snapshot_interval=snapshot_interval,
+                                  compaction_threshold=compaction_threshold,
+                                  account_store=account_store)
+        return persistence.recover()
+    return PointsService(compaction_threshold=compaction_threshold, account_store=account_store)
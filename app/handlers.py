@@ -0,0 +1,555 @@
+import hashlib
+import logging
+import typing
+
+from pydantic import ValidationError
+
+from app.cache import encode_fragment
+from app.idempotency import IDEMPOTENCY, IDEMPOTENT_REPLAYS, MAX_KEY_LENGTH, IdempotencyConflict
+from app.metrics import METRICS, PROMETHEUS_CONTENT_TYPE
+from app.model import NotEnoughPointsException, AccountDoesntExistException, Transaction
+from app.model import from_epoch_microseconds, to_epoch_microseconds
+from app.profiling import PROFILER, RequestProfile
+from app.schema import GetPointsQuery, GetAccountPointsQuery, GetAccountTransactionsQuery, AddPointsRequest
+from app.schema import AddPointsBatchRequest
+from app.schema import SpendPointsRequest, SpendPointsBatchItem, SpendPointsBatchRequest
+from app.schema import ProfilerRequest
+
+logger = logging.getLogger(__name__)
+
+# Route logic shared by the Flask (app.app) and ASGI (app.asgi) front-ends. Handlers take the points service, the
+# path parameters and the decoded JSON body, and return the response body with its status code.
+HandlerResponse = typing.Tuple[typing.Any, int]
+
+TEXT_CONTENT_TYPE = "text/plain; charset=utf-8"
+DEFAULT_PAGE_LIMIT = 1000
+STREAM_PAGE_SIZE = 1000
+# (epoch timestamp, sequence) key before every ledger entry.
+FIRST_LEDGER_KEY = (-(1 << 63), 0)
+
+
+class NDJSONStream:
+    # Response body generated lazily as chunks of newline delimited JSON, front-ends stream it as it is iterated.
+    media_type = "application/x-ndjson"
+
+    def __init__(self, chunks: typing.Iterator[bytes]):
+        self.chunks = chunks
+
+    def __iter__(self) -> typing.Iterator[bytes]:
+        return self.chunks
+
+
+class EncodedResponse:
+    # Response body that is already encoded, JSON unless told otherwise, sent as is along with its entity tag.
+    def __init__(self, body: bytes, etag: typing.Optional[str] = None, media_type: str = "application/json"):
+        self.body = body
+        self.etag = etag
+        self.media_type = media_type
+
+
+def encode_json(response) -> bytes:
+    # Same body as Flask's jsonify, so both front-ends return identical bodies.
+    return encode_fragment(response) + b"\n"
+
+
+def encode_account(account_id: str, encoded_balances: bytes) -> bytes:
+    # {"account_id": ..., "points": ...} around balances that are already encoded.
+    return b'{"account_id":' + encode_fragment(account_id) + b',"points":' + encoded_balances + b"}"
+
+
+def etag_matches(if_none_match: typing.Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+def balances_etag(version: int) -> str:
+    return f'"{version:x}"'
+
+
+# Response Helpers
+def add_points_response(transaction: Transaction):
+    response_timestamp = transaction.timestamp.strftime("'%Y-%m-%dT%H:%M:%SZ")
+    return {"payer": transaction.payer, "points": transaction.points, "timestamp": response_timestamp}
+
+
+def accounts_response(encoded_balances: typing.List[typing.Tuple[str, int, bytes]],
+                      if_none_match: typing.Optional[str],
+                      page: bool = False,
+                      next_account_id: typing.Optional[str] = None) -> HandlerResponse:
+    # The accounts view is assembled from the accounts' cached encodings and tagged with a digest of their versions.
+    digest = hashlib.blake2b(digest_size=16)
+    for account_id, version, _ in encoded_balances:
+        digest.update(f"{account_id}\0{version:x}\0".encode("utf-8"))
+    if page:
+        digest.update(repr(next_account_id).encode("utf-8"))
+    etag = f'"{digest.hexdigest()}"'
+    if etag_matches(if_none_match, etag):
+        return EncodedResponse(b"", etag), 304
+    body = b'{"accounts":[' + b",".join(encode_account(account_id, encoded)
+                                        for account_id, _, encoded in encoded_balances) + b"]"
+    if page:
+        body += b',"next":' + encode_fragment(next_account_id)
+    return EncodedResponse(body + b"}\n", etag), 200
+
+
+def stream_points_balances(points_service, after: typing.Optional[str], limit: typing.Optional[int]):
+    # Reads accounts a page at a time, so memory stays constant however many accounts there are and the first
+    # chunk is sent as soon as the first page is read.
+    remaining = limit
+    while remaining is None or remaining > 0:
+        page_limit = STREAM_PAGE_SIZE if remaining is None else min(STREAM_PAGE_SIZE, remaining)
+        page = points_service.get_encoded_points_balances_page(after, page_limit)
+        if not page:
+            return
+        yield b"".join(encode_account(account_id, encoded) + b"\n" for account_id, _, encoded in page)
+        after = page[-1][0]
+        if remaining is not None:
+            remaining -= len(page)
+        if len(page) < page_limit:
+            return
+
+
+def transaction_response(entry: typing.Tuple[int, int, int, str]):
+    # Timestamps are ISO 8601 in UTC with microseconds only when there are any, so they can be sent back as `from`.
+    timestamp, _, points, payer = entry
+    return {"payer": payer, "points": points,
+            "timestamp": from_epoch_microseconds(timestamp).isoformat().replace("+00:00", "Z")}
+
+
+def transactions_cursor(entry: typing.Tuple[int, int, int, str]) -> str:
+    # Cursors are the (epoch timestamp, sequence) ledger key of the first transaction of the next page.
+    return f"{entry[0]}.{entry[1]}"
+
+
+def stream_transactions(points_service,
+                        account_id: str,
+                        page: typing.List[typing.Tuple[int, int, int, str]],
+                        end: typing.Optional[int],
+                        payer: typing.Optional[str],
+                        limit: typing.Optional[int]):
+    # Continues from a first page that was already read, a page at a time like `stream_points_balances`.
+    remaining = limit
+    while page:
+        yield b"".join(encode_fragment(transaction_response(entry)) + b"\n" for entry in page)
+        if remaining is not None:
+            remaining -= len(page)
+        page_limit = STREAM_PAGE_SIZE if remaining is None else min(STREAM_PAGE_SIZE, remaining)
+        if page_limit <= 0:
+            return
+        timestamp, sequence, _, _ = page[-1]
+        page = points_service.get_transactions_page(account_id, (timestamp, sequence + 1), end, payer, page_limit)
+
+
+def request_fingerprint(body) -> bytes:
+    # Digest of the decoded body in canonical form, so retries match however their JSON was laid out.
+    return hashlib.blake2b(encode_fragment(body), digest_size=16).digest()
+
+
+def idempotency_error(idempotency_key: str) -> typing.Optional[HandlerResponse]:
+    if len(idempotency_key) > MAX_KEY_LENGTH:
+        status_code = 400
+        return {"message": f"Idempotency-Key is longer than {MAX_KEY_LENGTH} characters.",
+                "status_code": status_code}, status_code
+    return None
+
+
+def idempotency_conflict(idempotency_key: str) -> HandlerResponse:
+    status_code = 422
+    response = {"message": f"Idempotency-Key {idempotency_key} was already used for a different request.",
+                "status_code": status_code}
+    return response, status_code
+
+
+def stored_response(handler, account_id: str, body, idempotency_key: typing.Optional[str]
+                    ) -> typing.Optional[HandlerResponse]:
+    # The stored response of a completed request with the key, for front-ends to answer a retry before they queue
+    # for the account. Handlers are stored under their name.
+    if not idempotency_key or idempotency_error(idempotency_key):
+        return None
+    try:
+        stored = IDEMPOTENCY.get((handler.__name__, account_id, idempotency_key), request_fingerprint(body))
+    except IdempotencyConflict:
+        return idempotency_conflict(idempotency_key)
+    if stored is None:
+        return None
+    IDEMPOTENT_REPLAYS.inc()
+    return EncodedResponse(stored.body), stored.status_code
+
+
+def idempotent(handler, account_id: str, body, idempotency_key: typing.Optional[str], apply) -> HandlerResponse:
+    """
+    Runs `apply` once per idempotency key. The encoded response is stored for retries with the key, which get it
+    back without running `apply`, including retries that arrive while it is still running. Server errors are not
+    stored, so a retry of a request that failed with one runs it again.
+    """
+    if not idempotency_key:
+        return apply()
+    error = idempotency_error(idempotency_key)
+    if error is not None:
+        return error
+    scope = (handler.__name__, account_id, idempotency_key)
+    fingerprint = request_fingerprint(body)
+    try:
+        stored = IDEMPOTENCY.claim(scope, fingerprint)
+    except IdempotencyConflict:
+        return idempotency_conflict(idempotency_key)
+    if stored is not None:
+        IDEMPOTENT_REPLAYS.inc()
+        return EncodedResponse(stored.body), stored.status_code
+    try:
+        response, status_code = apply()
+    except BaseException:
+        IDEMPOTENCY.release(scope)
+        raise
+    if status_code >= 500:
+        IDEMPOTENCY.release(scope)
+        return response, status_code
+    encoded = response.body if isinstance(response, EncodedResponse) else encode_json(response)
+    IDEMPOTENCY.complete(scope, fingerprint, encoded, status_code)
+    return EncodedResponse(encoded), status_code
+
+
+# Application Routes
+def get_points(points_service,
+               query: typing.Mapping[str, str],
+               if_none_match: typing.Optional[str] = None) -> HandlerResponse:
+    try:
+        get_points_query = GetPointsQuery.from_dict(query)
+    except ValidationError:
+        logger.warning("Request Validation Error for %s", GetPointsQuery.__name__, exc_info=True)
+        status_code = 400
+        response = {"message": f"Bad Request", "status_code": status_code}
+        return response, status_code
+
+    if get_points_query.format == "ndjson":
+        chunks = stream_points_balances(points_service, get_points_query.after, get_points_query.limit)
+        return NDJSONStream(chunks), 200
+
+    if get_points_query.limit is None and get_points_query.after is None:
+        return accounts_response(points_service.get_all_encoded_points_balances(), if_none_match)
+
+    # One extra account is read to tell whether there is a next page.
+    limit = get_points_query.limit or DEFAULT_PAGE_LIMIT
+    page = points_service.get_encoded_points_balances_page(get_points_query.after, limit + 1)
+    next_account_id = page[limit - 1][0] if len(page) > limit else None
+    return accounts_response(page[:limit], if_none_match, page=True, next_account_id=next_account_id)
+
+
+def get_points_for_account(points_service,
+                           account_id: str,
+                           if_none_match: typing.Optional[str] = None,
+                           query: typing.Optional[typing.Mapping[str, str]] = None) -> HandlerResponse:
+    # Other query parameters, such as cache busters, still get the current balances with their ETag.
+    if query and "as_of" in query:
+        return get_points_for_account_as_of(points_service, account_id, query)
+    # A matching If-None-Match is answered from the account's version alone, without copying or encoding balances.
+    if if_none_match:
+        version = points_service.get_points_balances_version(account_id)
+        if version is not None and etag_matches(if_none_match, balances_etag(version)):
+            return EncodedResponse(b"", balances_etag(version)), 304
+    encoded = points_service.get_encoded_points_balances(account_id)
+    if encoded is None:
+        status_code = 404
+        response = {"message": f"Account {account_id} not found.", "status_code": status_code}
+        return response, status_code
+    version, encoded_balances = encoded
+    return EncodedResponse(encoded_balances + b"\n", balances_etag(version)), 200
+
+
+def get_points_for_account_as_of(points_service,
+                                 account_id: str,
+                                 query: typing.Mapping[str, str]) -> HandlerResponse:
+    try:
+        get_account_points_query = GetAccountPointsQuery.from_dict(query)
+    except ValidationError:
+        logger.warning("Request Validation Error for %s", GetAccountPointsQuery.__name__, exc_info=True)
+        status_code = 400
+        response = {"message": f"Bad Request", "status_code": status_code}
+        return response, status_code
+    if get_account_points_query.as_of is None:
+        return get_points_for_account(points_service, account_id)
+    response = points_service.get_points_balances_as_of(account_id, get_account_points_query.as_of)
+    if response is None:
+        status_code = 404
+        response = {"message": f"Account {account_id} not found.", "status_code": status_code}
+        return response, status_code
+    return response, 200
+
+
+def get_account_transactions(points_service,
+                             account_id: str,
+                             query: typing.Mapping[str, str]) -> HandlerResponse:
+    try:
+        get_transactions_query = GetAccountTransactionsQuery.from_dict(query)
+    except ValidationError:
+        logger.warning("Request Validation Error for %s", GetAccountTransactionsQuery.__name__, exc_info=True)
+        status_code = 400
+        response = {"message": f"Bad Request", "status_code": status_code}
+        return response, status_code
+
+    key = FIRST_LEDGER_KEY
+    if get_transactions_query.from_ is not None:
+        key = (to_epoch_microseconds(get_transactions_query.from_), 0)
+    if get_transactions_query.cursor is not None:
+        timestamp, sequence = get_transactions_query.cursor.split(".")
+        key = max(key, (int(timestamp), int(sequence)))
+    end = to_epoch_microseconds(get_transactions_query.to) if get_transactions_query.to is not None else None
+    payer, limit = get_transactions_query.payer, get_transactions_query.limit
+
+    # The first page is read before responding either way, so a missing account is a 404 and not an empty stream.
+    if get_transactions_query.format == "ndjson":
+        page_limit = STREAM_PAGE_SIZE if limit is None else min(STREAM_PAGE_SIZE, limit)
+    else:
+        # One extra transaction is read to tell whether there is a next page.
+        page_limit = (limit or DEFAULT_PAGE_LIMIT) + 1
+    page = points_service.get_transactions_page(account_id, key, end, payer, page_limit)
+    if page is None:
+        status_code = 404
+        response = {"message": f"Account {account_id} not found.", "status_code": status_code}
+        return response, status_code
+    if get_transactions_query.format == "ndjson":
+        return NDJSONStream(stream_transactions(points_service, account_id, page, end, payer, limit)), 200
+
+    limit = page_limit - 1
+    next_cursor = transactions_cursor(page[limit]) if len(page) > limit else None
+    return {"transactions": [transaction_response(entry) for entry in page[:limit]], "next": next_cursor}, 200
+
+
+def add_points(points_service,
+               account_id: str,
+               body,
+               idempotency_key: typing.Optional[str] = None) -> HandlerResponse:
+    return idempotent(add_points, account_id, body, idempotency_key,
+                      lambda: apply_add_points(points_service, account_id, body))
+
+
+def apply_add_points(points_service, account_id: str, body) -> HandlerResponse:
+    try:
+        add_points_request = AddPointsRequest.from_dict_or_json(body)
+        logger.debug("Add Points Request for '%s': %s", account_id, add_points_request)
+        if add_points_request.points == 0:
+            status_code = 400
+            response = {
+                "message": f"Cannot add a transaction with zero points for account {account_id}: {add_points_request}",
+                "status_code": status_code
+            }
+        else:
+            transaction = points_service.add_transaction(account_id,
+                                                         add_points_request.payer,
+                                                         add_points_request.points,
+                                                         add_points_request.timestamp)
+            status_code = 200
+            response = add_points_response(transaction)
+    except ValidationError:
+        logger.warning("Request Validation Error for %s", AddPointsRequest.__name__, exc_info=True)
+        status_code = 400
+        response = {"message": f"Bad Request", "status_code": status_code}
+    return response, status_code
+
+
+def add_points_batch(points_service,
+                     account_id: str,
+                     body,
+                     idempotency_key: typing.Optional[str] = None) -> HandlerResponse:
+    return idempotent(add_points_batch, account_id, body, idempotency_key,
+                      lambda: apply_add_points_batch(points_service, account_id, body))
+
+
+def apply_add_points_batch(points_service, account_id: str, body) -> HandlerResponse:
+    try:
+        add_points_batch_request = AddPointsBatchRequest.from_dict_or_json(body)
+    except ValidationError:
+        logger.warning("Request Validation Error for %s", AddPointsBatchRequest.__name__, exc_info=True)
+        status_code = 400
+        response = {"message": f"Bad Request", "status_code": status_code}
+        return response, status_code
+
+    # Each item gets the response the single add route would give it, valid items are added in one service call.
+    item_responses = []
+    transactions = []
+    for item in add_points_batch_request.__root__:
+        try:
+            add_points_request = AddPointsRequest.from_dict(item)
+        except ValidationError:
+            item_responses.append({"message": f"Bad Request", "status_code": 400})
+            continue
+        if add_points_request.points == 0:
+            item_responses.append({
+                "message": f"Cannot add a transaction with zero points for account {account_id}: {add_points_request}",
+                "status_code": 400
+            })
+            continue
+        item_responses.append(None)
+        transactions.append((add_points_request.payer, add_points_request.points, add_points_request.timestamp))
+    rejected = len(item_responses) - len(transactions)
+    if rejected:
+        logger.warning("Rejected %d of %d items in add batch for account %s", rejected, len(item_responses), account_id)
+
+    added = iter(points_service.add_transactions(account_id, transactions) if transactions else [])
+    response = [item_response if item_response is not None else add_points_response(next(added))
+                for item_response in item_responses]
+    return response, 200
+
+
+def spend_points(points_service,
+                 account_id: str,
+                 body,
+                 idempotency_key: typing.Optional[str] = None) -> HandlerResponse:
+    return idempotent(spend_points, account_id, body, idempotency_key,
+                      lambda: apply_spend_points(points_service, account_id, body))
+
+
+def apply_spend_points(points_service, account_id: str, body) -> HandlerResponse:
+    points = 0
+    try:
+        spend_points_request = SpendPointsRequest.from_dict_or_json(body)
+        logger.debug("Spend Points Request for '%s': %s", account_id, spend_points_request)
+        points = spend_points_request.points
+        spend_transactions = points_service.spend_points(account_id, points)
+        status_code = 200
+        response = spend_points_response(spend_transactions)
+    except (NotEnoughPointsException, AccountDoesntExistException) as exception:
+        response, status_code = spend_error_response(account_id, points, exception)
+        logger.error(response["message"])
+    except ValidationError:
+        logger.warning("Request Validation Error for %s", SpendPointsRequest.__name__, exc_info=True)
+        status_code = 400
+        response = {"message": f"Bad Request", "status_code": status_code}
+    return response, status_code
+
+
+def spend_points_response(transactions: typing.List[Transaction]):
+    return [{"payer": transaction.payer, "points": transaction.points} for transaction in transactions]
+
+
+def spend_error_response(account_id: str, points: int, exception: Exception) -> HandlerResponse:
+    if isinstance(exception, NotEnoughPointsException):
+        status_code = 400
+        error_message = f"Account {account_id} did not have enough points to spend {points}."
+    else:
+        status_code = 404
+        error_message = f"Account {account_id} that does not exist. Cannot spend against it."
+    return {"message": error_message, "status_code": status_code}, status_code
+
+
+def spend_points_batch(points_service, body, idempotency_key: typing.Optional[str] = None) -> HandlerResponse:
+    # Spans accounts, so its idempotency keys are scoped to the route alone.
+    return idempotent(spend_points_batch, "", body, idempotency_key,
+                      lambda: apply_spend_points_batch(points_service, body))
+
+
+def apply_spend_points_batch(points_service, body) -> HandlerResponse:
+    try:
+        spend_points_batch_request = SpendPointsBatchRequest.from_dict_or_json(body)
+    except ValidationError:
+        logger.warning("Request Validation Error for %s", SpendPointsBatchRequest.__name__, exc_info=True)
+        status_code = 400
+        response = {"message": f"Bad Request", "status_code": status_code}
+        return response, status_code
+
+    # Items are grouped by account, each account's in request order, and every account is spent against in one
+    # service call. Each item gets the response the single spend route would give it.
+    items = spend_points_batch_request.__root__
+    item_responses: typing.List[typing.Any] = [None] * len(items)
+    positions_by_account: typing.Dict[str, typing.List[int]] = {}
+    points_by_account: typing.Dict[str, typing.List[int]] = {}
+    for position, item in enumerate(items):
+        try:
+            spend_request = SpendPointsBatchItem.from_dict(item)
+        except ValidationError:
+            item_responses[position] = {"message": f"Bad Request", "status_code": 400}
+            continue
+        positions_by_account.setdefault(spend_request.account_id, []).append(position)
+        points_by_account.setdefault(spend_request.account_id, []).append(spend_request.points)
+
+    spends = list(points_by_account.items())
+    results = points_service.spend_points_batch(spends) if spends else []
+    failed = 0
+    for (account_id, account_points), account_results in zip(spends, results):
+        for position, points, result in zip(positions_by_account[account_id], account_points, account_results):
+            if isinstance(result, Exception):
+                item_responses[position], _ = spend_error_response(account_id, points, result)
+                failed += 1
+            else:
+                item_responses[position] = spend_points_response(result)
+    rejected = len(items) - sum(map(len, points_by_account.values()))
+    if failed or rejected:
+        logger.warning("%d of %d items in spend batch failed and %d were rejected", failed, len(items), rejected)
+    return item_responses, 200
+
+
+# Application Testing Routes
+def remove_account(points_service, account_id: str) -> HandlerResponse:
+    if points_service.has_account(account_id):
+        points_service.remove_account(account_id)
+        response = {}
+        status_code = 204
+    else:
+        status_code = 404
+        response = {"message": f"Account {account_id} not found.", "status_code": status_code}
+    return response, status_code
+
+
+def remove_accounts(points_service) -> HandlerResponse:
+    accounts_removed = []
+    for account_id in points_service.get_account_ids():
+        accounts_removed.append(account_id)
+        points_service.remove_account(account_id)
+    response = {"accounts_removed": accounts_removed}
+    return response, 200
+
+
+def get_payers(points_service) -> HandlerResponse:
+    # Points available and spent per payer across every account, read from totals kept as transactions are applied.
+    return points_service.get_payer_totals(), 200
+
+
+def get_metrics(points_service) -> HandlerResponse:
+    body = METRICS.render(points_service.collect_metrics()).encode("utf-8")
+    return EncodedResponse(body, media_type=PROMETHEUS_CONTENT_TYPE), 200
+
+
+def get_profiler(points_service) -> HandlerResponse:
+    # Samples of the current or last profiler run as collapsed stacks.
+    return EncodedResponse(PROFILER.collapsed().encode("utf-8"), media_type=TEXT_CONTENT_TYPE), 200
+
+
+def set_profiler(points_service, body) -> HandlerResponse:
+    try:
+        profiler_request = ProfilerRequest.from_dict_or_json(body)
+    except ValidationError:
+        logger.warning("Request Validation Error for %s", ProfilerRequest.__name__, exc_info=True)
+        status_code = 400
+        response = {"message": f"Bad Request", "status_code": status_code}
+        return response, status_code
+    if profiler_request.running:
+        PROFILER.start(profiler_request.interval)
+        logger.info("Started the sampling profiler, sampling every %gs", PROFILER.interval)
+    else:
+        PROFILER.stop()
+        logger.info("Stopped the sampling profiler after %d samples", PROFILER.samples)
+    return PROFILER.status(), 200
+
+
+def profiling_disabled() -> HandlerResponse:
+    # The profiler routes are answered like unknown routes unless profiling is enabled.
+    status_code = 404
+    response = {"message": "Not Found", "status_code": status_code}
+    return response, status_code
+
+
+def request_profile_busy() -> HandlerResponse:
+    status_code = 429
+    response = {"message": "Another request is being profiled, retry later or without the X-Profile header.",
+                "status_code": status_code}
+    return response, status_code
+
+
+def request_profile_response(request_profile: RequestProfile, status_code: int) -> HandlerResponse:
+    # The profile replaces the response body, the status code is the request's own.
+    return EncodedResponse(request_profile.report(status_code), media_type=TEXT_CONTENT_TYPE), status_code
@@ -0,0 +1,145 @@
+"""
+Idempotency keys for the add and spend routes.
+
+A request sent with an `Idempotency-Key` header has its encoded response stored under the key, the route and the
+account. A retry with the same key gets the stored response back without the request being applied again, and a
+retry that arrives while the first request is still running waits for it. Reusing a key for a different request body
+is rejected.
+
+Responses are kept in memory for POINTS_IDEMPOTENCY_TTL seconds (default a day), and the least recently used are
+evicted once they take more than POINTS_IDEMPOTENCY_MAX_BYTES (default 64 MiB). The store belongs to the front-end
+process, so retries have to reach the same process and are not recognised after a restart.
+"""
+import collections
+import os
+import threading
+import time
+import typing
+
+from app.metrics import METRICS
+
+IDEMPOTENT_REPLAYS = METRICS.counter("points_idempotent_replays_total",
+                                     "Requests answered with the stored response of an earlier request with their key.")
+IDEMPOTENCY_EVICTIONS = METRICS.counter("points_idempotency_evictions_total",
+                                        "Stored responses evicted to stay within the store's memory bound.")
+
+MAX_KEY_LENGTH = 255
+
+# (route, account id, idempotency key)
+IdempotencyScope = typing.Tuple[str, str, str]
+
+
+class IdempotencyConflict(Exception):
+    pass
+
+
+class StoredResponse(typing.NamedTuple):
+    fingerprint: bytes
+    body: bytes
+    status_code: int
+    expires: float
+
+
+class IdempotencyStore:
+    """
+    Encoded responses by idempotency scope with a time to live and least recently used eviction.
+
+    A request claims its scope before running. Later claims of the scope block until the owner completes it with a
+    response, which they all get, or releases it after failing, in which case one of them runs the request instead.
+    Entries are charged their body and key sizes plus `ENTRY_OVERHEAD` for the bookkeeping around them.
+    """
+
+    ENTRY_OVERHEAD = 256
+
+    def __init__(self,
+                 max_bytes: int = 64 << 20,
+                 ttl: float = 86400.0,
+                 clock: typing.Callable[[], float] = time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.nbytes = 0
+        self._responses: "collections.OrderedDict[IdempotencyScope, StoredResponse]" = collections.OrderedDict()
+        self._in_flight: typing.Dict[IdempotencyScope, typing.Tuple[bytes, threading.Event]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._responses)
+
+    def get(self, scope: IdempotencyScope, fingerprint: bytes) -> typing.Optional[StoredResponse]:
+        # The stored response of a completed request, without waiting for one in flight.
+        with self._lock:
+            return self._stored(scope, fingerprint)
+
+    def claim(self, scope: IdempotencyScope, fingerprint: bytes) -> typing.Optional[StoredResponse]:
+        """
+        Returns the stored response for the scope, waiting for a request in flight with it first. Returns None when
+        the caller now owns the scope and has to `complete` or `release` it. Raises `IdempotencyConflict` when the
+        scope belongs to a request with a different fingerprint.
+        """
+        while True:
+            with self._lock:
+                stored = self._stored(scope, fingerprint)
+                if stored is not None:
+                    return stored
+                in_flight = self._in_flight.get(scope)
+                if in_flight is None:
+                    self._in_flight[scope] = (fingerprint, threading.Event())
+                    return None
+            owner_fingerprint, finished = in_flight
+            if owner_fingerprint != fingerprint:
+                raise IdempotencyConflict()
+            finished.wait()
+
+    def complete(self, scope: IdempotencyScope, fingerprint: bytes, body: bytes, status_code: int):
+        stored = StoredResponse(fingerprint, body, status_code, self.clock() + self.ttl)
+        with self._lock:
+            self._discard(scope)
+            self._responses[scope] = stored
+            self.nbytes += self._size(scope, stored)
+            self._evict()
+            _, finished = self._in_flight.pop(scope)
+        finished.set()
+
+    def release(self, scope: IdempotencyScope):
+        with self._lock:
+            _, finished = self._in_flight.pop(scope)
+        finished.set()
+
+    def _stored(self, scope: IdempotencyScope, fingerprint: bytes) -> typing.Optional[StoredResponse]:
+        # Must be called while holding the store lock.
+        stored = self._responses.get(scope)
+        if stored is None:
+            return None
+        if stored.expires <= self.clock():
+            self._discard(scope)
+            return None
+        if stored.fingerprint != fingerprint:
+            raise IdempotencyConflict()
+        self._responses.move_to_end(scope)
+        return stored
+
+    def _discard(self, scope: IdempotencyScope):
+        stored = self._responses.pop(scope, None)
+        if stored is not None:
+            self.nbytes -= self._size(scope, stored)
+
+    def _evict(self):
+        # Expired entries are dropped from the least recently used end, then entries until the store fits. Expired
+        # entries used more recently than a live one are left to expire when they are next looked up or evicted.
+        now = self.clock()
+        while self._responses:
+            scope, stored = next(iter(self._responses.items()))
+            if stored.expires > now and self.nbytes <= self.max_bytes:
+                return
+            if stored.expires > now:
+                IDEMPOTENCY_EVICTIONS.inc()
+            self._discard(scope)
+
+    def _size(self, scope: IdempotencyScope, stored: StoredResponse) -> int:
+        return sum(map(len, scope)) + len(stored.fingerprint) + len(stored.body) + self.ENTRY_OVERHEAD
+
+
+# Read when imported, like the audit trail, so every front-end process configures its store the same way.
+IDEMPOTENCY = IdempotencyStore(max_bytes=int(os.environ.get("POINTS_IDEMPOTENCY_MAX_BYTES", str(64 << 20))),
+                               ttl=float(os.environ.get("POINTS_IDEMPOTENCY_TTL", "86400")))
@@ -0,0 +1,267 @@
+"""
+Bulk importer for backfilling historical transactions.
+
+Streams (account_id, payer, points, timestamp) rows from CSV or NDJSON files into the points service the environment
+configures, the same one the server would create, so with POINTS_DATA_DIR set the history is journaled there and the
+server recovers it when it starts. Rows are read `--batch-rows` at a time and grouped by account, and each account's
+rows are added with one hold of its lock, so memory stays bounded by the batch size however large the files are. With
+POINTS_SHARDS set accounts are fanned out across that many worker processes. A batch is applied while the next one is
+read.
+
+CSV files need a header naming the four columns, in any order. Files ending in .gz are decompressed and - reads stdin.
+
+    python -m app.importer history.csv
+    POINTS_DATA_DIR=data python -m app.importer partner-*.ndjson.gz --batch-rows 200000
+    POINTS_DATA_DIR=data POINTS_SHARDS=4 python -m app.importer - --format ndjson < history.ndjson
+"""
+import argparse
+import concurrent.futures
+import csv
+import datetime
+import gzip
+import io
+import json
+import logging
+import os
+import re
+import sys
+import time
+import typing
+
+from app.schema import parse_timestamp
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ("account_id", "payer", "points", "timestamp")
+FORMATS = ("csv", "ndjson")
+DEFAULT_BATCH_ROWS = 100000
+# Rejected rows past this many are only counted, a malformed file should not flood the log.
+LOGGED_REJECTIONS = 20
+# Date and time forms that datetime.fromisoformat and pydantic both parse, and parse to the same datetime.
+ISO_DATETIME = re.compile(r"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(:\d{2}(\.\d{1,6})?)?(Z|[+-]\d{2}:\d{2})?")
+
+AccountBatch = typing.Tuple[str, typing.List[typing.Tuple[str, int, datetime.datetime]]]
+
+
+def file_format(path: str) -> str:
+    # Format of a file by its extension, ignoring a trailing .gz.
+    name = path[:-len(".gz")] if path.endswith(".gz") else path
+    extension = os.path.splitext(name)[1].lower()
+    if extension == ".csv":
+        return "csv"
+    if extension in (".ndjson", ".jsonl"):
+        return "ndjson"
+    raise ValueError(f"Cannot tell the format of '{path}' from its extension, pass --format csv or ndjson.")
+
+
+def open_text(path: str) -> typing.TextIO:
+    if path == "-":
+        return io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8", newline="")
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", newline="")
+    return open(path, encoding="utf-8", newline="")
+
+
+def read_csv(text_file: typing.TextIO) -> typing.Iterator[typing.Tuple[int, typing.Optional[list]]]:
+    # (line number, [account_id, payer, points, timestamp]) of each record, None for a record missing columns.
+    reader = csv.reader(text_file)
+    header = next(reader, None)
+    if header is None:
+        return
+    header = [column.strip() for column in header]
+    missing = [column for column in COLUMNS if column not in header]
+    if missing:
+        raise ValueError(f"CSV header {header} is missing the columns {missing}.")
+    indices = [header.index(column) for column in COLUMNS]
+    width = max(indices) + 1
+    for values in reader:
+        if not values:
+            continue
+        yield reader.line_num, [values[index] for index in indices] if len(values) >= width else None
+
+
+def read_ndjson(text_file: typing.TextIO) -> typing.Iterator[typing.Tuple[int, typing.Optional[list]]]:
+    # (line number, [account_id, payer, points, timestamp]) of each object, None for a line that is not one.
+    loads = orjson.loads if orjson is not None else json.loads
+    for line_number, line in enumerate(text_file, 1):
+        if not line.strip():
+            continue
+        try:
+            row = loads(line)
+        except ValueError:
+            yield line_number, None
+            continue
+        yield line_number, [row.get(column) for column in COLUMNS] if type(row) is dict else None
+
+
+READERS = {"csv": read_csv, "ndjson": read_ndjson}
+
+
+def parse_points(points) -> typing.Optional[int]:
+    # Integers, and in CSV strings of integers. Zero points are rejected as they are by the add routes.
+    if type(points) is str:
+        try:
+            points = int(points)
+        except ValueError:
+            return None
+    if type(points) is not int or points == 0:
+        return None
+    return points
+
+
+def parse_timestamps(timestamps: typing.Iterable[str]) -> typing.Dict[str, typing.Optional[datetime.datetime]]:
+    # Each distinct timestamp string of a batch is parsed once, None when it is not a timestamp. fromisoformat parses
+    # the full date and time forms exports use at a fraction of the cost of pydantic and agrees with it on them. It
+    # also reads forms pydantic takes differently, such as dates alone or "20201102" which pydantic reads as a unix
+    # timestamp, so everything else is parsed by pydantic as the add routes would.
+    parsed = {}
+    for timestamp in timestamps:
+        try:
+            if not ISO_DATETIME.fullmatch(timestamp):
+                raise ValueError(timestamp)
+            parsed[timestamp] = datetime.datetime.fromisoformat(timestamp)
+        except ValueError:
+            try:
+                parsed[timestamp] = parse_timestamp(timestamp)
+            except (TypeError, ValueError):
+                parsed[timestamp] = None
+    return parsed
+
+
+class RowReader:
+    """
+    Reads rows from `paths` and yields them as batches of up to `batch_rows` rows grouped by account, in the order
+    each account's rows appear. Malformed rows are skipped and counted in `rejected`.
+    """
+
+    def __init__(self, paths: typing.List[str], format: typing.Optional[str] = None,
+                 batch_rows: int = DEFAULT_BATCH_ROWS):
+        if batch_rows < 1:
+            raise ValueError("Batches need room for at least one row.")
+        self.paths = paths
+        self.formats = [format or file_format(path) for path in paths]
+        self.batch_rows = batch_rows
+        self.rejected = 0
+
+    def reject(self, reason: str):
+        self.rejected += 1
+        if self.rejected <= LOGGED_REJECTIONS:
+            logger.warning("Skipping %s", reason)
+        if self.rejected == LOGGED_REJECTIONS:
+            logger.warning("Further rejected rows are only counted.")
+
+    def batches(self) -> typing.Iterator[typing.List[AccountBatch]]:
+        rows_by_account: typing.Dict[str, typing.List[typing.Tuple[str, int, str]]] = {}
+        buffered = 0
+        for path, format in zip(self.paths, self.formats):
+            with open_text(path) as text_file:
+                for line_number, row in READERS[format](text_file):
+                    if row is None:
+                        self.reject(f"{path} line {line_number}, it is not a row of {', '.join(COLUMNS)}.")
+                        continue
+                    account_id, payer, points, timestamp = row
+                    points = parse_points(points)
+                    if type(account_id) is not str or type(payer) is not str or type(timestamp) is not str or \
+                            points is None:
+                        self.reject(f"{path} line {line_number}, {row} is not a valid transaction.")
+                        continue
+                    rows_by_account.setdefault(account_id, []).append((payer, points, timestamp))
+                    buffered += 1
+                    if buffered >= self.batch_rows:
+                        yield self._batch(rows_by_account)
+                        rows_by_account = {}
+                        buffered = 0
+        if buffered:
+            yield self._batch(rows_by_account)
+
+    def _batch(self, rows_by_account: typing.Dict[str, typing.List[typing.Tuple[str, int, str]]]
+               ) -> typing.List[AccountBatch]:
+        timestamps = parse_timestamps({timestamp for rows in rows_by_account.values() for _, _, timestamp in rows})
+        batch = []
+        for account_id, rows in rows_by_account.items():
+            transactions = [(payer, points, timestamps[timestamp]) for payer, points, timestamp in rows]
+            if None in (timestamp for _, _, timestamp in transactions):
+                for (_, _, timestamp), (_, _, parsed) in zip(rows, transactions):
+                    if parsed is None:
+                        self.reject(f"a row of account '{account_id}', '{timestamp}' is not a timestamp.")
+                transactions = [transaction for transaction in transactions if transaction[2] is not None]
+            if transactions:
+                batch.append((account_id, transactions))
+        return batch
+
+
+class ImportReport:
+    def __init__(self, imported: int, rejected: int, batches: int, elapsed: float):
+        self.imported = imported
+        self.rejected = rejected
+        self.batches = batches
+        self.elapsed = elapsed
+
+    def to_dict(self) -> dict:
+        return {
+            "imported": self.imported,
+            "rejected": self.rejected,
+            "batches": self.batches,
+            "elapsed": self.elapsed,
+            "rows_per_second": self.imported / self.elapsed if self.elapsed else 0.0,
+        }
+
+    def format(self) -> str:
+        report = self.to_dict()
+        return (f"Imported {report['imported']} rows in {report['batches']} batches in {report['elapsed']:.2f}s "
+                f"({report['rows_per_second']:.0f} rows/s), rejected {report['rejected']}")
+
+
+def run_import(points_service,
+               paths: typing.List[str],
+               format: typing.Optional[str] = None,
+               batch_rows: int = DEFAULT_BATCH_ROWS,
+               audit: bool = False) -> ImportReport:
+    """
+    Imports the rows of `paths` into `points_service` through `import_transactions`. One batch is applied while the
+    next is read and batches are applied in order, so each account's rows are added in file order and at most two
+    batches are held at a time. Imported rows are only written to the audit trail with `audit`.
+    """
+    reader = RowReader(paths, format, batch_rows)
+    started = time.perf_counter()
+    imported, batches = 0, 0
+    pending: typing.Optional[concurrent.futures.Future] = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="Importer") as applier:
+        for batch in reader.batches():
+            if pending is not None:
+                imported += pending.result()
+            pending = applier.submit(points_service.import_transactions, batch, audit)
+            batches += 1
+            logger.debug("Read batch %d of %d accounts", batches, len(batch))
+        if pending is not None:
+            imported += pending.result()
+    return ImportReport(imported, reader.rejected, batches, time.perf_counter() - started)
+
+
+def main(argv: typing.Optional[typing.List[str]] = None):
+    parser = argparse.ArgumentParser(description="Bulk import historical transactions into the points service.")
+    parser.add_argument("paths", nargs="+", help="CSV or NDJSON files of account_id, payer, points and timestamp.")
+    parser.add_argument("--format", choices=FORMATS, help="Format of every file, told by extension by default.")
+    parser.add_argument("--batch-rows", type=int, default=DEFAULT_BATCH_ROWS,
+                        help="Rows read before they are applied, bounds memory use.")
+    parser.add_argument("--audit", action="store_true",
+                        help="Also write imported rows to the audit trail configured by POINTS_AUDIT_LOG.")
+    parser.add_argument("--json", help="Also write the report as JSON to this path.")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    from app.config import create_points_service
+    report = run_import(create_points_service(), args.paths, args.format, args.batch_rows, args.audit)
+    print(report.format())
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(report.to_dict(), json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
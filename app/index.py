@@ -0,0 +1,81 @@
+import bisect
+import typing
+
+
+class SortedKeys:
+    """
+    Sorted set of strings stored in blocks of bounded size.
+
+    Adding or discarding a key costs a binary search over the block maximums plus an insert into one block, and
+    reading the keys after a cursor costs a binary search plus the keys read, so paging through millions of keys
+    never sorts or scans them.
+    """
+
+    BLOCK_SIZE = 1024
+
+    def __init__(self, keys: typing.Iterable[str] = (), block_size: typing.Optional[int] = None):
+        self.block_size = block_size or self.BLOCK_SIZE
+        ordered = sorted(set(keys))
+        self._blocks: typing.List[typing.List[str]] = [ordered[start:start + self.block_size]
+                                                       for start in range(0, len(ordered), self.block_size)]
+        self._maxes: typing.List[str] = [block[-1] for block in self._blocks]
+        self._length = len(ordered)
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self) -> typing.Iterator[str]:
+        for block in self._blocks:
+            yield from block
+
+    def add(self, key: str):
+        if not self._maxes:
+            self._blocks.append([key])
+            self._maxes.append(key)
+            self._length += 1
+            return
+        block = min(bisect.bisect_left(self._maxes, key), len(self._maxes) - 1)
+        keys = self._blocks[block]
+        offset = bisect.bisect_left(keys, key)
+        if offset < len(keys) and keys[offset] == key:
+            return
+        keys.insert(offset, key)
+        self._maxes[block] = keys[-1]
+        self._length += 1
+        if len(keys) > 2 * self.block_size:
+            half = len(keys) // 2
+            self._blocks.insert(block + 1, keys[half:])
+            del keys[half:]
+            self._maxes[block] = keys[-1]
+            self._maxes.insert(block + 1, self._blocks[block + 1][-1])
+
+    def discard(self, key: str):
+        block = bisect.bisect_left(self._maxes, key)
+        if block == len(self._maxes):
+            return
+        keys = self._blocks[block]
+        offset = bisect.bisect_left(keys, key)
+        if keys[offset] != key:
+            return
+        del keys[offset]
+        self._length -= 1
+        if keys:
+            self._maxes[block] = keys[-1]
+        else:
+            del self._blocks[block]
+            del self._maxes[block]
+
+    def after(self, key: typing.Optional[str], limit: int) -> typing.List[str]:
+        # Up to `limit` keys greater than `key` in order, starting from the first key when `key` is None.
+        block, offset = 0, 0
+        if key is not None:
+            block = bisect.bisect_right(self._maxes, key)
+            if block == len(self._maxes):
+                return []
+            offset = bisect.bisect_right(self._blocks[block], key)
+        page: typing.List[str] = []
+        while block < len(self._blocks) and len(page) < limit:
+            page.extend(self._blocks[block][offset:offset + limit - len(page)])
+            block += 1
+            offset = 0
+        return page
@@ -0,0 +1,516 @@
+import array
+import bisect
+import heapq
+import itertools
+import typing
+import zlib
+
+
+# Ledger Index Structures
+class FenwickTree:
+    """Binary indexed tree over a list of integers with O(log n) point updates, prefix sums and prefix searches."""
+
+    def __init__(self, values: typing.Sequence[int] = ()):
+        self.size = len(values)
+        self.tree = [0] + list(values)
+        for index in range(1, self.size + 1):
+            parent = index + (index & -index)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[index]
+
+    def add(self, index: int, delta: int):
+        index += 1
+        while index <= self.size:
+            self.tree[index] += delta
+            index += index & -index
+
+    def prefix(self, index: int) -> int:
+        # Sum of the first `index` values.
+        total = 0
+        while index > 0:
+            total += self.tree[index]
+            index -= index & -index
+        return total
+
+    def search(self, target: int) -> typing.Tuple[int, int]:
+        # Finds the first index whose inclusive prefix sum exceeds `target` along with the sum of the values before
+        # it. Only valid while every value is non-negative.
+        index = 0
+        before = 0
+        step = 1 << self.size.bit_length()
+        while step:
+            candidate = index + step
+            if candidate <= self.size and before + self.tree[candidate] <= target:
+                index = candidate
+                before += self.tree[candidate]
+            step >>= 1
+        return index, before
+
+
+# (timestamp in epoch microseconds, account sequence, points, payer id)
+LedgerEntry = typing.Tuple[int, int, int, int]
+LedgerColumns = typing.Tuple[array.array, array.array, array.array, array.array]
+COLUMN_TYPECODES = ("q", "q", "q", "i")
+
+
+def split_index(columns: LedgerColumns, key: typing.Optional[typing.Tuple[int, int]]) -> int:
+    # Number of entries in ledger ordered columns that come before the (timestamp, sequence) key, all of them for None.
+    timestamps, sequences = columns[0], columns[1]
+    if key is None:
+        return len(timestamps)
+    index = bisect.bisect_left(timestamps, key[0])
+    while index < len(timestamps) and timestamps[index] == key[0] and sequences[index] < key[1]:
+        index += 1
+    return index
+
+
+def compress_columns(columns: LedgerColumns) -> bytes:
+    # Column bytes of a run of ledger entries in one zlib chunk, which stores an entry in about a third of its size.
+    return zlib.compress(b"".join(column.tobytes() for column in columns), 1)
+
+
+def decompress_columns(chunk: bytes) -> LedgerColumns:
+    data = zlib.decompress(chunk)
+    entries = len(data) // sum(array.array(typecode).itemsize for typecode in COLUMN_TYPECODES)
+    columns = []
+    offset = 0
+    for typecode in COLUMN_TYPECODES:
+        column = array.array(typecode)
+        end = offset + entries * column.itemsize
+        column.frombytes(data[offset:end])
+        columns.append(column)
+        offset = end
+    return tuple(columns)
+
+
+class Ledger:
+    """
+    Timestamp sorted ledger entries stored column-wise in blocks of bounded size.
+
+    Each block keeps its timestamps, sequences, points and payer ids in typed arrays, so an entry costs 28 bytes
+    instead of a Python object graph. Inserts anywhere in the ledger cost a binary search over the block maximums
+    plus an insert into one block, so backdated entries no longer shift the whole ledger. Block point totals are kept
+    in a Fenwick tree, giving O(log n) access to the entry where a running point total is crossed.
+
+    Entries are ordered by (timestamp, sequence). Sequences are handed out in increasing order, so a new entry goes
+    after those sharing its timestamp, but entries moved back out of an archive land among them.
+
+    With `payer_index` each block also keeps its point total per payer, with a Fenwick tree per payer over them, so
+    each payer's points up to a timestamp take O(log n) plus a scan of one block.
+    """
+
+    BLOCK_SIZE = 512
+
+    def __init__(self, block_size: typing.Optional[int] = None, payer_index: bool = False):
+        self.block_size = block_size or self.BLOCK_SIZE
+        self.payer_index = payer_index
+        self.total_points = 0
+        self._length = 0
+        self._timestamps: typing.List[array.array] = []
+        self._sequences: typing.List[array.array] = []
+        self._points: typing.List[array.array] = []
+        self._payers: typing.List[array.array] = []
+        self._maxes: typing.List[int] = []
+        self._tree = FenwickTree()
+        self._payer_sums: typing.List[typing.Dict[int, int]] = []
+        self._payer_trees: typing.Dict[int, FenwickTree] = {}
+
+    @classmethod
+    def from_columns(cls,
+                     timestamps: array.array,
+                     sequences: array.array,
+                     points: array.array,
+                     payers: array.array,
+                     block_size: typing.Optional[int] = None,
+                     payer_index: bool = False) -> "Ledger":
+        # Builds a ledger from columns that are already in ledger order, in O(n) without any per entry inserts.
+        ledger = cls(block_size, payer_index)
+        ledger._append_blocks((timestamps, sequences, points, payers))
+        ledger._length = len(timestamps)
+        ledger.total_points = sum(points)
+        return ledger
+
+    def to_columns(self) -> LedgerColumns:
+        # Copies of the timestamp, sequence, points and payer id columns in ledger order.
+        copies = tuple(array.array(typecode) for typecode in COLUMN_TYPECODES)
+        for copy, column in zip(copies, self._columns()):
+            for block in column:
+                copy.extend(block)
+        return copies
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self) -> typing.Iterator[LedgerEntry]:
+        for columns in zip(self._timestamps, self._sequences, self._points, self._payers):
+            yield from zip(*columns)
+
+    def _columns(self):
+        return self._timestamps, self._sequences, self._points, self._payers
+
+    def insert(self, timestamp: int, sequence: int, points: int, payer: int):
+        if not self._maxes:
+            self._timestamps.append(array.array('q', [timestamp]))
+            self._sequences.append(array.array('q', [sequence]))
+            self._points.append(array.array('q', [points]))
+            self._payers.append(array.array('i', [payer]))
+            self._maxes.append(timestamp)
+            self._tree = FenwickTree([points])
+            if self.payer_index:
+                self._payer_sums.append({payer: points})
+                self._rebuild_payer_trees()
+        else:
+            block = bisect.bisect_left(self._maxes, timestamp)
+            while block < len(self._maxes) - 1 and self._maxes[block] == timestamp and \
+                    self._sequences[block][-1] < sequence:
+                block += 1
+            block = min(block, len(self._maxes) - 1)
+            timestamps = self._timestamps[block]
+            offset = bisect.bisect_left(self._sequences[block], sequence, bisect.bisect_left(timestamps, timestamp),
+                                        bisect.bisect_right(timestamps, timestamp))
+            timestamps.insert(offset, timestamp)
+            self._sequences[block].insert(offset, sequence)
+            self._points[block].insert(offset, points)
+            self._payers[block].insert(offset, payer)
+            self._maxes[block] = timestamps[-1]
+            self._tree.add(block, points)
+            if self.payer_index:
+                payer_sums = self._payer_sums[block]
+                payer_sums[payer] = payer_sums.get(payer, 0) + points
+                if payer in self._payer_trees:
+                    self._payer_trees[payer].add(block, points)
+                else:
+                    self._rebuild_payer_trees()
+            if len(timestamps) > 2 * self.block_size:
+                self._split(block)
+        self._length += 1
+        self.total_points += points
+
+    def merge(self, entries: typing.List[LedgerEntry]):
+        """
+        Merges entries sorted by (timestamp, sequence) into the ledger. Blocks before the first one the entries land
+        in are left alone and the rest are rebuilt by a single sort-merge pass, which is O(n + m) at worst. Batches
+        that are tiny compared to what would be rebuilt are inserted one at a time instead, and batches that all come
+        after the last entry are appended.
+        """
+        if not entries:
+            return
+        if not self._maxes or entries[0][:2] > (self._maxes[-1], self._sequences[-1][-1]):
+            self._extend(entries)
+            return
+        first = min(bisect.bisect_left(self._maxes, entries[0][0]), max(len(self._maxes) - 1, 0))
+        rebuilt = sum(len(timestamps) for timestamps in self._timestamps[first:])
+        if len(entries) * 16 < rebuilt:
+            for entry in entries:
+                self.insert(*entry)
+            return
+        existing = zip(*(itertools.chain.from_iterable(column[first:]) for column in self._columns()))
+        merged = zip(*heapq.merge(existing, entries))
+        for column in self._columns():
+            del column[first:]
+        del self._maxes[first:]
+        del self._payer_sums[first:]
+        self._append_blocks([array.array(typecode, values) for typecode, values in zip("qqqi", merged)])
+        self._length += len(entries)
+        self.total_points += sum(entry[2] for entry in entries)
+
+    def _extend(self, entries: typing.List[LedgerEntry]):
+        # Entries that all come after the last one, as when history is loaded in order, top up the last block and the
+        # rest become new blocks. Nothing is rebuilt until a block is added.
+        columns = [array.array(typecode, values) for typecode, values in zip(COLUMN_TYPECODES, zip(*entries))]
+        filled = 0
+        if self._maxes:
+            block = len(self._maxes) - 1
+            filled = min(max(self.block_size - len(self._timestamps[block]), 0), len(entries))
+        if filled:
+            for column, values in zip(self._columns(), columns):
+                column[block].extend(values[:filled])
+            self._maxes[block] = self._timestamps[block][-1]
+            self._tree.add(block, sum(columns[2][:filled]))
+            if self.payer_index:
+                payer_sums = self._payer_sums[block]
+                added: typing.Dict[int, int] = {}
+                for payer, points in zip(columns[3][:filled], columns[2][:filled]):
+                    added[payer] = added.get(payer, 0) + points
+                for payer, points in added.items():
+                    payer_sums[payer] = payer_sums.get(payer, 0) + points
+                    if payer in self._payer_trees:
+                        self._payer_trees[payer].add(block, points)
+                if not added.keys() <= self._payer_trees.keys():
+                    self._rebuild_payer_trees()
+        if filled < len(entries):
+            self._append_blocks([values[filled:] for values in columns])
+        self._length += len(entries)
+        self.total_points += sum(columns[2])
+
+    def _append_blocks(self, columns: typing.Sequence[array.array]):
+        # Appends sorted columns as full blocks after the existing ones and rebuilds the Fenwick tree.
+        for start in range(0, len(columns[0]), self.block_size):
+            for column, values in zip(self._columns(), columns):
+                column.append(values[start:start + self.block_size])
+            self._maxes.append(self._timestamps[-1][-1])
+            if self.payer_index:
+                self._payer_sums.append(self._block_payer_sums(len(self._maxes) - 1))
+        self._tree = FenwickTree([sum(points) for points in self._points])
+        if self.payer_index:
+            self._rebuild_payer_trees()
+
+    def _split(self, block: int):
+        half = len(self._timestamps[block]) // 2
+        for column in self._columns():
+            column.insert(block + 1, column[block][half:])
+            del column[block][half:]
+        self._maxes[block] = self._timestamps[block][-1]
+        self._maxes.insert(block + 1, self._timestamps[block + 1][-1])
+        self._tree = FenwickTree([sum(points) for points in self._points])
+        if self.payer_index:
+            self._payer_sums[block:block + 1] = [self._block_payer_sums(block), self._block_payer_sums(block + 1)]
+            self._rebuild_payer_trees()
+
+    def _block_payer_sums(self, block: int) -> typing.Dict[int, int]:
+        payer_sums: typing.Dict[int, int] = {}
+        for payer, points in zip(self._payers[block], self._points[block]):
+            payer_sums[payer] = payer_sums.get(payer, 0) + points
+        return payer_sums
+
+    def _rebuild_payer_trees(self):
+        payers = set().union(*self._payer_sums)
+        self._payer_trees = {payer: FenwickTree([payer_sums.get(payer, 0) for payer_sums in self._payer_sums])
+                             for payer in payers}
+
+    def payer_points_through(self, timestamp: int) -> typing.Dict[int, int]:
+        # Points per payer id of the entries at or before the timestamp. Requires `payer_index`.
+        blocks = bisect.bisect_right(self._maxes, timestamp)
+        totals = {payer: tree.prefix(blocks) for payer, tree in self._payer_trees.items()}
+        if blocks < len(self._maxes):
+            end = bisect.bisect_right(self._timestamps[blocks], timestamp)
+            for payer, points in zip(self._payers[blocks][:end], self._points[blocks][:end]):
+                totals[payer] += points
+        return totals
+
+    def entries_from(self,
+                     key: typing.Tuple[int, int],
+                     payer: typing.Optional[int] = None) -> typing.Iterator[LedgerEntry]:
+        """
+        Entries from the (timestamp, sequence) key on in ledger order, only those of `payer` when given. The first
+        block is found by binary search over the block maximums, and with `payer_index` blocks without any entry of
+        the payer are skipped without being read.
+        """
+        timestamp, sequence = key
+        first = bisect.bisect_left(self._maxes, timestamp)
+        for block in range(first, len(self._maxes)):
+            if payer is not None and self.payer_index and payer not in self._payer_sums[block]:
+                continue
+            entries = zip(*(column[block] for column in self._columns()))
+            if block == first:
+                entries = itertools.islice(entries, bisect.bisect_left(self._timestamps[block], timestamp), None)
+            for entry in entries:
+                # Entries before the key only remain among those sharing its timestamp.
+                if (payer is None or entry[3] == payer) and (entry[0] > timestamp or entry[1] >= sequence):
+                    yield entry
+
+    def locate(self, target: int) -> typing.Optional[typing.Tuple[LedgerEntry, int]]:
+        """
+        Returns the first entry whose running point total exceeds `target` with its points beyond `target`, or None
+        when the total points do not exceed it. Requires non-negative points.
+        """
+        if target >= self.total_points:
+            return None
+        block, before = self._tree.search(target)
+        running_points = list(itertools.accumulate(self._points[block], initial=before))
+        offset = bisect.bisect_right(running_points, target) - 1
+        entry = tuple(column[block][offset] for column in self._columns())
+        return entry, running_points[offset + 1] - target
+
+    def nbytes(self) -> int:
+        # Bytes held by the column arrays, excluding the per-block and index overhead.
+        return sum(column.buffer_info()[1] * column.itemsize for columns in self._columns() for column in columns)
+
+
+class ArchiveChunk:
+    """
+    Ledger entries folded out of an account, compressed in blocks of `Ledger.BLOCK_SIZE` entries.
+
+    Each block's last timestamp and, at the end of each block, the running point total of every payer and the running
+    total of its lots (positive entries) are kept uncompressed. Points per payer up to a timestamp then take a binary
+    search over the blocks and decompressing at most the one block the timestamp falls in, and a payer's newest lots
+    are found without decompressing blocks that hold none.
+    """
+
+    def __init__(self,
+                 blocks: typing.List[bytes],
+                 maxes: array.array,
+                 payer_totals: typing.Dict[int, array.array],
+                 lot_totals: typing.Dict[int, array.array],
+                 entries: int):
+        self.blocks = blocks
+        self.maxes = maxes
+        self.payer_totals = payer_totals
+        self.lot_totals = lot_totals
+        self.entries = entries
+
+    @classmethod
+    def from_columns(cls, columns: LedgerColumns, block_size: typing.Optional[int] = None) -> "ArchiveChunk":
+        # Columns in ledger order.
+        block_size = block_size or Ledger.BLOCK_SIZE
+        timestamps, _, points, payers = columns
+        blocks = []
+        maxes = array.array("q")
+        running: typing.Dict[int, int] = {}
+        running_lots: typing.Dict[int, int] = {}
+        payer_totals: typing.Dict[int, array.array] = {}
+        lot_totals: typing.Dict[int, array.array] = {}
+        for start in range(0, len(timestamps), block_size):
+            end = start + block_size
+            blocks.append(compress_columns(tuple(column[start:end] for column in columns)))
+            maxes.append(timestamps[min(end, len(timestamps)) - 1])
+            for payer, entry_points in zip(payers[start:end], points[start:end]):
+                running[payer] = running.get(payer, 0) + entry_points
+                running_lots[payer] = running_lots.get(payer, 0) + max(entry_points, 0)
+            for totals, block_running in ((payer_totals, running), (lot_totals, running_lots)):
+                for payer in block_running:
+                    totals.setdefault(payer, array.array("q", [0] * (len(blocks) - 1)))
+                for payer, total in totals.items():
+                    total.append(block_running[payer])
+        return cls(blocks, maxes, payer_totals, lot_totals, len(timestamps))
+
+    @classmethod
+    def merge(cls,
+              chunks: typing.List["ArchiveChunk"],
+              columns: LedgerColumns,
+              block_size: typing.Optional[int] = None) -> "ArchiveChunk":
+        """
+        One chunk holding the entries of `chunks` and of the ledger ordered `columns`. When there is a single chunk and
+        the new entries all come after it, as folded spends and spent lots usually do, they are compressed into blocks
+        appended to it and the chunk's own blocks are left as they are. Anything else is merged and compressed again.
+        """
+        if len(chunks) == 1 and columns[0] and columns[0][0] > chunks[0].maxes[-1]:
+            return chunks[0]._appended(cls.from_columns(columns, block_size))
+        parts = [chunk.columns() for chunk in chunks] + [columns]
+        merged = tuple(array.array(typecode) for typecode in COLUMN_TYPECODES)
+        for entry in heapq.merge(*(zip(*part) for part in parts)):
+            for column, value in zip(merged, entry):
+                column.append(value)
+        return cls.from_columns(merged, block_size)
+
+    def _appended(self, appended: "ArchiveChunk") -> "ArchiveChunk":
+        # This chunk followed by the blocks of `appended`, whose entries all come after this chunk's.
+        totals = []
+        for own, added in ((self.payer_totals, appended.payer_totals), (self.lot_totals, appended.lot_totals)):
+            combined: typing.Dict[int, array.array] = {}
+            for payer in own.keys() | added.keys():
+                total = own.get(payer, array.array("q", [0] * len(self.blocks)))
+                later = added.get(payer, array.array("q", [0] * len(appended.blocks)))
+                combined[payer] = total + array.array("q", (total[-1] + points for points in later))
+            totals.append(combined)
+        return ArchiveChunk(self.blocks + appended.blocks, self.maxes + appended.maxes, *totals,
+                            self.entries + appended.entries)
+
+    def __len__(self):
+        return self.entries
+
+    def columns(self) -> LedgerColumns:
+        columns = tuple(array.array(typecode) for typecode in COLUMN_TYPECODES)
+        for block in self.blocks:
+            for column, block_column in zip(columns, decompress_columns(block)):
+                column.extend(block_column)
+        return columns
+
+    def payer_points_through(self, timestamp: int) -> typing.Dict[int, int]:
+        # Points per payer id of the archived entries at or before the timestamp.
+        blocks = bisect.bisect_right(self.maxes, timestamp)
+        totals = {payer: total[blocks - 1] if blocks else 0 for payer, total in self.payer_totals.items()}
+        if blocks < len(self.blocks):
+            timestamps, _, points, payers = decompress_columns(self.blocks[blocks])
+            end = bisect.bisect_right(timestamps, timestamp)
+            for payer, entry_points in zip(payers[:end], points[:end]):
+                totals[payer] += entry_points
+        return totals
+
+    def entries_from(self,
+                     key: typing.Tuple[int, int],
+                     payer: typing.Optional[int] = None) -> typing.Iterator[LedgerEntry]:
+        # Archived entries from the (timestamp, sequence) key on in ledger order. The first block is found by binary
+        # search over the block maximums and blocks are decompressed one at a time as the entries are consumed.
+        if payer is not None and payer not in self.payer_totals:
+            return
+        timestamp, sequence = key
+        first = bisect.bisect_left(self.maxes, timestamp)
+        for block in range(first, len(self.blocks)):
+            columns = decompress_columns(self.blocks[block])
+            entries = zip(*columns)
+            if block == first:
+                entries = itertools.islice(entries, bisect.bisect_left(columns[0], timestamp), None)
+            for entry in entries:
+                # Entries before the key only remain among those sharing its timestamp.
+                if (payer is None or entry[3] == payer) and (entry[0] > timestamp or entry[1] >= sequence):
+                    yield entry
+
+    def take_lots(self,
+                  payer: int,
+                  timestamp: int,
+                  points: int) -> typing.Tuple["ArchiveChunk", typing.List[LedgerEntry]]:
+        """
+        Takes the payer's newest lots dated after the epoch timestamp out of the chunk until their points reach
+        `points` or there are none left, returning the chunk without them and the entries taken in ledger order.
+
+        The running lot totals give the first block that can hold any of them, later blocks without lots of the payer
+        are skipped, and only the blocks that lose entries are decompressed and compressed again. The running totals
+        of the blocks after them are lowered by the points taken.
+        """
+        lots = self.lot_totals.get(payer)
+        if lots is None or points <= 0:
+            return self, []
+        first = max(bisect.bisect_right(self.maxes, timestamp), bisect.bisect_right(lots, lots[-1] - points))
+        taken: typing.List[LedgerEntry] = []
+        taken_points = 0
+        # Columns left in each block entries were taken from, with the points taken from it.
+        rewritten: typing.Dict[int, typing.Tuple[LedgerColumns, int]] = {}
+        for block in range(len(self.blocks) - 1, first - 1, -1):
+            if taken_points >= points:
+                break
+            if lots[block] == (lots[block - 1] if block else 0):
+                continue
+            columns = decompress_columns(self.blocks[block])
+            timestamps, _, entry_points, payers = columns
+            kept = [True] * len(timestamps)
+            block_points = 0
+            for index in range(len(kept) - 1, -1, -1):
+                if taken_points + block_points >= points or timestamps[index] <= timestamp:
+                    break
+                if payers[index] == payer and entry_points[index] > 0:
+                    kept[index] = False
+                    taken.append(tuple(column[index] for column in columns))
+                    block_points += entry_points[index]
+            if block_points:
+                taken_points += block_points
+                rewritten[block] = (tuple(array.array(column.typecode, itertools.compress(column, kept))
+                                          for column in columns), block_points)
+        if not taken:
+            return self, []
+        blocks = list(self.blocks)
+        maxes = array.array("q", self.maxes)
+        payer_totals = {payer_id: array.array("q", total) for payer_id, total in self.payer_totals.items()}
+        lot_totals = {payer_id: array.array("q", total) for payer_id, total in self.lot_totals.items()}
+        removed = 0
+        for block in range(min(rewritten), len(blocks)):
+            if block in rewritten:
+                columns, block_points = rewritten[block]
+                removed += block_points
+                if columns[0]:
+                    blocks[block] = compress_columns(columns)
+                    maxes[block] = columns[0][-1]
+            payer_totals[payer][block] -= removed
+            lot_totals[payer][block] -= removed
+        for block in sorted(rewritten, reverse=True):
+            if not rewritten[block][0][0]:
+                del blocks[block], maxes[block]
+                for total in itertools.chain(payer_totals.values(), lot_totals.values()):
+                    del total[block]
+        taken.reverse()
+        return ArchiveChunk(blocks, maxes, payer_totals, lot_totals, self.entries - len(taken)), taken
+
+    def nbytes(self) -> int:
+        return (sum(map(len, self.blocks)) + self.maxes.itemsize * len(self.maxes) +
+                sum(total.itemsize * len(total) for totals in (self.payer_totals, self.lot_totals)
+                    for total in totals.values()))
@@ -0,0 +1,300 @@
+"""
+Open-loop load generator for the points API.
+
+Requests are scheduled at a fixed arrival rate regardless of how fast earlier ones complete, so a slow server builds
+up a queue instead of slowing the load down. Latency is measured from when a request was scheduled to be sent, which
+corrects for coordinated omission: time a request spends waiting behind slow ones is counted against it.
+
+    python -m app.loadgen --rate 500 --duration 10 --mix add=8,spend=1,get=1
+    python -m app.loadgen --spawn asgi --rate 2000 --duration 30 --json results.json
+    python -m app.loadgen --url http://127.0.0.1:5000 --rate 200 --mix spend=1
+"""
+import argparse
+import datetime
+import http.client
+import json
+import logging
+import os
+import queue
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import typing
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+PAYERS = ["DANNON", "UNILEVER", "MILLER COORS", "KRAFT"]
+OPERATIONS = ("add", "spend", "get")
+PERCENTILES = (50.0, 99.0, 99.9)
+
+
+def parse_mix(mix: str) -> typing.Dict[str, float]:
+    # "add=8,spend=1,get=1" -> relative weights of each operation.
+    weights = {}
+    for part in mix.split(","):
+        operation, _, weight = part.partition("=")
+        operation = operation.strip()
+        if operation not in OPERATIONS:
+            raise ValueError(f"Unknown operation '{operation}' in mix '{mix}', expected one of {OPERATIONS}.")
+        weights[operation] = float(weight or 1)
+    if not any(weights.values()):
+        raise ValueError(f"Mix '{mix}' has no operation with a positive weight.")
+    return weights
+
+
+def build_request(operation: str, account_id: str, generator: random.Random) -> typing.Tuple[str, str, bytes]:
+    # (method, path, body) of one request for an operation.
+    if operation == "add":
+        timestamp = datetime.datetime(2020, 1, 1) + datetime.timedelta(seconds=generator.randint(0, 10 ** 8))
+        body = {"payer": generator.choice(PAYERS), "points": 100, "timestamp": f"{timestamp.isoformat()}Z"}
+        return "POST", f"/points/{account_id}/add", json.dumps(body).encode("utf-8")
+    if operation == "spend":
+        return "POST", f"/points/{account_id}/spend", json.dumps({"points": 10}).encode("utf-8")
+    return "GET", f"/points/{account_id}", b""
+
+
+# Targets
+class InProcessTarget:
+    # Sends requests through Flask's WSGI test client, one client per sending thread.
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self._local = threading.local()
+
+    def request(self, method: str, path: str, body: bytes) -> int:
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.flask_app.test_client()
+        response = client.open(path, method=method, data=body, content_type="application/json")
+        return response.status_code
+
+
+class HTTPTarget:
+    # Sends requests over one keep-alive connection per sending thread, reconnecting when the server closes it.
+    def __init__(self, url: str):
+        parsed = urllib.parse.urlsplit(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self._local = threading.local()
+
+    def request(self, method: str, path: str, body: bytes) -> int:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        try:
+            connection.request(method, path, body=body or None, headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            response.read()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            self._local.connection = None
+            raise
+        if response.will_close:
+            connection.close()
+            self._local.connection = None
+        return response.status
+
+
+class SpawnedServer:
+    # Runs the Flask or ASGI app in a child process on a free local port for the duration of a `with` block.
+    COMMANDS = {
+        "flask": [sys.executable, "-m", "flask", "run", "--with-threads", "--host", "127.0.0.1", "--port", "{port}"],
+        "asgi": [sys.executable, "-m", "uvicorn", "app.asgi:app", "--host", "127.0.0.1", "--port", "{port}",
+                 "--log-level", "warning", "--no-access-log"],
+    }
+
+    def __init__(self, server: str):
+        self.server = server
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            self.port = probe.getsockname()[1]
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.process: typing.Optional[subprocess.Popen] = None
+
+    def __enter__(self) -> "SpawnedServer":
+        command = [argument.format(port=self.port) for argument in self.COMMANDS[self.server]]
+        self.process = subprocess.Popen(command, env=dict(os.environ, FLASK_APP="app.app"),
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                return self
+            except OSError:
+                time.sleep(0.1)
+        self.process.kill()
+        raise RuntimeError(f"{self.server} server did not start on port {self.port}")
+
+    def __exit__(self, *exc_info):
+        self.process.terminate()
+        self.process.wait(timeout=10)
+
+
+# Load Generation
+class Sample(typing.NamedTuple):
+    operation: str
+    status: int
+    scheduled: float
+    sent: float
+    completed: float
+
+
+def percentile(sorted_values: typing.Sequence[float], percent: float) -> float:
+    # Nearest rank percentile of already sorted values.
+    if not sorted_values:
+        return float("nan")
+    rank = max(int(len(sorted_values) * percent / 100.0 + 0.5) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+class LoadReport:
+    def __init__(self, samples: typing.List[Sample], target_rate: float, duration: float, elapsed: float):
+        self.samples = samples
+        self.target_rate = target_rate
+        self.duration = duration
+        self.elapsed = elapsed
+
+    def summary(self, samples: typing.List[Sample]) -> dict:
+        # Response time counts from when the request was scheduled, service time from when it was actually sent.
+        response_times = sorted(sample.completed - sample.scheduled for sample in samples)
+        service_times = sorted(sample.completed - sample.sent for sample in samples)
+        statuses: typing.Dict[str, int] = {}
+        for sample in samples:
+            statuses[str(sample.status)] = statuses.get(str(sample.status), 0) + 1
+        return {
+            "requests": len(samples),
+            "statuses": statuses,
+            "response_time_ms": {f"p{percent:g}": percentile(response_times, percent) * 1000
+                                 for percent in PERCENTILES},
+            "service_time_ms": {f"p{percent:g}": percentile(service_times, percent) * 1000
+                                for percent in PERCENTILES},
+        }
+
+    def to_dict(self) -> dict:
+        by_operation = {operation: [sample for sample in self.samples if sample.operation == operation]
+                        for operation in OPERATIONS}
+        return {
+            "target_rate": self.target_rate,
+            "duration": self.duration,
+            "elapsed": self.elapsed,
+            "throughput": len(self.samples) / self.elapsed if self.elapsed else 0.0,
+            "all": self.summary(self.samples),
+            "operations": {operation: self.summary(samples) for operation, samples in by_operation.items()
+                           if samples},
+        }
+
+    def format(self) -> str:
+        report = self.to_dict()
+        lines = [f"Target {report['target_rate']:.0f} requests/s for {report['duration']:g}s, completed "
+                 f"{report['all']['requests']} in {report['elapsed']:.2f}s ({report['throughput']:.0f} requests/s)"]
+        for name, summary in [("all", report["all"]), *report["operations"].items()]:
+            response_times = " ".join(f"{key} {value:.2f}" for key, value in summary["response_time_ms"].items())
+            service_times = " ".join(f"{key} {value:.2f}" for key, value in summary["service_time_ms"].items())
+            lines.append(f"  {name:<6} {summary['requests']:>8} requests  statuses {summary['statuses']}")
+            lines.append(f"         response time ms {response_times}  |  service time ms {service_times}")
+        return "\n".join(lines)
+
+
+def run_load(target,
+             mix: typing.Dict[str, float],
+             rate: float,
+             duration: float,
+             accounts: int = 100,
+             concurrency: int = 32,
+             poisson: bool = False,
+             seed: int = 0) -> LoadReport:
+    """
+    Sends `rate` requests per second for `duration` seconds to `target`, choosing operations by the `mix` weights and
+    accounts uniformly. A dispatcher thread releases each request at its scheduled time, with constant or, with
+    `poisson`, exponentially distributed gaps, and `concurrency` threads send them. Requests released while every
+    sender is busy wait in the queue and that wait is part of their response time.
+    """
+    generator = random.Random(seed)
+    account_ids = [f"load-{account}" for account in range(accounts)]
+    # Every account starts with enough points that spends in the mix do not all fail.
+    for account_id in account_ids:
+        for payer in PAYERS:
+            body = json.dumps({"payer": payer, "points": 100000, "timestamp": "2020-01-01T00:00:00Z"})
+            target.request("POST", f"/points/{account_id}/add", body.encode("utf-8"))
+
+    operations, weights = zip(*mix.items())
+    total = int(rate * duration)
+    pending: "queue.Queue[typing.Optional[typing.Tuple[str, typing.Tuple[str, str, bytes], float]]]" = queue.Queue()
+    samples: typing.List[Sample] = []
+
+    def send():
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            operation, request, scheduled = item
+            sent = time.perf_counter()
+            try:
+                status = target.request(*request)
+            except Exception as exception:
+                logger.warning(f"{operation} request failed: {exception!r}")
+                status = 0
+            samples.append(Sample(operation, status, scheduled, sent, time.perf_counter()))
+
+    senders = [threading.Thread(target=send, name=f"LoadSender-{sender}", daemon=True)
+               for sender in range(concurrency)]
+    for sender in senders:
+        sender.start()
+    started = time.perf_counter()
+    scheduled = started
+    for _ in range(total):
+        operation = generator.choices(operations, weights)[0]
+        request = build_request(operation, generator.choice(account_ids), generator)
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        pending.put((operation, request, scheduled))
+        scheduled += generator.expovariate(rate) if poisson else 1.0 / rate
+    for _ in senders:
+        pending.put(None)
+    for sender in senders:
+        sender.join()
+    return LoadReport(samples, rate, duration, time.perf_counter() - started)
+
+
+def main(argv: typing.Optional[typing.List[str]] = None):
+    parser = argparse.ArgumentParser(description="Open-loop load generator for the points API.")
+    where = parser.add_mutually_exclusive_group()
+    where.add_argument("--url", help="Base URL of a running server, the Flask app is driven in-process by default.")
+    where.add_argument("--spawn", choices=sorted(SpawnedServer.COMMANDS), help="Start a local server to target.")
+    parser.add_argument("--rate", type=float, default=200.0, help="Requests per second to schedule.")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to schedule requests for.")
+    parser.add_argument("--mix", default="add=8,spend=1,get=1", help="Relative weights of add, spend and get.")
+    parser.add_argument("--accounts", type=int, default=100, help="Accounts requests are spread over.")
+    parser.add_argument("--concurrency", type=int, default=32, help="Threads sending requests.")
+    parser.add_argument("--poisson", action="store_true", help="Exponential gaps between requests.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the report as JSON to this path.")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    def run(target) -> LoadReport:
+        return run_load(target, parse_mix(args.mix), args.rate, args.duration, args.accounts, args.concurrency,
+                        args.poisson, args.seed)
+
+    if args.spawn:
+        with SpawnedServer(args.spawn) as server:
+            report = run(HTTPTarget(server.url))
+    elif args.url:
+        report = run(HTTPTarget(args.url))
+    else:
+        from app.app import app as flask_app
+        # Keep per request logging of the in-process app from competing with the load generator.
+        logging.getLogger("app").setLevel(logging.WARNING)
+        report = run(InProcessTarget(flask_app))
+    print(report.format())
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(report.to_dict(), json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
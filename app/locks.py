@@ -0,0 +1,32 @@
+import asyncio
+import threading
+import typing
+
+
+class StripedLocks:
+    """
+    Fixed pool of locks shared by hashing keys onto them.
+
+    Looking up a key's lock never allocates and the pool never grows, so there is nothing to create on first use or
+    reclaim when an account is removed. Unrelated keys that hash to the same stripe share a lock, which only costs
+    contention when both are busy at once, so the pool should be a few times larger than the expected number of
+    concurrently busy accounts.
+    """
+
+    STRIPES = 1024
+    LOCK_FACTORY = threading.Lock
+
+    def __init__(self, stripes: typing.Optional[int] = None):
+        self.locks = [self.LOCK_FACTORY() for _ in range(stripes or self.STRIPES)]
+
+    def __getitem__(self, key: str):
+        return self.locks[hash(key) % len(self.locks)]
+
+    def __len__(self):
+        return len(self.locks)
+
+
+class AsyncStripedLocks(StripedLocks):
+    """`StripedLocks` of asyncio locks, waiting on a busy key suspends the coroutine instead of blocking a thread."""
+
+    LOCK_FACTORY = asyncio.Lock
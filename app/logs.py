@@ -0,0 +1,193 @@
+"""
+Logging off the request thread.
+
+`configure_logging` routes every log record through a bounded queue to a listener thread that formats and writes it,
+so a request only pays for creating the record. Messages use lazy %-style arguments, which are formatted by the
+listener and only when the record is actually emitted. Arguments must therefore not be mutated after they are
+logged.
+
+Applied transactions are written to an audit trail configured by POINTS_AUDIT_LOG:
+
+    log              every applied transaction is logged at INFO by the "app.audit" logger (default)
+    sample:<rate>    only that fraction of them is logged, e.g. sample:0.01
+    binary:<path>    all of them are appended to a buffered binary file, read back with `read_audit_log`
+    off              none are
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+import time
+import typing
+
+from app.metrics import METRICS
+from app.model import Transaction
+
+logger = logging.getLogger(__name__)
+audit_logger = logging.getLogger("app.audit")
+
+LOG_FORMAT = "%(levelname)s:%(name)s:%(message)s"
+LOG_QUEUE_SIZE = 65536
+
+LOG_RECORDS_DROPPED = METRICS.counter("points_log_records_dropped_total",
+                                      "Log records dropped because the log queue was full.")
+AUDIT_RECORDS_SAMPLED_OUT = METRICS.counter("points_audit_records_sampled_out_total",
+                                            "Applied transactions left out of a sampled audit log.")
+
+AUDIT_RECORD = b"A"
+
+
+class AsyncLogHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that leaves records unformatted for the listener thread.
+
+    The standard `QueueHandler` formats each record on the logging thread before queueing it, which is the cost this
+    handler exists to move. The queue is a `queue.SimpleQueue`, whose puts take no lock in Python code, bounded by
+    checking its size first. When it holds `capacity` records a record is dropped and counted rather than blocking
+    the request.
+    """
+
+    def __init__(self, log_queue: "queue.SimpleQueue[logging.LogRecord]", capacity: int = LOG_QUEUE_SIZE):
+        super().__init__(log_queue)
+        self.capacity = capacity
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Stack frames cannot be formatted once the logging function has returned.
+        if record.stack_info:
+            record.stack_info = str(record.stack_info)
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        if self.queue.qsize() >= self.capacity:
+            LOG_RECORDS_DROPPED.inc()
+            return
+        self.queue.put_nowait(record)
+
+
+def configure_logging(level: int = logging.INFO,
+                      stream: typing.Optional[typing.TextIO] = None,
+                      queue_size: int = LOG_QUEUE_SIZE) -> typing.Optional[logging.handlers.QueueListener]:
+    # Like logging.basicConfig, does nothing when the root logger already has handlers.
+    root = logging.getLogger()
+    if root.handlers:
+        return None
+    stream_handler = logging.StreamHandler(stream)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    # Records still queued at exit are written out before the process ends.
+    atexit.register(listener.stop)
+    root.addHandler(AsyncLogHandler(log_queue, queue_size))
+    root.setLevel(level)
+    return listener
+
+
+# Audit Trail
+class BinaryAuditSink:
+    """
+    Appends applied transactions to a binary file in the write ahead log's frame format, with the time a record was
+    written in place of its log sequence.
+
+    Frames are buffered in memory and written when the buffer fills, every `flush_interval` seconds and at exit. The
+    file is opened for appending and each write is whole frames, so several shard processes can share one file.
+    """
+
+    BUFFER_SIZE = 1 << 16
+
+    def __init__(self, path: str, flush_interval: float = 1.0, buffer_size: typing.Optional[int] = None):
+        self.path = path
+        self.buffer_size = buffer_size or self.BUFFER_SIZE
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        self._file = open(path, "ab", buffering=0)
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(target=self._run, args=(flush_interval,), name="AuditFlusher", daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+
+    def write(self, account_id: str, transactions: typing.List[Transaction]):
+        # The frame codec lives with persistence, which imports the service that imports this module, so it is only
+        # imported once everything is loaded.
+        from app.persistence import encode_frame, encode_string, encode_transactions
+        body = encode_string(account_id) + encode_transactions(transactions)
+        frame = encode_frame(time.time_ns() // 1000, AUDIT_RECORD, len(transactions), body)
+        with self._lock:
+            self._buffer += frame
+            if len(self._buffer) < self.buffer_size:
+                return
+            data = bytes(self._buffer)
+            self._buffer.clear()
+            # Written under the lock so frames reach the file in the order they were buffered.
+            self._file.write(data)
+
+    def flush(self):
+        with self._lock:
+            if self._buffer and not self._file.closed:
+                self._file.write(bytes(self._buffer))
+                self._buffer.clear()
+
+    def _run(self, flush_interval: float):
+        while not self._closed.wait(flush_interval):
+            try:
+                self.flush()
+            except OSError:
+                logger.error(f"Flushing the audit log {self.path} failed.", exc_info=True)
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self.flush()
+        with self._lock:
+            self._file.close()
+
+
+class TransactionAudit:
+    # Records transactions applied to accounts, either logged, sampled or to a binary sink.
+    def __init__(self, sample_rate: float = 1.0, sink: typing.Optional[BinaryAuditSink] = None):
+        self.sample_rate = sample_rate
+        self.sink = sink
+
+    def record(self, account_id: str, transactions: typing.List[Transaction]):
+        if not self.sample_rate:
+            return
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            AUDIT_RECORDS_SAMPLED_OUT.inc(amount=len(transactions))
+            return
+        if self.sink is not None:
+            self.sink.write(account_id, transactions)
+        elif audit_logger.isEnabledFor(logging.INFO):
+            # A batch is one record, so a large batch add does not flood the log queue.
+            if len(transactions) == 1:
+                audit_logger.info("Applied transaction to account '%s': %s", account_id, transactions[0])
+            else:
+                audit_logger.info("Applied %d transactions to account '%s': %s", len(transactions), account_id,
+                                  transactions)
+
+
+def create_transaction_audit(spec: str) -> TransactionAudit:
+    mode, _, argument = spec.partition(":")
+    if mode == "log":
+        return TransactionAudit()
+    if mode == "sample":
+        return TransactionAudit(sample_rate=float(argument))
+    if mode == "binary":
+        return TransactionAudit(sink=BinaryAuditSink(argument))
+    if mode == "off":
+        return TransactionAudit(sample_rate=0.0)
+    raise ValueError(f"Unknown audit log '{spec}', expected log, sample:<rate>, binary:<path> or off.")
+
+
+def read_audit_log(path: str) -> typing.Iterator[typing.Tuple[int, str, typing.List[Transaction]]]:
+    # Yields (epoch microseconds written, account id, transactions) of each record in a binary audit log.
+    from app.persistence import read_frames
+    for written, _, account_id, transactions in read_frames(path):
+        yield written, account_id, transactions
+
+
+# Read when imported, so shard worker processes configure their audit trail the same way.
+AUDIT = create_transaction_audit(os.environ.get("POINTS_AUDIT_LOG", "log"))
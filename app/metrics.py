@@ -0,0 +1,200 @@
+import bisect
+import threading
+import typing
+import weakref
+
+# Recorded values keyed by (metric name, label values). A counter or gauge cell is [value], a histogram cell is the
+# count of each bucket, the +Inf bucket last, followed by the sum of the observed values.
+MetricsCollection = typing.Dict[typing.Tuple[str, typing.Tuple[str, ...]], typing.List[float]]
+
+DURATION_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                    5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096, 16384)
+SIZE_BUCKETS = (10, 100, 1000, 10000, 100000, 1000000, 10000000)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def merge_collections(*collections: MetricsCollection) -> MetricsCollection:
+    merged: MetricsCollection = {}
+    for collection in collections:
+        for key, cell in collection.items():
+            total = merged.get(key)
+            if total is None:
+                merged[key] = list(cell)
+            else:
+                for index, value in enumerate(cell):
+                    total[index] += value
+    return merged
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, registry: "MetricsRegistry", name: str, documentation: str, labels: typing.Sequence[str] = ()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        registry.metrics[name] = self
+
+    def label_text(self, label_values: typing.Tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{label}="{escape_label(str(value))}"' for label, value in zip(self.labels, label_values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self, cells: typing.List[typing.Tuple[typing.Tuple[str, ...], typing.List[float]]]) -> typing.List[str]:
+        return [f"{self.name}{self.label_text(label_values)} {cell[0]:g}" for label_values, cell in cells]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *label_values: str, amount: float = 1):
+        cells = self.registry.shard()
+        key = (self.name, label_values)
+        cell = cells.get(key)
+        if cell is None:
+            cell = cells[key] = [0]
+        cell[0] += amount
+
+
+class Gauge(Metric):
+    # Gauges are filled in when collected, there is nothing to record between scrapes.
+    kind = "gauge"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self,
+                 registry: "MetricsRegistry",
+                 name: str,
+                 documentation: str,
+                 labels: typing.Sequence[str] = (),
+                 buckets: typing.Sequence[float] = DURATION_BUCKETS):
+        super().__init__(registry, name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *label_values: str):
+        cells = self.registry.shard()
+        key = (self.name, label_values)
+        cell = cells.get(key)
+        if cell is None:
+            cell = cells[key] = [0] * (len(self.buckets) + 2)
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def cell(self, values: typing.Iterable[float]) -> typing.List[float]:
+        # A cell holding every value at once, for histograms built when collected.
+        cell = [0] * (len(self.buckets) + 2)
+        for value in values:
+            cell[bisect.bisect_left(self.buckets, value)] += 1
+            cell[-1] += value
+        return cell
+
+    def render(self, cells: typing.List[typing.Tuple[typing.Tuple[str, ...], typing.List[float]]]) -> typing.List[str]:
+        lines = []
+        for label_values, cell in cells:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), cell):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                bucket_labels = self.label_text(label_values, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative:g}")
+            lines.append(f"{self.name}_sum{self.label_text(label_values)} {cell[-1]:g}")
+            lines.append(f"{self.name}_count{self.label_text(label_values)} {cumulative:g}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Counters and histograms recorded into per-thread shards and summed when scraped.
+
+    Recording only touches the calling thread's own cells, so it takes no lock and threads never contend on a shared
+    counter. Shards of threads that have exited are folded into a retired total, which keeps the number of shards at
+    the number of live threads even under a server that starts a thread per connection.
+    """
+
+    def __init__(self):
+        self.metrics: typing.Dict[str, Metric] = {}
+        self._local = threading.local()
+        self._shards: typing.List[typing.Tuple[weakref.ref, MetricsCollection]] = []
+        self._retired: MetricsCollection = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, documentation: str, labels: typing.Sequence[str] = ()) -> Counter:
+        return Counter(self, name, documentation, labels)
+
+    def gauge(self, name: str, documentation: str, labels: typing.Sequence[str] = ()) -> Gauge:
+        return Gauge(self, name, documentation, labels)
+
+    def histogram(self,
+                  name: str,
+                  documentation: str,
+                  labels: typing.Sequence[str] = (),
+                  buckets: typing.Sequence[float] = DURATION_BUCKETS) -> Histogram:
+        return Histogram(self, name, documentation, labels, buckets)
+
+    def shard(self) -> MetricsCollection:
+        try:
+            return self._local.cells
+        except AttributeError:
+            cells = self._local.cells = {}
+            with self._lock:
+                self._retire_exited()
+                self._shards.append((weakref.ref(threading.current_thread()), cells))
+            return cells
+
+    def _retire_exited(self):
+        # Must be called while holding the registry lock.
+        live = []
+        for thread_reference, cells in self._shards:
+            thread = thread_reference()
+            if thread is not None and thread.is_alive():
+                live.append((thread_reference, cells))
+            else:
+                self._retired = merge_collections(self._retired, cells)
+        self._shards = live
+
+    def collect(self) -> MetricsCollection:
+        with self._lock:
+            self._retire_exited()
+            # Copying a live shard's items is a single step for the interpreter, its owner may add cells meanwhile.
+            return merge_collections(self._retired, *(dict(list(cells.items())) for _, cells in self._shards))
+
+    def render(self, collection: MetricsCollection) -> str:
+        # Prometheus text exposition format of a collection, metrics in registration order.
+        by_metric: typing.Dict[str, list] = {}
+        for (name, label_values), cell in collection.items():
+            by_metric.setdefault(name, []).append((label_values, cell))
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            lines.extend(metric.render(sorted(by_metric.get(name, []))))
+        return "\n".join(lines) + "\n"
+
+
+# Metrics of the process, scraped through `PointsService.collect_metrics`.
+METRICS = MetricsRegistry()
+HTTP_REQUEST_SECONDS = METRICS.histogram("points_http_request_duration_seconds",
+                                         "Time to handle a request, its _count is the request count.",
+                                         ["route", "method", "status"])
+ACCOUNT_LOCK_WAIT_SECONDS = METRICS.histogram("points_account_lock_wait_seconds",
+                                              "Time spent waiting to acquire an account lock.", ["operation"])
+SPEND_LOTS_VISITED = METRICS.histogram("points_spend_lots_visited",
+                                       "Lots consumed by a spend.", buckets=COUNT_BUCKETS)
+LEDGER_ENTRIES = METRICS.histogram("points_ledger_entries",
+                                   "Ledger entries per account when scraped.", buckets=SIZE_BUCKETS)
+LEDGER_ENTRIES_COMPACTED = METRICS.counter("points_ledger_entries_compacted_total",
+                                           "Ledger entries folded into compressed account archives.")
+ACCOUNT_EXPANSIONS = METRICS.counter("points_account_expansions_total",
+                                     "Lots added behind the compaction horizon that restored archived lots.")
+ACCOUNTS = METRICS.gauge("points_accounts", "Accounts in the service when scraped.")
+RESIDENT_ACCOUNTS = METRICS.gauge("points_resident_accounts", "Accounts held in memory when scraped.")
@@ -1,13 +1,44 @@
+import array
 import datetime
+import heapq
+import itertools
 import logging
+import sys
+import time
+import types
 import typing
 
+from app.ledger import COLUMN_TYPECODES, ArchiveChunk, Ledger, LedgerColumns, LedgerEntry, split_index
+
 
 logger = logging.getLogger(__name__)
 
 
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def to_epoch_microseconds(timestamp: datetime.datetime) -> int:
+    # Timestamps without a timezone are treated as UTC.
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return (timestamp - EPOCH) // MICROSECOND
+
+
+def from_epoch_microseconds(epoch_microseconds: int) -> datetime.datetime:
+    return EPOCH + datetime.timedelta(microseconds=epoch_microseconds)
+
+
+# Balance versions are drawn from one counter, so a version never repeats across accounts, including a removed and
+# recreated one. Seeding it from the clock keeps a restarted service or another shard process from reissuing them.
+BALANCE_VERSIONS = itertools.count(time.time_ns())
+
+
 # Service Data Objects
 class Transaction:
+    # Transactions are only materialized when returned from the service, ledgers store them as columns.
+    __slots__ = ("payer", "points", "timestamp")
+
     def __init__(self,
                  payer: str,
                  points: int,
@@ -23,15 +54,225 @@ class Transaction:
         return self.__repr__()
 
     def __repr__(self):
-        return f"{{{self.__class__.__name__} ({str(self.__dict__).strip('{}')})}}"
+        return f"{{{self.__class__.__name__} ({str(self.to_dict()).strip('{}')})}}"
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        return {attribute: getattr(self, attribute) for attribute in self.__slots__}
+
+
+class BalanceSnapshot:
+    """
+    Balances of an account as of one version, never changed once published. Writers publish a new snapshot with
+    `Account.publish_balances` while holding the account lock, readers take `Account.balances` with one attribute load
+    and read it without the lock, so the version and balances they see always belong together.
+    """
+    __slots__ = ("version", "balances")
+
+    def __init__(self, version: int, balances: typing.Dict[str, int]):
+        self.version = version
+        self.balances: typing.Mapping[str, int] = types.MappingProxyType(balances)
+
+
+class PayerLots:
+    """
+    FIFO spend state for a single payer.
+
+    Positive add transactions are kept as lots in a ledger ordered by (timestamp, sequence). Every negative point
+    (spends and negative adds) consumes lots from the front, so the consumption cursor is just the running total
+    `consumed`: the lot where the ledger's running points first exceed it is the oldest one with points left. A
+    backdated lot shifts the running totals after it, which moves the cursor without any explicit repair.
+    Consumption beyond the points of all lots is carried until a later add covers it.
+    """
+
+    def __init__(self, payer_id: int):
+        self.payer_id = payer_id
+        self.lots = Ledger()
+        self.consumed = 0
+
+    def head(self) -> typing.Optional[typing.Tuple[int, int, int]]:
+        # Epoch timestamp, sequence and remaining points of the oldest lot with points left.
+        located = self.lots.locate(self.consumed)
+        if located is None:
+            return None
+        (timestamp, sequence, _, _), remaining = located
+        return timestamp, sequence, remaining
+
+    def add(self, points: int, timestamp: int, sequence: int):
+        self.lots.insert(timestamp, sequence, points, self.payer_id)
+
+    def merge(self, entries: typing.List[LedgerEntry]):
+        # Positive ledger entries for this payer, sorted by (timestamp, sequence).
+        self.lots.merge(entries)
+
+    def consume(self, points: int):
+        self.consumed += points
 
 
 class Account:
     def __init__(self, account_id: str):
         self.account_id = account_id
-        self.timestamp_sorted_transactions: typing.List[Transaction] = []
+        # Columnar ledger of every transaction, payers are stored as ids into `payers`. Its payer index answers
+        # point-in-time balances.
+        self.timestamp_sorted_transactions = Ledger(payer_index=True)
+        self.payers: typing.List[str] = []
+        self.payer_ids: typing.Dict[str, int] = {}
         self.available_points_by_payer: typing.Dict[str, int] = {}
         self.spent_points_by_payer: typing.Dict[str, int] = {}
+        self.lots_by_payer: typing.Dict[str, PayerLots] = {}
+        self.transaction_sequence = 0
+        # Sequence of the last write ahead log record applied to the account, zero when not journaled.
+        self.journal_sequence = 0
+        # Bumped from `BALANCE_VERSIONS` after every change to the balances.
+        self.version = 0
+        # Balances as of `version`, replaced as a whole after every change. `available_points_by_payer` is the
+        # writers' working copy.
+        self.balances = BalanceSnapshot(0, {})
+        # The ledger entries folded away by `compact` as a single chunk every compaction merges into, empty until the
+        # first one.
+        self.archive: typing.List[ArchiveChunk] = []
+        self.archived_entries = 0
+        # Epoch timestamp of the newest lot folded away. A lot added before it may make archived lots of its payer
+        # spendable again, so those are restored first.
+        self.compaction_horizon: typing.Optional[int] = None
+        # Live ledger entries left by the last compaction.
+        self.compacted_length = 0
+
+    def payer_id(self, payer: str) -> int:
+        if payer not in self.payer_ids:
+            self.payer_ids[payer] = len(self.payers)
+            self.payers.append(sys.intern(payer))
+        return self.payer_ids[payer]
+
+    def publish_balances(self, version: typing.Optional[int] = None):
+        # Must be called while holding the account lock, once a change is complete. The balances are copied, so later
+        # changes to the working copy are not seen by readers until they are published in turn.
+        self.version = next(BALANCE_VERSIONS) if version is None else version
+        self.balances = BalanceSnapshot(self.version, self.available_points_by_payer.copy())
+
+    def transactions(self) -> typing.Iterator[Transaction]:
+        for timestamp, _, points, payer_id in zip(*self.ledger_columns()):
+            yield Transaction(self.payers[payer_id], points, from_epoch_microseconds(timestamp))
+
+    def ledger_columns(self) -> LedgerColumns:
+        # Columns of the account's whole history, archived entries merged with the live ledger in ledger order.
+        live = self.timestamp_sorted_transactions.to_columns()
+        if not self.archive:
+            return live
+        parts = [chunk.columns() for chunk in self.archive] + [live]
+        merged = zip(*heapq.merge(*(zip(*part) for part in parts)))
+        return tuple(array.array(typecode, values) for typecode, values in zip(COLUMN_TYPECODES, merged))
+
+    def balances_as_of(self, timestamp: int) -> typing.Dict[str, int]:
+        # Points of every payer counting only the transactions at or before the epoch timestamp, archived ones
+        # included. Payers whose transactions all come later are 0. Compactions merge into a single archive chunk, so
+        # the archived part costs one binary search and decompressing at most one block however often it compacted.
+        totals = [0] * len(self.payers)
+        for ledger in [self.timestamp_sorted_transactions, *self.archive]:
+            for payer_id, points in ledger.payer_points_through(timestamp).items():
+                totals[payer_id] += points
+        return dict(zip(self.payers, totals))
+
+    def history(self,
+                key: typing.Tuple[int, int],
+                payer_id: typing.Optional[int] = None) -> typing.Iterator[LedgerEntry]:
+        # Entries of the whole history from the (timestamp, sequence) key on in ledger order, only those of the payer
+        # when given. The archive is skipped when the key comes after its last block, and otherwise its entries are
+        # merged in lazily from the block the key falls in, so reading a page only decompresses the blocks it spans.
+        live = self.timestamp_sorted_transactions.entries_from(key, payer_id)
+        archive = [chunk for chunk in self.archive if chunk.maxes and chunk.maxes[-1] >= key[0]]
+        if not archive:
+            return live
+        return heapq.merge(*(chunk.entries_from(key, payer_id) for chunk in archive), live)
+
+    def restore_ledger(self,
+                       timestamps: array.array,
+                       sequences: array.array,
+                       points: array.array,
+                       payer_ids: array.array):
+        # Rebuilds balances and payer lots from the columns of the whole history without replaying each transaction.
+        self.timestamp_sorted_transactions = Ledger.from_columns(timestamps, sequences, points, payer_ids,
+                                                                 payer_index=True)
+        available = [0] * len(self.payers)
+        spent = [0] * len(self.payers)
+        lot_columns = [tuple(array.array(typecode) for typecode in COLUMN_TYPECODES) for _ in self.payers]
+        for timestamp, sequence, transaction_points, payer_id in zip(timestamps, sequences, points, payer_ids):
+            available[payer_id] += transaction_points
+            if transaction_points < 0:
+                spent[payer_id] -= transaction_points
+            elif transaction_points > 0:
+                lot_timestamps, lot_sequences, lot_points, lot_payers = lot_columns[payer_id]
+                lot_timestamps.append(timestamp)
+                lot_sequences.append(sequence)
+                lot_points.append(transaction_points)
+                lot_payers.append(payer_id)
+        for payer_id, payer in enumerate(self.payers):
+            self.available_points_by_payer[payer] = available[payer_id]
+            self.spent_points_by_payer[payer] = spent[payer_id]
+            payer_lots = PayerLots(payer_id)
+            payer_lots.lots = Ledger.from_columns(*lot_columns[payer_id])
+            payer_lots.consumed = spent[payer_id]
+            self.lots_by_payer[payer] = payer_lots
+
+    def compact(self) -> int:
+        """
+        Folds spends, negative adds and the lots older than the oldest lot any payer has points left in into the
+        compressed archive chunk, returning the number of ledger entries folded. The live ledger is left with the lots
+        that may still be spent from.
+
+        Balances are per payer totals and a payer's consumption cursor only depends on the points of the lots before
+        it, so negative entries are history once applied. Dropping lots that are fully consumed and taking their
+        points off `consumed` therefore leaves every later spend identical. A lot added behind the compaction horizon
+        moves the cursor back over the newer dropped lots of its payer, `restore_lots` brings those back first.
+        """
+        heads = [head[:2] for head in (payer_lots.head() for payer_lots in self.lots_by_payer.values())
+                 if head is not None]
+        horizon = min(heads) if heads else None
+        columns = self.timestamp_sorted_transactions.to_columns()
+        boundary = split_index(columns, horizon)
+        kept = [False] * boundary + [points > 0 for points in columns[2][boundary:]]
+        folded = len(kept) - sum(kept)
+        if folded:
+            self.archive = [ArchiveChunk.merge(self.archive, tuple(
+                array.array(column.typecode, itertools.compress(column, [not keep for keep in kept]))
+                for column in columns))]
+            self.archived_entries += folded
+            self.timestamp_sorted_transactions = Ledger.from_columns(*(
+                array.array(column.typecode, itertools.compress(column, kept)) for column in columns),
+                payer_index=True)
+            for payer_lots in self.lots_by_payer.values():
+                lot_columns = payer_lots.lots.to_columns()
+                dropped = split_index(lot_columns, horizon)
+                if not dropped:
+                    continue
+                payer_lots.lots = Ledger.from_columns(*(column[dropped:] for column in lot_columns))
+                payer_lots.consumed -= sum(lot_columns[2][:dropped])
+                newest = lot_columns[0][dropped - 1]
+                if self.compaction_horizon is None or newest > self.compaction_horizon:
+                    self.compaction_horizon = newest
+        self.compacted_length = len(self.timestamp_sorted_transactions)
+        return folded
+
+    def restore_lots(self, payer_id: int, timestamp: int, points: int) -> int:
+        """
+        Moves the payer's newest archived lots dated after the epoch timestamp back into the ledger and the payer's
+        lots, until they hold `points` or there are none left, returning the number of entries restored.
+
+        A lot of `points` added at the timestamp moves the payer's consumption cursor back by its points, so at most
+        that many points of the newest lots dropped after it can become spendable again. Older archived lots stay
+        fully consumed and stay folded away, and only the archive blocks holding the restored lots are rewritten.
+        """
+        if not self.archive:
+            return 0
+        chunk, entries = self.archive[0].take_lots(payer_id, timestamp, points)
+        if not entries:
+            return 0
+        self.archive = [chunk] if len(chunk) else []
+        self.archived_entries -= len(entries)
+        self.timestamp_sorted_transactions.merge(entries)
+        payer_lots = self.lots_by_payer[self.payers[payer_id]]
+        payer_lots.merge(entries)
+        payer_lots.consume(sum(entry[2] for entry in entries))
+        return len(entries)
 
 
 # Service Logic Exceptions
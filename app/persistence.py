@@ -0,0 +1,469 @@
+import array
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import typing
+import zlib
+
+from app.ledger import COLUMN_TYPECODES, ArchiveChunk
+from app.model import Account, Transaction, from_epoch_microseconds, to_epoch_microseconds
+from app.service import PointsService
+
+logger = logging.getLogger(__name__)
+
+# Write ahead log frames are a payload length and crc32 followed by the payload. A payload is a record header
+# (log sequence, record type, transaction count), the account id and then each transaction's payer, points and epoch
+# timestamp. Strings are utf-8 prefixed with their length.
+FRAME_HEADER = struct.Struct("<II")
+RECORD_HEADER = struct.Struct("<QcI")
+TRANSACTION = struct.Struct("<qq")
+STRING_LENGTH = struct.Struct("<H")
+TRANSACTIONS_RECORD = b"T"
+REMOVAL_RECORD = b"R"
+
+# Snapshots are a magic number and header (last log sequence, account count), each account and a trailing crc32.
+# An account is its id, a header (last log sequence, transaction sequence, payer count, entry count), its payers,
+# each payer's (available, spent, consumed) points, the raw bytes of its live ledger columns, an archive header
+# (whether there is a compaction horizon, the horizon, archived entries, chunk count) and the archive chunks.
+# A chunk is a header (entries, block count, payer count), its block maximums, each payer's id, running totals and
+# running lot totals and the length prefixed compressed blocks.
+SNAPSHOT_MAGIC = b"PTSSNAP3"
+SNAPSHOT_HEADER = struct.Struct("<QI")
+SNAPSHOT_ACCOUNT = struct.Struct("<QqII")
+SNAPSHOT_PAYER = struct.Struct("<qqq")
+SNAPSHOT_ARCHIVE = struct.Struct("<?qQI")
+SNAPSHOT_CHUNK = struct.Struct("<QII")
+SNAPSHOT_CHUNK_PAYER = struct.Struct("<i")
+SNAPSHOT_BLOCK_LENGTH = struct.Struct("<I")
+SNAPSHOT_CRC = struct.Struct("<I")
+
+SEGMENT_FILE = re.compile(r"^wal-(\d{8})\.log$")
+SNAPSHOT_FILE = re.compile(r"^snapshot-(\d{8})\.bin$")
+
+
+def segment_path(directory: str, segment: int) -> str:
+    return os.path.join(directory, f"wal-{segment:08d}.log")
+
+
+def snapshot_path(directory: str, segment: int) -> str:
+    # A snapshot is named after the first write ahead log segment that has to be replayed on top of it.
+    return os.path.join(directory, f"snapshot-{segment:08d}.bin")
+
+
+def fsync_directory(directory: str):
+    # Makes created, renamed and removed files in the directory durable.
+    descriptor = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def numbered_files(directory: str, pattern: typing.Pattern) -> typing.List[typing.Tuple[int, str]]:
+    numbered = []
+    for name in os.listdir(directory):
+        match = pattern.match(name)
+        if match:
+            numbered.append((int(match.group(1)), os.path.join(directory, name)))
+    return sorted(numbered)
+
+
+# Record Encoding
+def encode_string(value: str) -> bytes:
+    encoded = value.encode("utf-8")
+    return STRING_LENGTH.pack(len(encoded)) + encoded
+
+
+def decode_string(buffer, offset: int) -> typing.Tuple[str, int]:
+    (length,) = STRING_LENGTH.unpack_from(buffer, offset)
+    offset += STRING_LENGTH.size
+    return bytes(buffer[offset:offset + length]).decode("utf-8"), offset + length
+
+
+def encode_transactions(transactions: typing.List[Transaction]) -> bytes:
+    return b"".join(encode_string(transaction.payer) +
+                    TRANSACTION.pack(transaction.points, to_epoch_microseconds(transaction.timestamp))
+                    for transaction in transactions)
+
+
+def encode_frame(journal_sequence: int, record_type: bytes, count: int, body: bytes) -> bytes:
+    header = RECORD_HEADER.pack(journal_sequence, record_type, count)
+    crc = zlib.crc32(body, zlib.crc32(header))
+    return FRAME_HEADER.pack(len(header) + len(body), crc) + header + body
+
+
+def read_frames(path: str) -> typing.Iterator[typing.Tuple[int, bytes, str, typing.List[Transaction]]]:
+    # Yields (log sequence, record type, account id, transactions) and stops at the first torn or corrupt frame.
+    with open(path, "rb") as segment_file:
+        data = segment_file.read()
+    offset = 0
+    while offset + FRAME_HEADER.size <= len(data):
+        length, crc = FRAME_HEADER.unpack_from(data, offset)
+        start = offset + FRAME_HEADER.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            logger.warning(f"Ignoring torn write ahead log tail in {path} at offset {offset}.")
+            return
+        journal_sequence, record_type, count = RECORD_HEADER.unpack_from(payload)
+        account_id, position = decode_string(payload, RECORD_HEADER.size)
+        transactions = []
+        for _ in range(count):
+            payer, position = decode_string(payload, position)
+            points, timestamp = TRANSACTION.unpack_from(payload, position)
+            position += TRANSACTION.size
+            transactions.append(Transaction(payer, points, from_epoch_microseconds(timestamp)))
+        yield journal_sequence, record_type, account_id, transactions
+        offset = start + length
+
+
+# Account Encoding
+def encode_account(account: Account) -> bytes:
+    columns = account.timestamp_sorted_transactions.to_columns()
+    header = SNAPSHOT_ACCOUNT.pack(account.journal_sequence, account.transaction_sequence, len(account.payers),
+                                   len(columns[0]))
+    payers = b"".join(encode_string(payer) for payer in account.payers)
+    totals = b"".join(SNAPSHOT_PAYER.pack(account.available_points_by_payer[payer],
+                                          account.spent_points_by_payer[payer],
+                                          account.lots_by_payer[payer].consumed)
+                      for payer in account.payers)
+    horizon = account.compaction_horizon
+    archive = [SNAPSHOT_ARCHIVE.pack(horizon is not None, horizon or 0, account.archived_entries,
+                                     len(account.archive))]
+    archive += [encode_archive_chunk(chunk) for chunk in account.archive]
+    return b"".join([encode_string(account.account_id), header, payers, totals] +
+                    [column.tobytes() for column in columns] + archive)
+
+
+def encode_archive_chunk(chunk: ArchiveChunk) -> bytes:
+    parts = [SNAPSHOT_CHUNK.pack(chunk.entries, len(chunk.blocks), len(chunk.payer_totals)), chunk.maxes.tobytes()]
+    for payer_id, totals in chunk.payer_totals.items():
+        parts += [SNAPSHOT_CHUNK_PAYER.pack(payer_id), totals.tobytes(), chunk.lot_totals[payer_id].tobytes()]
+    for block in chunk.blocks:
+        parts += [SNAPSHOT_BLOCK_LENGTH.pack(len(block)), block]
+    return b"".join(parts)
+
+
+def decode_length_prefixed(buffer, offset: int) -> typing.Tuple[bytes, int]:
+    (length,) = SNAPSHOT_BLOCK_LENGTH.unpack_from(buffer, offset)
+    offset += SNAPSHOT_BLOCK_LENGTH.size
+    return bytes(buffer[offset:offset + length]), offset + length
+
+
+def decode_archive_chunk(buffer, offset: int) -> typing.Tuple[ArchiveChunk, int]:
+    entries, block_count, payer_count = SNAPSHOT_CHUNK.unpack_from(buffer, offset)
+    offset += SNAPSHOT_CHUNK.size
+    maxes = array.array("q")
+    maxes.frombytes(buffer[offset:offset + block_count * maxes.itemsize])
+    offset += block_count * maxes.itemsize
+    payer_totals = {}
+    lot_totals = {}
+    for _ in range(payer_count):
+        (payer_id,) = SNAPSHOT_CHUNK_PAYER.unpack_from(buffer, offset)
+        offset += SNAPSHOT_CHUNK_PAYER.size
+        for chunk_totals in (payer_totals, lot_totals):
+            totals = array.array("q")
+            totals.frombytes(buffer[offset:offset + block_count * totals.itemsize])
+            offset += block_count * totals.itemsize
+            chunk_totals[payer_id] = totals
+    blocks = []
+    for _ in range(block_count):
+        block, offset = decode_length_prefixed(buffer, offset)
+        blocks.append(block)
+    return ArchiveChunk(blocks, maxes, payer_totals, lot_totals, entries), offset
+
+
+def decode_account(buffer, offset: int = 0) -> typing.Tuple[Account, int]:
+    account_id, offset = decode_string(buffer, offset)
+    journal_sequence, transaction_sequence, payer_count, entries = SNAPSHOT_ACCOUNT.unpack_from(buffer, offset)
+    offset += SNAPSHOT_ACCOUNT.size
+    account = Account(account_id)
+    account.journal_sequence = journal_sequence
+    account.transaction_sequence = transaction_sequence
+    for _ in range(payer_count):
+        payer, offset = decode_string(buffer, offset)
+        account.payer_id(payer)
+    totals = []
+    for _ in range(payer_count):
+        totals.append(SNAPSHOT_PAYER.unpack_from(buffer, offset))
+        offset += SNAPSHOT_PAYER.size
+    columns = []
+    for typecode in COLUMN_TYPECODES:
+        column = array.array(typecode)
+        end = offset + entries * column.itemsize
+        column.frombytes(buffer[offset:end])
+        columns.append(column)
+        offset = end
+    # The live ledger holds exactly the lots not folded away, the balances also cover the archived entries.
+    account.restore_ledger(*columns)
+    for payer, (available, spent, consumed) in zip(account.payers, totals):
+        account.available_points_by_payer[payer] = available
+        account.spent_points_by_payer[payer] = spent
+        account.lots_by_payer[payer].consumed = consumed
+    has_horizon, horizon, account.archived_entries, chunk_count = SNAPSHOT_ARCHIVE.unpack_from(buffer, offset)
+    offset += SNAPSHOT_ARCHIVE.size
+    account.compaction_horizon = horizon if has_horizon else None
+    for _ in range(chunk_count):
+        chunk, offset = decode_archive_chunk(buffer, offset)
+        account.archive.append(chunk)
+    account.compacted_length = entries
+    return account, offset
+
+
+# Write Ahead Log
+class WriteAheadLog:
+    """
+    Append only journal of applied transactions and account removals with group commit.
+
+    Appends only buffer an encoded frame and hand back its log sequence. A single writer thread waits up to
+    `commit_latency` seconds for concurrent appends to join, then writes and fsyncs the whole batch, so callers
+    blocked in `wait` share one fsync instead of paying for one each.
+    """
+
+    def __init__(self,
+                 directory: str,
+                 segment: int,
+                 journal_sequence: int = 0,
+                 commit_latency: float = 0.002,
+                 fsync: bool = True):
+        self.directory = directory
+        self.segment = segment
+        self.commit_latency = commit_latency
+        self.fsync = fsync
+        self._file = self._open_segment()
+        self._lock = threading.Lock()
+        self._pending = threading.Condition(self._lock)
+        self._committed = threading.Condition(self._lock)
+        self._file_lock = threading.Lock()
+        self._buffer: typing.List[bytes] = []
+        self._journal_sequence = journal_sequence
+        self._durable_sequence = journal_sequence
+        self._closed = False
+        self._writer = threading.Thread(target=self._run, name="WriteAheadLogWriter", daemon=True)
+        self._writer.start()
+
+    def _open_segment(self):
+        segment_file = open(segment_path(self.directory, self.segment), "ab")
+        if self.fsync:
+            fsync_directory(self.directory)
+        return segment_file
+
+    @property
+    def journal_sequence(self) -> int:
+        return self._journal_sequence
+
+    def append_transactions(self, account_id: str, transactions: typing.List[Transaction]) -> int:
+        return self._append(TRANSACTIONS_RECORD, len(transactions),
+                            encode_string(account_id) + encode_transactions(transactions))
+
+    def append_removal(self, account_id: str) -> int:
+        return self._append(REMOVAL_RECORD, 0, encode_string(account_id))
+
+    def _append(self, record_type: bytes, count: int, body: bytes) -> int:
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Write ahead log is closed.")
+            self._journal_sequence += 1
+            self._buffer.append(encode_frame(self._journal_sequence, record_type, count, body))
+            self._pending.notify()
+            return self._journal_sequence
+
+    def wait(self, journal_sequence: int):
+        # Blocks until the record with the given log sequence is durable.
+        with self._lock:
+            while self._durable_sequence < journal_sequence:
+                self._committed.wait()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._buffer and not self._closed:
+                    self._pending.wait()
+                if self._closed:
+                    return
+            # Give concurrent requests the latency bound to join this commit.
+            if self.commit_latency:
+                time.sleep(self.commit_latency)
+            self._commit()
+
+    def _commit(self, rotate: bool = False):
+        with self._file_lock:
+            with self._lock:
+                frames, self._buffer = self._buffer, []
+                journal_sequence = self._journal_sequence
+            if frames:
+                self._file.write(b"".join(frames))
+                self._file.flush()
+                if self.fsync:
+                    os.fsync(self._file.fileno())
+            if rotate:
+                self._file.close()
+                self.segment += 1
+                self._file = self._open_segment()
+            segment = self.segment
+        with self._lock:
+            self._durable_sequence = max(self._durable_sequence, journal_sequence)
+            self._committed.notify_all()
+        return segment
+
+    def rotate(self) -> int:
+        # Commits everything appended so far and switches appends to a new segment, returning its number.
+        return self._commit(rotate=True)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._pending.notify()
+        self._writer.join()
+        self._commit()
+        self._file.close()
+
+
+# Durable Points Service
+class Persistence:
+    """
+    Recovers a `PointsService` from the latest snapshot and write ahead log in `directory` and keeps journaling it.
+
+    Snapshots are written every `snapshot_interval` seconds when set, or on demand with `snapshot`. Each snapshot
+    rotates the journal first, so only segments from that rotation onwards need replaying. Records in those segments
+    that an account snapshot already includes are skipped by their log sequence.
+    """
+
+    def __init__(self,
+                 directory: str,
+                 commit_latency: float = 0.002,
+                 snapshot_interval: typing.Optional[float] = None,
+                 fsync: bool = True,
+                 compaction_threshold: typing.Optional[int] = None,
+                 account_store=None):
+        self.directory = directory
+        self.commit_latency = commit_latency
+        self.snapshot_interval = snapshot_interval
+        self.fsync = fsync
+        self.compaction_threshold = compaction_threshold
+        # Optional `app.storage.AccountStore` for the recovered service.
+        self.account_store = account_store
+        self.service: typing.Optional[PointsService] = None
+        self.journal: typing.Optional[WriteAheadLog] = None
+        self._stopped = threading.Event()
+        self._snapshotter: typing.Optional[threading.Thread] = None
+
+    def recover(self) -> PointsService:
+        os.makedirs(self.directory, exist_ok=True)
+        started = time.perf_counter()
+        service = PointsService(compaction_threshold=self.compaction_threshold, account_store=self.account_store)
+        snapshot_segment, journal_sequence = 0, 0
+        snapshots = numbered_files(self.directory, SNAPSHOT_FILE)
+        if snapshots:
+            snapshot_segment, path = snapshots[-1]
+            journal_sequence = self._load_snapshot(service, path)
+        segments = [(segment, path) for segment, path in numbered_files(self.directory, SEGMENT_FILE)
+                    if segment >= snapshot_segment]
+        replayed = 0
+        for _, path in segments:
+            for record_sequence, record_type, account_id, transactions in read_frames(path):
+                journal_sequence = max(journal_sequence, record_sequence)
+                replayed += self._replay(service, record_sequence, record_type, account_id, transactions)
+        next_segment = max([snapshot_segment] + [segment + 1 for segment, _ in segments])
+        logger.info(f"Recovered {len(service.accounts)} accounts from {self.directory} in "
+                    f"{time.perf_counter() - started:.3f}s, replayed {replayed} write ahead log records.")
+
+        self.journal = WriteAheadLog(self.directory, next_segment, journal_sequence, self.commit_latency, self.fsync)
+        service.journal = self.journal
+        self.service = service
+        if self.snapshot_interval:
+            self._snapshotter = threading.Thread(target=self._run_snapshots, name="Snapshotter", daemon=True)
+            self._snapshotter.start()
+        return service
+
+    @staticmethod
+    def _load_snapshot(service: PointsService, path: str) -> int:
+        with open(path, "rb") as snapshot_file, mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            buffer = memoryview(data)
+            try:
+                (crc,) = SNAPSHOT_CRC.unpack_from(buffer, len(buffer) - SNAPSHOT_CRC.size)
+                if bytes(buffer[:len(SNAPSHOT_MAGIC)]) != SNAPSHOT_MAGIC or zlib.crc32(buffer[:len(buffer) - SNAPSHOT_CRC.size]) != crc:
+                    raise ValueError(f"Snapshot {path} is corrupt.")
+                journal_sequence, account_count = SNAPSHOT_HEADER.unpack_from(buffer, len(SNAPSHOT_MAGIC))
+                offset = len(SNAPSHOT_MAGIC) + SNAPSHOT_HEADER.size
+                for _ in range(account_count):
+                    account, offset = decode_account(buffer, offset)
+                    service._insert_account(account)
+                    # Accounts are copied after the journal rotation, so they may include later records.
+                    journal_sequence = max(journal_sequence, account.journal_sequence)
+            finally:
+                buffer.release()
+        return journal_sequence
+
+    @staticmethod
+    def _replay(service: PointsService,
+                journal_sequence: int,
+                record_type: bytes,
+                account_id: str,
+                transactions: typing.List[Transaction]) -> int:
+        account = service.accounts.get(account_id)
+        if account is not None and account.journal_sequence >= journal_sequence:
+            return 0
+        if record_type == REMOVAL_RECORD:
+            service._pop_account(account_id)
+            return 1
+        account = service._get_or_create_account(account_id)
+        for transaction in transactions:
+            # Spends are journaled as negative transactions, which consume lots the same way the spend did. They were
+            # audited when first applied.
+            service._add_transaction(account, transaction, audit=False)
+        account.journal_sequence = journal_sequence
+        return 1
+
+    def snapshot(self) -> str:
+        segment = self.journal.rotate()
+        journal_sequence = self.journal.journal_sequence
+        path = snapshot_path(self.directory, segment)
+        temporary_path = f"{path}.tmp"
+        account_ids = self.service.get_account_ids()
+        account_count = 0
+        with open(temporary_path, "wb") as snapshot_file:
+            snapshot_file.write(SNAPSHOT_MAGIC + SNAPSHOT_HEADER.pack(journal_sequence, 0))
+            for account_id in account_ids:
+                # Each account is copied under its lock, so it is consistent with its own journal sequence.
+                with self.service.account_locks[account_id]:
+                    account = self.service.accounts.peek(account_id)
+                    encoded = encode_account(account) if account is not None else None
+                if encoded is not None:
+                    snapshot_file.write(encoded)
+                    account_count += 1
+            snapshot_file.seek(len(SNAPSHOT_MAGIC))
+            snapshot_file.write(SNAPSHOT_HEADER.pack(journal_sequence, account_count))
+        crc = 0
+        with open(temporary_path, "rb") as snapshot_file:
+            for chunk in iter(lambda: snapshot_file.read(1 << 20), b""):
+                crc = zlib.crc32(chunk, crc)
+        with open(temporary_path, "ab") as snapshot_file:
+            snapshot_file.write(SNAPSHOT_CRC.pack(crc))
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temporary_path, path)
+        fsync_directory(self.directory)
+        for old_segment, old_path in numbered_files(self.directory, SEGMENT_FILE) + \
+                numbered_files(self.directory, SNAPSHOT_FILE):
+            if old_segment < segment:
+                os.remove(old_path)
+        logger.info(f"Wrote snapshot of {account_count} accounts to {path}.")
+        return path
+
+    def _run_snapshots(self):
+        while not self._stopped.wait(self.snapshot_interval):
+            try:
+                self.snapshot()
+            except Exception:
+                logger.error("Scheduled snapshot failed.", exc_info=True)
+
+    def close(self):
+        self._stopped.set()
+        if self._snapshotter is not None:
+            self._snapshotter.join()
+        if self.journal is not None:
+            self.journal.close()
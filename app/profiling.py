@@ -0,0 +1,169 @@
+"""
+Profiling a running server.
+
+`PROFILER` samples the stacks of every thread in the process at a fixed interval while it is running and counts
+identical stacks. It is started and stopped through POST /admin/profiler and its samples are read from
+GET /admin/profiler as collapsed stacks, one "thread;outermost;...;innermost count" line per distinct stack, which
+flamegraph.pl and speedscope read as they are. Nothing runs while it is stopped. While it runs, the sampler thread
+walks each thread's frames once per interval and the request threads themselves do no extra work.
+
+A request sent with an `X-Profile` header is run under cProfile, and its response body is replaced by the profile as
+pstats text, sorted by the header's value when that is a pstats sort key and by cumulative time otherwise. Only one
+request is profiled at a time, as cProfile slows the request it profiles several times over.
+"""
+import collections
+import cProfile
+import io
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import typing
+
+PROFILE_HEADER = "X-Profile"
+DEFAULT_SAMPLE_INTERVAL = 0.01
+# Functions listed in a per request profile.
+PROFILE_LINES = 60
+# Thread names without their counters, so threads of one pool or server add up to a single root.
+THREAD_NUMBER = re.compile(r"[-_]\d+")
+
+
+def frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler of the whole process. A sample is the current stack of every thread other than the
+    sampler's, kept as a count per (thread name, code objects) stack, so frames are only turned into text when the
+    samples are read. Starting clears the samples of the previous run.
+    """
+
+    def __init__(self):
+        self.interval = DEFAULT_SAMPLE_INTERVAL
+        self.samples = 0
+        self.started: typing.Optional[float] = None
+        self.stopped: typing.Optional[float] = None
+        self._counts: typing.Counter[tuple] = collections.Counter()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread: typing.Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, interval: typing.Optional[float] = None):
+        with self._lock:
+            self._stop()
+            self.interval = interval or DEFAULT_SAMPLE_INTERVAL
+            self.samples = 0
+            self._counts = collections.Counter()
+            self.started, self.stopped = time.monotonic(), None
+            self._stopping = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(self._stopping,), name="SamplingProfiler",
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            self._stop()
+
+    def _stop(self):
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+        self.stopped = time.monotonic()
+
+    def _run(self, stopping: threading.Event):
+        sampler = threading.get_ident()
+        while not stopping.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == sampler:
+                    continue
+                codes = []
+                while frame is not None:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                codes.reverse()
+                stacks.append((THREAD_NUMBER.sub("", names.get(ident, "unknown")), *codes))
+            self._counts.update(stacks)
+            self.samples += 1
+
+    def status(self) -> dict:
+        end = self.stopped if self.stopped is not None else time.monotonic()
+        return {
+            "running": self.running,
+            "interval": self.interval,
+            "samples": self.samples,
+            "seconds": end - self.started if self.started is not None else 0.0,
+        }
+
+    def collapsed(self) -> str:
+        # Most sampled stacks first. Counted while the sampler may still be adding to them, so copied first.
+        counts = self._counts.copy()
+        labels: typing.Dict[typing.Any, str] = {}
+        lines = []
+        for (thread_name, *codes), count in counts.most_common():
+            frames = [labels.get(code) or labels.setdefault(code, frame_label(code)) for code in codes]
+            lines.append(f"{';'.join([thread_name, *frames])} {count}\n")
+        return "".join(lines)
+
+
+class RequestProfile:
+    """
+    cProfile of one request. `begin` returns None while another request is being profiled. The profile is enabled
+    around the handler in whichever thread runs it, by `enable` and `disable` or by `run`, and `report` ends it.
+    """
+
+    _active = threading.Lock()
+
+    def __init__(self, sort: str):
+        self.sort = sort
+        self.profile = cProfile.Profile()
+        self.started = time.perf_counter()
+        self._finished = False
+
+    @classmethod
+    def begin(cls, header_value: str) -> typing.Optional["RequestProfile"]:
+        if not cls._active.acquire(blocking=False):
+            return None
+        sort = header_value.strip().lower()
+        return cls(sort if sort in pstats.Stats.sort_arg_dict_default else "cumulative")
+
+    def enable(self):
+        self.profile.enable()
+
+    def disable(self):
+        self.profile.disable()
+
+    def run(self, function, *args):
+        self.profile.enable()
+        try:
+            return function(*args)
+        finally:
+            self.profile.disable()
+
+    def report(self, status_code: int) -> bytes:
+        self.finish()
+        output = io.StringIO()
+        output.write(f"Request answered {status_code} in {(time.perf_counter() - self.started) * 1000:.3f}ms\n")
+        self.profile.create_stats()
+        if self.profile.stats:
+            pstats.Stats(self.profile, stream=output).sort_stats(self.sort).print_stats(PROFILE_LINES)
+        return output.getvalue().encode("utf-8")
+
+    def finish(self):
+        # Ends the profile, also called when the request failed before its report was written.
+        if not self._finished:
+            self._finished = True
+            self._active.release()
+
+
+PROFILER = SamplingProfiler()
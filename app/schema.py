@@ -1,6 +1,19 @@
 import datetime
+import functools
+import typing
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, confloat, conint, constr
+from pydantic.datetime_parse import parse_datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Clients resend the same timestamps (whole seconds, batch loads, retries), so parsed ones are reused. Keyed by the
+# exact string and datetimes are immutable, so a cached result is the one pydantic would produce.
+TIMESTAMP_CACHE_SIZE = 65536
+parse_timestamp = functools.lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)(parse_datetime)
 
 
 # Base Validation Model
@@ -8,20 +21,40 @@ class BaseValidationModel(BaseModel):
 
     @classmethod
     def from_json(cls, json_string):
+        # orjson turns integers beyond 64 bits into floats, which no fast path accepts, so pydantic decodes those.
+        if orjson is not None:
+            try:
+                dictionary = orjson.loads(json_string)
+            except orjson.JSONDecodeError:
+                dictionary = None
+            if type(dictionary) is dict:
+                model = cls.from_dict_fast(dictionary)
+                if model is not None:
+                    return model
         return cls.parse_raw(json_string, content_type="application/json")
 
     @classmethod
     def from_dict(cls, dictionary):
+        if type(dictionary) is dict:
+            model = cls.from_dict_fast(dictionary)
+            if model is not None:
+                return model
         return cls.parse_obj(dictionary)
 
+    @classmethod
+    def from_dict_fast(cls, dictionary: dict):
+        # Models override this to build themselves from plainly well formed input without running pydantic. Anything
+        # else returns None and is validated by pydantic, so its errors and coercions are unchanged.
+        return None
+
     @classmethod
     def from_dict_or_json(cls, json_string_or_dictionary):
         if isinstance(json_string_or_dictionary, str):
             return cls.from_json(json_string_or_dictionary)
-        if isinstance(json_string_or_dictionary, dict):
+        if isinstance(json_string_or_dictionary, (dict, list)):
             return cls.from_dict(json_string_or_dictionary)
         raise Exception(f"Input to {cls.__name__}.from_dict_or_json was {type(json_string_or_dictionary)} "
-                        f"and not of type str or dict.")
+                        f"and not of type str, dict or list.")
 
     def __str__(self):
         return self.__repr__()
@@ -34,11 +67,78 @@ class BaseValidationModel(BaseModel):
         validate_all = True
 
 
+class GetPointsQuery(BaseValidationModel):
+    # Query string of GET /points, a `limit` or `after` cursor selects a page of accounts in account id order.
+    limit: typing.Optional[conint(gt=0, le=10000)] = None
+    after: typing.Optional[str] = None
+    format: typing.Literal["json", "ndjson"] = "json"
+
+
+class GetAccountPointsQuery(BaseValidationModel):
+    # Query string of GET /points/<account_id>, `as_of` asks for the balances at that time instead of now.
+    as_of: typing.Optional[datetime.datetime] = None
+
+
+class GetAccountTransactionsQuery(BaseValidationModel):
+    # Query string of GET /points/<account_id>/transactions. Transactions from `from` up to but excluding `to`, only
+    # those of `payer` when given. `cursor` is the `next` of the previous page.
+    from_: typing.Optional[datetime.datetime] = Field(None, alias="from")
+    to: typing.Optional[datetime.datetime] = None
+    payer: typing.Optional[str] = None
+    limit: typing.Optional[conint(gt=0, le=10000)] = None
+    cursor: typing.Optional[constr(regex=r"^-?[0-9]+\.[0-9]+$")] = None
+    format: typing.Literal["json", "ndjson"] = "json"
+
+
 class AddPointsRequest(BaseValidationModel):
     payer: str
     points: int
     timestamp: datetime.datetime
 
+    @classmethod
+    def from_dict_fast(cls, dictionary: dict):
+        payer, points, timestamp = dictionary.get("payer"), dictionary.get("points"), dictionary.get("timestamp")
+        if type(payer) is not str or type(points) is not int or type(timestamp) is not str:
+            return None
+        try:
+            timestamp = parse_timestamp(timestamp)
+        except (TypeError, ValueError):
+            return None
+        return cls.construct(payer=payer, points=points, timestamp=timestamp)
+
+
+class AddPointsBatchRequest(BaseValidationModel):
+    # Items are validated one at a time as `AddPointsRequest` so a bad item only fails itself.
+    __root__: typing.List[typing.Any]
+
 
 class SpendPointsRequest(BaseValidationModel):
     points: int
+
+    @classmethod
+    def from_dict_fast(cls, dictionary: dict):
+        points = dictionary.get("points")
+        return cls.construct(points=points) if type(points) is int else None
+
+
+class SpendPointsBatchItem(BaseValidationModel):
+    account_id: str
+    points: int
+
+    @classmethod
+    def from_dict_fast(cls, dictionary: dict):
+        account_id, points = dictionary.get("account_id"), dictionary.get("points")
+        if type(account_id) is not str or type(points) is not int:
+            return None
+        return cls.construct(account_id=account_id, points=points)
+
+
+class SpendPointsBatchRequest(BaseValidationModel):
+    # Items are validated one at a time as `SpendPointsBatchItem` so a bad item only fails itself.
+    __root__: typing.List[typing.Any]
+
+
+class ProfilerRequest(BaseValidationModel):
+    # Body of POST /admin/profiler, starts sampling every `interval` seconds or stops it.
+    running: bool
+    interval: typing.Optional[confloat(ge=0.001, le=1.0)] = None
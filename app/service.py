@@ -1,57 +1,322 @@
-import bisect
+import contextlib
 import datetime
+import heapq
+import itertools
 import logging
-import multiprocessing
+import threading
 import time
 import typing
 
-from app.model import Account, Transaction, AccountDoesntExistException, NotEnoughPointsException
+from app.aggregates import PayerTotal, PayerTotals
+from app.cache import EncodedBalanceCache, encode_fragment
+from app.index import SortedKeys
+from app.ledger import LedgerEntry
+from app.locks import StripedLocks
+from app.logs import AUDIT
+from app.metrics import METRICS, ACCOUNTS, ACCOUNT_EXPANSIONS, ACCOUNT_LOCK_WAIT_SECONDS, LEDGER_ENTRIES
+from app.metrics import LEDGER_ENTRIES_COMPACTED, RESIDENT_ACCOUNTS, SPEND_LOTS_VISITED
+from app.metrics import MetricsCollection, merge_collections
+from app.model import Account, PayerLots, Transaction, AccountDoesntExistException, NotEnoughPointsException
+from app.model import BalanceSnapshot, to_epoch_microseconds
+from app.storage import AccountStore, MemoryAccountStore
 
 logger = logging.getLogger(__name__)
 
 
 class PointsService:
-    def __init__(self):
-        self.accounts: typing.Dict[str, Account] = {}
-        self.account_locks: typing.Dict[str, multiprocessing.Lock] = {}
+    def __init__(self,
+                 journal=None,
+                 compaction_threshold: typing.Optional[int] = None,
+                 account_store: typing.Optional[AccountStore] = None):
+        # Every account in memory by default, an `app.tiering.TieredAccountStore` spills cold ones to disk.
+        self.accounts: AccountStore = account_store if account_store is not None else MemoryAccountStore()
+        self.account_locks = StripedLocks()
+        self.accounts.bind(self.account_locks)
+        # Account ids in sorted order for cursor pagination. An id is in the index exactly while its account is in
+        # `accounts` as seen by holders of the index lock, so pages can read the accounts they list.
+        self.account_index = SortedKeys()
+        self.account_index_lock = threading.Lock()
+        self.balance_cache = EncodedBalanceCache()
+        # Points available and spent per payer across every account, kept up to date by `_add_transaction`.
+        self.payer_totals = PayerTotals()
+        # Optional `app.persistence.WriteAheadLog`, applied mutations are journaled before they are acknowledged.
+        self.journal = journal
+        # Accounts whose live ledger reaches this many entries are compacted inline, never when None.
+        self.compaction_threshold = compaction_threshold
+
+    @contextlib.contextmanager
+    def _account_lock(self, account_id: str, operation: str):
+        # Holds the account's lock, recording how long `operation` waited for it.
+        lock = self.account_locks[account_id]
+        started = time.perf_counter()
+        with lock:
+            ACCOUNT_LOCK_WAIT_SECONDS.observe(time.perf_counter() - started, operation)
+            yield
+
+    def collect_metrics(self) -> MetricsCollection:
+        # Metrics recorded in this process along with the account count and ledger sizes of this service.
+        # Ledger sizes are of the accounts in memory, cold accounts are not read back to be measured.
+        accounts = self.accounts.resident()
+        service_metrics = {
+            (ACCOUNTS.name, ()): [len(self.accounts)],
+            (RESIDENT_ACCOUNTS.name, ()): [len(accounts)],
+            (LEDGER_ENTRIES.name, ()): LEDGER_ENTRIES.cell(len(account.timestamp_sorted_transactions)
+                                                         for account in accounts),
+        }
+        return merge_collections(METRICS.collect(), service_metrics)
 
     def get_account_ids(self) -> typing.List[str]:
-        return list(self.accounts.keys())
+        return self.accounts.account_ids()
 
     def get_account(self, account_id: str) -> typing.Optional[Account]:
-        return self.accounts[account_id] if account_id in self.accounts else None
+        return self.accounts.get(account_id)
+
+    def has_account(self, account_id: str) -> bool:
+        return account_id in self.accounts
 
     def remove_account(self, account_id: str):
-        # dict.pop() is a C-function call with no bytecode __dunder__ callback, so it is technically an atomic call.
-        # There is no need for explicit concurrency safety. Additionally, this method is primarily used for testing...
-        self.accounts.pop(account_id)
+        # Removal takes the account lock so it is ordered with in flight adds and spends, including in the journal.
+        with self._account_lock(account_id, "remove_account"):
+            self._pop_account(account_id)
+            journal_sequence = self.journal.append_removal(account_id) if self.journal is not None else 0
+        self._wait_for_journal(journal_sequence)
 
     def get_points_balances(self, account_id: str):
+        # Balance reads take the account's published snapshot and never wait on its lock.
         points_balances: typing.Dict[str, int] = {}
-        if account_id in self.accounts:
-            points_balances = self.accounts[account_id].available_points_by_payer.copy()
+        account = self.accounts.get(account_id)
+        if account is not None:
+            points_balances = dict(account.balances.balances)
         return points_balances
 
+    def get_points_balances_as_of(self,
+                                  account_id: str,
+                                  timestamp: datetime.datetime) -> typing.Optional[typing.Dict[str, int]]:
+        # Balances counting only transactions at or before the timestamp, or None when there is no such account.
+        # Read under the account lock, the ledger's blocks are reorganized by concurrent adds.
+        with self._account_lock(account_id, "get_points_balances_as_of"):
+            account = self.accounts.get(account_id)
+            return account.balances_as_of(to_epoch_microseconds(timestamp)) if account is not None else None
+
+    def get_transactions_page(self,
+                              account_id: str,
+                              key: typing.Tuple[int, int],
+                              end: typing.Optional[int],
+                              payer: typing.Optional[str],
+                              limit: int) -> typing.Optional[typing.List[typing.Tuple[int, int, int, str]]]:
+        """
+        Up to `limit` of the account's transactions as (epoch timestamp, sequence, points, payer) in ledger order,
+        starting at the (epoch timestamp, sequence) key and ending before the epoch timestamp `end`, only those of
+        `payer` when given. None when there is no such account.
+
+        The first entry is found by binary search and ledger blocks without any entry of the payer are skipped, so a
+        page costs about the entries it returns. Read under the account lock like `get_points_balances_as_of`.
+        """
+        with self._account_lock(account_id, "get_transactions_page"):
+            account = self.accounts.get(account_id)
+            if account is None:
+                return None
+            payer_id = None
+            if payer is not None:
+                if payer not in account.payer_ids:
+                    return []
+                payer_id = account.payer_ids[payer]
+            entries = account.history(key, payer_id)
+            if end is not None:
+                entries = itertools.takewhile(lambda entry: entry[0] < end, entries)
+            return [(timestamp, sequence, points, account.payers[entry_payer_id])
+                    for timestamp, sequence, points, entry_payer_id in itertools.islice(entries, limit)]
+
+    def get_all_points_balances(self) -> typing.List[typing.Tuple[str, typing.Dict[str, int]]]:
+        return [(account_id, self.get_points_balances(account_id)) for account_id in self.get_account_ids()]
+
+    def get_payer_totals(self) -> typing.Dict[str, PayerTotal]:
+        return self.payer_totals.totals()
+
+    def get_points_balances_version(self, account_id: str) -> typing.Optional[int]:
+        account = self.accounts.get(account_id)
+        return account.balances.version if account is not None else None
+
+    def get_encoded_points_balances(self, account_id: str) -> typing.Optional[typing.Tuple[int, bytes]]:
+        # The account's balance version with its balances encoded as JSON, or None when there is no such account.
+        account = self.accounts.get(account_id)
+        return self._encoded_points_balances(account_id, account.balances) if account is not None else None
+
+    def get_all_encoded_points_balances(self) -> typing.List[typing.Tuple[str, int, bytes]]:
+        # Listings peek at the balances of cold accounts rather than faulting them into the working set.
+        snapshots = ((account_id, self.accounts.peek_balances(account_id))
+                     for account_id in self.accounts.account_ids())
+        return [(account_id, *self._encoded_points_balances(account_id, snapshot))
+                for account_id, snapshot in snapshots if snapshot is not None]
+
+    def get_encoded_points_balances_page(self,
+                                         after: typing.Optional[str],
+                                         limit: int) -> typing.List[typing.Tuple[str, int, bytes]]:
+        with self.account_index_lock:
+            return [(account_id, *self._encoded_points_balances(account_id, self.accounts.peek_balances(account_id)))
+                    for account_id in self.account_index.after(after, limit)]
+
+    def _encoded_points_balances(self, account_id: str, snapshot: BalanceSnapshot) -> typing.Tuple[int, bytes]:
+        # The version and balances come from one snapshot, so an encoding is always cached under its own version.
+        encoded = self.balance_cache.get(account_id, snapshot.version)
+        if encoded is None:
+            encoded = encode_fragment(dict(snapshot.balances))
+            self.balance_cache.put(account_id, snapshot.version, encoded)
+        return snapshot.version, encoded
+
+    def get_points_balances_page(self,
+                                 after: typing.Optional[str],
+                                 limit: int) -> typing.List[typing.Tuple[str, typing.Dict[str, int]]]:
+        # Up to `limit` accounts with ids after `after` in id order with their balances.
+        with self.account_index_lock:
+            return [(account_id, dict(self.accounts.peek_balances(account_id).balances))
+                    for account_id in self.account_index.after(after, limit)]
+
     def add_transaction(self, account_id, payer, points, timestamp):
-        # Lock mutation on account while transaction is added. `setdefault` is not guaranteed atomic, but may be in
-        # some CPython implementations. Either way, handling the race condition here is not worth the performance
-        # impact of a global accounts lock and can only cause a problem for the first competing requests to
-        # add a create an account that doesn't exist with an add transaction.
+        # Lock mutation on account while transaction is added. Every request for an account hashes to the same
+        # striped lock, so creating the account on its first add is race free.
         #
         # Note: the `with lock` syntax performs a lock.acquire() and then guarantees lock.release() on successful
         # execution and even if an exception is raised inside the with body block.
-        with self.account_locks.setdefault(account_id, multiprocessing.Lock()):
-            account = self.accounts.setdefault(account_id, Account(account_id))
+        with self._account_lock(account_id, "add_transaction"):
+            account = self._get_or_create_account(account_id)
             transaction = Transaction(payer, points, timestamp)
             self._add_transaction(account, transaction)
+            journal_sequence = self._journal_transactions(account, [transaction])
+            self._compact_when_due(account)
+        # Wait for the group commit outside the account lock so other requests for the account can join it.
+        self._wait_for_journal(journal_sequence)
         return transaction
 
+    def add_transactions(self,
+                         account_id: str,
+                         transactions: typing.List[typing.Tuple[str, int, datetime.datetime]]
+                         ) -> typing.List[Transaction]:
+        # Adds a batch of (payer, points, timestamp) under a single hold of the account lock.
+        with self._account_lock(account_id, "add_transactions"):
+            account = self._get_or_create_account(account_id)
+            transactions = [Transaction(payer, points, timestamp) for payer, points, timestamp in transactions]
+            self._add_transactions(account, transactions)
+            journal_sequence = self._journal_transactions(account, transactions)
+            self._compact_when_due(account)
+        self._wait_for_journal(journal_sequence)
+        return transactions
+
+    def import_transactions(self,
+                            batches: typing.List[
+                                typing.Tuple[str, typing.List[typing.Tuple[str, int, datetime.datetime]]]],
+                            audit: bool = True) -> int:
+        # Bulk load path of `app.importer`. Each account's (payer, points, timestamp) batch is added as by
+        # `add_transactions` under one hold of its lock, and the journal is waited on once for all of them. Returns the
+        # number of transactions added.
+        journal_sequence = 0
+        added = 0
+        for account_id, transactions in batches:
+            with self._account_lock(account_id, "import_transactions"):
+                account = self._get_or_create_account(account_id)
+                transactions = [Transaction(payer, points, timestamp) for payer, points, timestamp in transactions]
+                self._add_transactions(account, transactions, audit=audit)
+                journal_sequence = max(journal_sequence, self._journal_transactions(account, transactions))
+                self._compact_when_due(account)
+            added += len(transactions)
+        self._wait_for_journal(journal_sequence)
+        return added
+
+    def _get_or_create_account(self, account_id: str) -> Account:
+        # Must be called while holding the account lock.
+        account = self.accounts.get(account_id)
+        if account is None:
+            account = Account(account_id)
+            self._insert_account(account)
+        return account
+
+    def _insert_account(self, account: Account):
+        # Accounts are only added and removed through these two so the account index and cache stay in step.
+        account.publish_balances()
+        self.payer_totals.add_account(account)
+        self.accounts.put(account)
+        with self.account_index_lock:
+            self.account_index.add(account.account_id)
+
+    def _pop_account(self, account_id: str) -> typing.Optional[Account]:
+        with self.account_index_lock:
+            self.account_index.discard(account_id)
+        account = self.accounts.pop(account_id, None)
+        self.balance_cache.discard(account_id)
+        if account is not None:
+            self.payer_totals.add_account(account, sign=-1)
+        return account
+
+    def _journal_transactions(self, account: Account, transactions: typing.List[Transaction]) -> int:
+        # Must be called while holding the account lock so journal order matches the order applied to the account.
+        if self.journal is None or not transactions:
+            return 0
+        account.journal_sequence = self.journal.append_transactions(account.account_id, transactions)
+        return account.journal_sequence
+
+    def _wait_for_journal(self, journal_sequence: int):
+        if self.journal is not None and journal_sequence:
+            self.journal.wait(journal_sequence)
+
+    def compact_accounts(self) -> int:
+        # Compacts every account regardless of the threshold, returning the number of ledger entries folded.
+        folded = 0
+        for account_id in self.get_account_ids():
+            with self._account_lock(account_id, "compact_accounts"):
+                account = self.accounts.get(account_id)
+                if account is not None:
+                    folded += self._compact(account)
+        return folded
+
+    def _compact_when_due(self, account: Account):
+        # Must be called while holding the account lock. Waiting for the live ledger to double since the last
+        # compaction keeps the copying amortized even while most of the ledger is unspent and cannot be folded.
+        if self.compaction_threshold is None:
+            return
+        if len(account.timestamp_sorted_transactions) >= max(self.compaction_threshold, 2 * account.compacted_length):
+            self._compact(account)
+
+    @staticmethod
+    def _compact(account: Account) -> int:
+        folded = account.compact()
+        if folded:
+            LEDGER_ENTRIES_COMPACTED.inc(amount=folded)
+            logger.debug("Compacted %d ledger entries of account '%s', %d remain", folded, account.account_id,
+                         len(account.timestamp_sorted_transactions))
+        return folded
+
     @staticmethod
-    def _add_transaction(account: Account, transaction: Transaction):
+    def _restore_behind_horizon(account: Account, transactions: typing.List[Transaction]):
+        # A lot dated before the compaction horizon can make newer archived lots of its payer spendable again, so those
+        # are restored first. Lots of a batch are taken in turn, each one against what the earlier ones left archived.
+        if account.compaction_horizon is None:
+            return
+        for transaction in transactions:
+            timestamp = to_epoch_microseconds(transaction.timestamp)
+            if transaction.points > 0 and timestamp < account.compaction_horizon and \
+                    transaction.payer in account.payer_ids:
+                restored = account.restore_lots(account.payer_ids[transaction.payer], timestamp, transaction.points)
+                if restored:
+                    logger.debug("Restored %d archived lots of payer '%s' in account '%s' for a backdated add",
+                                 restored, transaction.payer, account.account_id)
+                    ACCOUNT_EXPANSIONS.inc()
+
+    def _add_transaction(self,
+                         account: Account,
+                         transaction: Transaction,
+                         spent_from_lots: bool = False,
+                         audit: bool = True,
+                         publish: bool = True):
+        # Publishes the account's balances unless `publish` is False, when the caller publishes once it has applied
+        # the rest of the change.
+        PointsService._restore_behind_horizon(account, [transaction])
         if transaction.payer not in account.spent_points_by_payer:
             account.spent_points_by_payer[transaction.payer] = 0
         if transaction.payer not in account.available_points_by_payer:
             account.available_points_by_payer[transaction.payer] = 0
+        payer_id = account.payer_id(transaction.payer)
+        if transaction.payer not in account.lots_by_payer:
+            account.lots_by_payer[transaction.payer] = PayerLots(payer_id)
 
         previous_available_points = account.available_points_by_payer[transaction.payer]
         if previous_available_points + transaction.points < 0:
@@ -59,55 +324,165 @@ class PointsService:
             #   out of order with negative point values or an error in the spend points transactions calculation.
             # This could be swapped by raising an exception that stops the transaction from being added,
             # though it is not clear from the instructions what edge case functionality is desired.
-            logger.error(f"Available Points for payer '{transaction.payer}' in account: '{account}' is negative.")
+            logger.error("Available Points for payer '%s' in account: '%s' is negative.", transaction.payer,
+                         account.account_id)
 
         # Uncomment millisecond wait below for reliable stress testing. It forces a thread break during a global
         # resource mutation calculation. This could also potentially be tested with a lot more threads and time...
         # time.sleep(0.001)
         account.available_points_by_payer[transaction.payer] = previous_available_points + transaction.points
-        # Insert transaction into sorted list by timestamp, this uses the __lt__ function from Transaction.
-        bisect.insort(account.timestamp_sorted_transactions, transaction)
+        self.payer_totals.add(transaction.payer, transaction.points, max(-transaction.points, 0))
+        # Insert transaction into the ledger by timestamp, the account sequence keeps equal timestamps in arrival order.
+        account.transaction_sequence += 1
+        timestamp = to_epoch_microseconds(transaction.timestamp)
+        account.timestamp_sorted_transactions.insert(timestamp, account.transaction_sequence, transaction.points,
+                                                     payer_id)
         if transaction.points == 0:
-            logger.error(f"Transaction {transaction} has a point value of 0. This should not be possible.")
+            logger.error("Transaction %s has a point value of 0. This should not be possible.", transaction)
         elif transaction.points < 0:
             # Update spent points
             account.spent_points_by_payer[transaction.payer] -= transaction.points
-        logger.info(f"Applied transaction to account '{account.account_id}': {transaction}")
+            # Spend transactions have already consumed their lots while being calculated.
+            if not spent_from_lots:
+                account.lots_by_payer[transaction.payer].consume(-transaction.points)
+        else:
+            account.lots_by_payer[transaction.payer].add(transaction.points, timestamp, account.transaction_sequence)
+        if publish:
+            account.publish_balances()
+        if audit:
+            AUDIT.record(account.account_id, [transaction])
+
+    def _add_transactions(self, account: Account, transactions: typing.List[Transaction], audit: bool = True):
+        # Batch version of `_add_transaction`. Entries get sequences in batch order, then the sorted batch is merged
+        # into the ledger and each payer's lots in one pass instead of one insert per transaction. FIFO consumption
+        # is measured from the front of the lots, so applying the batch in any order gives the same result. Payer
+        # totals are updated once per payer of the batch.
+        PointsService._restore_behind_horizon(account, transactions)
+        entries: typing.List[LedgerEntry] = []
+        lot_entries_by_payer: typing.Dict[str, typing.List[LedgerEntry]] = {}
+        totals_by_payer: typing.Dict[str, typing.List[int]] = {}
+        for transaction in transactions:
+            payer_id = account.payer_id(transaction.payer)
+            if transaction.payer not in account.lots_by_payer:
+                account.spent_points_by_payer[transaction.payer] = 0
+                account.available_points_by_payer[transaction.payer] = 0
+                account.lots_by_payer[transaction.payer] = PayerLots(payer_id)
+            available_points = account.available_points_by_payer[transaction.payer] + transaction.points
+            if available_points < 0:
+                logger.error("Available Points for payer '%s' in account: '%s' is negative.", transaction.payer,
+                             account.account_id)
+            account.available_points_by_payer[transaction.payer] = available_points
+            payer_total = totals_by_payer.get(transaction.payer)
+            if payer_total is None:
+                payer_total = totals_by_payer[transaction.payer] = [0, 0]
+            payer_total[0] += transaction.points
+            account.transaction_sequence += 1
+            entry = (to_epoch_microseconds(transaction.timestamp), account.transaction_sequence, transaction.points,
+                     payer_id)
+            entries.append(entry)
+            if transaction.points == 0:
+                logger.error("Transaction %s has a point value of 0. This should not be possible.", transaction)
+            elif transaction.points < 0:
+                account.spent_points_by_payer[transaction.payer] -= transaction.points
+                account.lots_by_payer[transaction.payer].consume(-transaction.points)
+                payer_total[1] -= transaction.points
+            else:
+                lot_entries_by_payer.setdefault(transaction.payer, []).append(entry)
+        entries.sort()
+        account.timestamp_sorted_transactions.merge(entries)
+        for payer, lot_entries in lot_entries_by_payer.items():
+            lot_entries.sort()
+            account.lots_by_payer[payer].merge(lot_entries)
+        for payer, (available, spent) in totals_by_payer.items():
+            self.payer_totals.add(payer, available, spent)
+        account.publish_balances()
+        if audit:
+            AUDIT.record(account.account_id, transactions)
 
     def spend_points(self, account_id, points):
         # Lock mutation on account while transaction spend is being calculated and spend transactions are being added.
-        with self.account_locks.setdefault(account_id, multiprocessing.Lock()):
-            if account_id in self.accounts:
-                account = self.accounts[account_id]
-            else:
+        with self._account_lock(account_id, "spend_points"):
+            account = self.accounts.get(account_id)
+            if account is None:
                 raise AccountDoesntExistException()
+            transactions = self._spend_points(account, points)
+            # A spend is journaled as its negative transactions, replaying them consumes the same lots.
+            journal_sequence = self._journal_transactions(account, transactions)
+            self._compact_when_due(account)
 
-            points_to_spend = points
-            spend_negation_by_payer = account.spent_points_by_payer.copy()
-            transactions: typing.List[Transaction] = []
-            for transaction in account.timestamp_sorted_transactions:
-                # Iterate over add transactions in timestamp order to accumulate spend negation.
-                if transaction.points > 0 and points_to_spend > 0:
-                    spend_negation = spend_negation_by_payer[transaction.payer]
-                    if spend_negation >= transaction.points:
-                        # Spend negation hasn't completed yet.
-                        spend_negation_by_payer[transaction.payer] -= transaction.points
-                    else:
-                        # The accumulated add transactions for this payer have exceeded the already spent,
-                        # so we can start to use these transactions and spend against them.
-                        spend_negation_by_payer[transaction.payer] = 0
-                        # Spend can't be larger than the points to spend and must be negative in the transaction
-                        spend = -min(transaction.points - spend_negation, points_to_spend)
-                        points_to_spend += spend
-                        datetime_now_utc = datetime.datetime.now(datetime.timezone.utc)
-                        transactions.append(Transaction(transaction.payer, spend, datetime_now_utc))
-
-            if points_to_spend == 0:
-                logger.info(f"Spend Transactions calculated for account {account_id}: {transactions}")
-                for transaction in transactions:
-                    self._add_transaction(account, transaction)
-            else:
-                raise NotEnoughPointsException(f"Not enough points to spend... need {points_to_spend} more for "
-                                               f"account {account_id}")
+        self._wait_for_journal(journal_sequence)
+        return transactions
+
+    def spend_points_batch(self, spends: typing.List[typing.Tuple[str, typing.List[int]]]) -> typing.List[list]:
+        """
+        Applies the spends of several accounts, given as (account id, points of each spend), in one call. Each
+        account's spends run in order under a single hold of its lock and are journaled as one record, and the journal
+        is waited on once for the whole batch. The result for each account lists each spend's transactions, or the
+        `NotEnoughPointsException` or `AccountDoesntExistException` it failed with, and a failed spend does not stop
+        the others.
+        """
+        results = []
+        journal_sequence = 0
+        for account_id, spend_points in spends:
+            with self._account_lock(account_id, "spend_points_batch"):
+                account = self.accounts.get(account_id)
+                if account is None:
+                    results.append([AccountDoesntExistException() for _ in spend_points])
+                    continue
+                account_results = []
+                transactions: typing.List[Transaction] = []
+                for points in spend_points:
+                    try:
+                        spent = self._spend_points(account, points)
+                    except NotEnoughPointsException as exception:
+                        account_results.append(exception)
+                        continue
+                    account_results.append(spent)
+                    transactions.extend(spent)
+                journal_sequence = max(journal_sequence, self._journal_transactions(account, transactions))
+                self._compact_when_due(account)
+            results.append(account_results)
+        self._wait_for_journal(journal_sequence)
+        return results
+
+    def _spend_points(self, account: Account, points: int) -> typing.List[Transaction]:
+        # Must be called while holding the account lock. Applies the spend and returns its negative transactions.
+        # Unconsumed lot points for a payer are exactly its available points when those are positive, so the spend
+        # can be rejected up front without touching any lots.
+        spendable_points = sum(max(available, 0) for available in account.available_points_by_payer.values())
+        if points < 0 or points > spendable_points:
+            points_to_spend = points - spendable_points if points > 0 else points
+            raise NotEnoughPointsException(f"Not enough points to spend... need {points_to_spend} more for "
+                                           f"account {account.account_id}")
+
+        # Merge the payers' oldest unconsumed lots by (timestamp, sequence) and consume them in FIFO order. Only the
+        # lots actually spent against are visited.
+        heads = []
+        for payer, payer_lots in account.lots_by_payer.items():
+            head = payer_lots.head()
+            if head is not None:
+                heads.append((*head, payer))
+        heapq.heapify(heads)
+
+        points_to_spend = points
+        transactions: typing.List[Transaction] = []
+        while points_to_spend > 0:
+            _, _, remaining, payer = heapq.heappop(heads)
+            payer_lots = account.lots_by_payer[payer]
+            spend = min(remaining, points_to_spend)
+            payer_lots.consume(spend)
+            points_to_spend -= spend
+            datetime_now_utc = datetime.datetime.now(datetime.timezone.utc)
+            transactions.append(Transaction(payer, -spend, datetime_now_utc))
+            head = payer_lots.head()
+            if head is not None:
+                heapq.heappush(heads, (*head, payer))
 
+        SPEND_LOTS_VISITED.observe(len(transactions))
+        logger.debug("Spend of %d points for account '%s' consumed %d lots", points, account.account_id,
+                     len(transactions))
+        # A spend of several lots is published once, readers never see only some of its lots spent.
+        for transaction in transactions:
+            self._add_transaction(account, transaction, spent_from_lots=True, publish=False)
+        account.publish_balances()
         return transactions
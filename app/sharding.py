@@ -0,0 +1,277 @@
+import atexit
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import threading
+import typing
+import zlib
+
+from app.aggregates import PayerTotal
+from app.logs import configure_logging
+from app.metrics import METRICS, MetricsCollection, merge_collections
+from app.model import Transaction
+from app.persistence import Persistence
+from app.service import PointsService
+from app.tiering import create_account_store
+
+logger = logging.getLogger(__name__)
+
+# Service methods a shard worker will run for its router.
+SHARD_METHODS = {
+    "add_transaction",
+    "add_transactions",
+    "import_transactions",
+    "spend_points",
+    "spend_points_batch",
+    "remove_account",
+    "has_account",
+    "get_points_balances",
+    "get_points_balances_as_of",
+    "get_transactions_page",
+    "get_account_ids",
+    "get_all_points_balances",
+    "get_points_balances_page",
+    "get_points_balances_version",
+    "get_encoded_points_balances",
+    "get_all_encoded_points_balances",
+    "get_payer_totals",
+    "get_encoded_points_balances_page",
+    "collect_metrics",
+    "compact_accounts",
+}
+
+
+def shard_for(account_id: str, shards: int) -> int:
+    # crc32 rather than hash(), string hashes are salted differently in every process.
+    return zlib.crc32(account_id.encode("utf-8")) % shards
+
+
+def serve_connection(service: PointsService, connection: multiprocessing.connection.Connection):
+    # Runs the calls sent over one router connection until the router closes it.
+    while True:
+        try:
+            method, args = connection.recv()
+        except EOFError:
+            return
+        try:
+            if method not in SHARD_METHODS:
+                raise AttributeError(f"{method} is not a shard method.")
+            response = (True, getattr(service, method)(*args))
+        except Exception as exception:
+            response = (False, exception)
+        connection.send(response)
+
+
+def serve_shard(connections: typing.List[multiprocessing.connection.Connection],
+                data_directory: typing.Optional[str],
+                commit_latency: float,
+                snapshot_interval: typing.Optional[float],
+                compaction_threshold: typing.Optional[int] = None,
+                hot_accounts: typing.Optional[int] = None,
+                cold_store_directory: typing.Optional[str] = None):
+    # Worker process main loop, owns a PointsService for one partition of account ids.
+    configure_logging(logging.INFO)
+    account_store = create_account_store(hot_accounts, cold_store_directory)
+    persistence = Persistence(data_directory, commit_latency, snapshot_interval,
+                              compaction_threshold=compaction_threshold,
+                              account_store=account_store) if data_directory else None
+    service = persistence.recover() if persistence is not None else PointsService(
+        compaction_threshold=compaction_threshold, account_store=account_store)
+    # Each connection is served by its own thread, so a call waiting on the journal's group commit leaves the other
+    # connections free to apply writes that join the same commit.
+    servers = [threading.Thread(target=serve_connection, args=(service, connection),
+                                name=f"ShardConnection-{index}", daemon=True)
+               for index, connection in enumerate(connections)]
+    for server in servers:
+        server.start()
+    for server in servers:
+        server.join()
+    if persistence is not None:
+        persistence.close()
+
+
+class Shard:
+    def __init__(self,
+                 process: multiprocessing.Process,
+                 connections: typing.List[multiprocessing.connection.Connection]):
+        self.process = process
+        self.connections: "queue.SimpleQueue[multiprocessing.connection.Connection]" = queue.SimpleQueue()
+        for connection in connections:
+            self.connections.put(connection)
+
+    def call(self, method: str, *args):
+        # Each request thread borrows one of the shard's connections, and the worker serves every connection on its
+        # own thread, so a shard runs up to that many requests at once and their journal writes share commits.
+        connection = self.connections.get()
+        try:
+            connection.send((method, args))
+            succeeded, result = connection.recv()
+        finally:
+            self.connections.put(connection)
+        if not succeeded:
+            raise result
+        return result
+
+
+class ShardedPointsService:
+    """
+    Drop in replacement for `PointsService` that partitions accounts across worker processes.
+
+    Each of the `shards` worker processes owns the accounts whose id hashes to it, so adds and spends for different
+    partitions run on different cores instead of sharing one interpreter lock. Account scoped calls are forwarded to
+    the owning shard over a pool of pipes and whole-service reads fan out to every shard and are merged. With a
+    `data_directory` every shard is journaled to its own subdirectory, so the shard count has to stay the same
+    across restarts.
+    """
+
+    def __init__(self,
+                 shards: int,
+                 connections_per_shard: int = 8,
+                 data_directory: typing.Optional[str] = None,
+                 commit_latency: float = 0.002,
+                 snapshot_interval: typing.Optional[float] = None,
+                 compaction_threshold: typing.Optional[int] = None,
+                 hot_accounts: typing.Optional[int] = None,
+                 cold_store_directory: typing.Optional[str] = None):
+        context = multiprocessing.get_context("spawn")
+        self.shards: typing.List[Shard] = []
+        for shard in range(shards):
+            shard_directory = os.path.join(data_directory, f"shard-{shard:03d}") if data_directory else None
+            shard_cold_directory = (os.path.join(cold_store_directory, f"shard-{shard:03d}")
+                                    if cold_store_directory else None)
+            pipes = [context.Pipe() for _ in range(connections_per_shard)]
+            process = context.Process(target=serve_shard,
+                                      args=([worker_end for _, worker_end in pipes], shard_directory,
+                                            commit_latency, snapshot_interval, compaction_threshold,
+                                            hot_accounts, shard_cold_directory),
+                                      name=f"PointsShard-{shard}",
+                                      daemon=True)
+            process.start()
+            for _, worker_end in pipes:
+                worker_end.close()
+            self.shards.append(Shard(process, [router_end for router_end, _ in pipes]))
+        self._fan_out = concurrent.futures.ThreadPoolExecutor(max_workers=shards, thread_name_prefix="ShardFanOut")
+        atexit.register(self.close)
+        logger.info(f"Started {shards} points service shards.")
+
+    def _shard(self, account_id: str) -> Shard:
+        return self.shards[shard_for(account_id, len(self.shards))]
+
+    def _call_all(self, method: str, *args) -> list:
+        return list(self._fan_out.map(lambda shard: shard.call(method, *args), self.shards))
+
+    def collect_metrics(self) -> MetricsCollection:
+        # Request metrics are recorded in this process and service metrics in the shards.
+        return merge_collections(METRICS.collect(), *self._call_all("collect_metrics"))
+
+    def compact_accounts(self) -> int:
+        return sum(self._call_all("compact_accounts"))
+
+    def get_account_ids(self) -> typing.List[str]:
+        return [account_id for account_ids in self._call_all("get_account_ids") for account_id in account_ids]
+
+    def get_all_points_balances(self) -> typing.List[typing.Tuple[str, typing.Dict[str, int]]]:
+        return [balances for shard_balances in self._call_all("get_all_points_balances") for balances in shard_balances]
+
+    def get_points_balances_page(self,
+                                 after: typing.Optional[str],
+                                 limit: int) -> typing.List[typing.Tuple[str, typing.Dict[str, int]]]:
+        # Every shard returns its own first `limit` accounts after the cursor, the page is the first `limit` of
+        # their merge.
+        pages = self._call_all("get_points_balances_page", after, limit)
+        return list(itertools.islice(heapq.merge(*pages, key=lambda balances: balances[0]), limit))
+
+    def get_all_encoded_points_balances(self) -> typing.List[typing.Tuple[str, int, bytes]]:
+        return [encoded for shard_encoded in self._call_all("get_all_encoded_points_balances")
+                for encoded in shard_encoded]
+
+    def get_encoded_points_balances_page(self,
+                                         after: typing.Optional[str],
+                                         limit: int) -> typing.List[typing.Tuple[str, int, bytes]]:
+        pages = self._call_all("get_encoded_points_balances_page", after, limit)
+        return list(itertools.islice(heapq.merge(*pages, key=lambda encoded: encoded[0]), limit))
+
+    def get_payer_totals(self) -> typing.Dict[str, PayerTotal]:
+        # Every shard totals its own accounts, a payer's totals are the sum of the shards'.
+        totals: typing.Dict[str, PayerTotal] = {}
+        for shard_totals in self._call_all("get_payer_totals"):
+            for payer, shard_total in shard_totals.items():
+                total = totals.setdefault(payer, {"available": 0, "spent": 0})
+                total["available"] += shard_total["available"]
+                total["spent"] += shard_total["spent"]
+        return dict(sorted(totals.items()))
+
+    def get_points_balances_version(self, account_id: str) -> typing.Optional[int]:
+        return self._shard(account_id).call("get_points_balances_version", account_id)
+
+    def get_encoded_points_balances(self, account_id: str) -> typing.Optional[typing.Tuple[int, bytes]]:
+        return self._shard(account_id).call("get_encoded_points_balances", account_id)
+
+    def has_account(self, account_id: str) -> bool:
+        return self._shard(account_id).call("has_account", account_id)
+
+    def remove_account(self, account_id: str):
+        return self._shard(account_id).call("remove_account", account_id)
+
+    def get_points_balances(self, account_id: str) -> typing.Dict[str, int]:
+        return self._shard(account_id).call("get_points_balances", account_id)
+
+    def get_points_balances_as_of(self, account_id: str, timestamp) -> typing.Optional[typing.Dict[str, int]]:
+        return self._shard(account_id).call("get_points_balances_as_of", account_id, timestamp)
+
+    def get_transactions_page(self, account_id: str, key, end, payer, limit: int
+                              ) -> typing.Optional[typing.List[typing.Tuple[int, int, int, str]]]:
+        return self._shard(account_id).call("get_transactions_page", account_id, key, end, payer, limit)
+
+    def add_transaction(self, account_id, payer, points, timestamp) -> Transaction:
+        return self._shard(account_id).call("add_transaction", account_id, payer, points, timestamp)
+
+    def add_transactions(self, account_id, transactions) -> typing.List[Transaction]:
+        return self._shard(account_id).call("add_transactions", account_id, transactions)
+
+    def import_transactions(self, batches, audit: bool = True) -> int:
+        # Each shard is sent its accounts' batches in one call, and the shards apply them in parallel.
+        batches_by_shard: typing.Dict[int, list] = {}
+        for batch in batches:
+            batches_by_shard.setdefault(shard_for(batch[0], len(self.shards)), []).append(batch)
+        return sum(self._fan_out.map(lambda item: self.shards[item[0]].call("import_transactions", item[1], audit),
+                                     batches_by_shard.items()))
+
+    def spend_points(self, account_id, points) -> typing.List[Transaction]:
+        return self._shard(account_id).call("spend_points", account_id, points)
+
+    def spend_points_batch(self, spends) -> typing.List[list]:
+        # Each shard is sent its accounts' spends in one call and the shards apply them in parallel. Results are put
+        # back in the order the accounts were given.
+        positions_by_shard: typing.Dict[int, typing.List[int]] = {}
+        for position, (account_id, _) in enumerate(spends):
+            positions_by_shard.setdefault(shard_for(account_id, len(self.shards)), []).append(position)
+
+        def call(item):
+            shard, positions = item
+            shard_spends = [spends[position] for position in positions]
+            return positions, self.shards[shard].call("spend_points_batch", shard_spends)
+
+        results: typing.List[list] = [[] for _ in spends]
+        for positions, shard_results in self._fan_out.map(call, positions_by_shard.items()):
+            for position, result in zip(positions, shard_results):
+                results[position] = result
+        return results
+
+    def close(self):
+        # Closing the router ends of the pipes stops the workers once they finish their current request.
+        for shard in self.shards:
+            while True:
+                try:
+                    shard.connections.get_nowait().close()
+                except queue.Empty:
+                    break
+        for shard in self.shards:
+            shard.process.join(timeout=10)
+        self._fan_out.shutdown(wait=False)
+        self.shards = []
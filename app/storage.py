@@ -0,0 +1,67 @@
+import typing
+
+from app.model import Account, BalanceSnapshot
+
+
+class AccountStore:
+    """
+    Where `PointsService` keeps its accounts.
+
+    `get` is on the request path and may fault a cold account into memory, `peek` reads an account for snapshots
+    without making it part of the working set, and `peek_balances` reads only its published balances for listings.
+    Stores that move accounts out of memory are given the service's account locks by `bind` and only move an account
+    while they hold its lock, so an account is never moved while an add or spend is applied to it.
+    """
+
+    def bind(self, locks):
+        pass
+
+    def get(self, account_id: str) -> typing.Optional[Account]:
+        raise NotImplementedError
+
+    def peek(self, account_id: str) -> typing.Optional[Account]:
+        raise NotImplementedError
+
+    def peek_balances(self, account_id: str) -> typing.Optional[BalanceSnapshot]:
+        raise NotImplementedError
+
+    def put(self, account: Account):
+        raise NotImplementedError
+
+    def pop(self, account_id: str, default=None) -> typing.Optional[Account]:
+        raise NotImplementedError
+
+    def account_ids(self) -> typing.List[str]:
+        raise NotImplementedError
+
+    def resident(self) -> typing.List[Account]:
+        # Accounts currently held in memory.
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __contains__(self, account_id: str) -> bool:
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+
+class MemoryAccountStore(dict, AccountStore):
+    # Every account in memory, the default. Lookups are the dict's own, so the request path costs what it did before
+    # there were stores.
+    peek = dict.get
+
+    def peek_balances(self, account_id: str) -> typing.Optional[BalanceSnapshot]:
+        account = self.get(account_id)
+        return account.balances if account is not None else None
+
+    def put(self, account: Account):
+        self[account.account_id] = account
+
+    def account_ids(self) -> typing.List[str]:
+        return list(self.keys())
+
+    def resident(self) -> typing.List[Account]:
+        return list(self.values())
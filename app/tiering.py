@@ -0,0 +1,201 @@
+import collections
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import typing
+
+from app.cache import encode_fragment
+from app.metrics import METRICS
+from app.model import Account, BalanceSnapshot
+from app.persistence import decode_account, encode_account
+from app.storage import AccountStore
+
+logger = logging.getLogger(__name__)
+
+COLD_STORE_FILE = "cold-accounts.sqlite"
+
+ACCOUNT_FAULTS = METRICS.counter("points_account_faults_total",
+                                 "Cold accounts read back from the cold store into memory.")
+ACCOUNT_EVICTIONS = METRICS.counter("points_account_evictions_total",
+                                    "Accounts moved out of memory, by whether they were written to the cold store.",
+                                    ["written"])
+
+
+class TieredAccountStore(AccountStore):
+    """
+    Accounts in a bounded in-memory working set, with the rest spilled to a SQLite file.
+
+    Up to `capacity` accounts are kept in memory in least recently used order. Past that the least recently used
+    accounts are encoded as they would be in a snapshot and written to the cold store, and an account that is asked
+    for again is faulted back in. Hits only move the account to the back of the order, so hot accounts cost about
+    what they do in a `MemoryAccountStore`. Accounts read back keep the version of their row, and one evicted again
+    unchanged is not rewritten. A cold row keeps the account's balance version and its balances encoded as JSON in
+    columns of their own, so listings read those without decoding the account.
+
+    An account is only evicted while its lock can be taken without waiting, so accounts being written to stay in
+    memory, even past the capacity if every one of them is busy. The cold store is scratch space, recovery comes
+    from `app.persistence`, so it is emptied when opened and written without syncing.
+    """
+
+    def __init__(self, path: str, capacity: int):
+        if capacity < 1:
+            raise ValueError("A tiered account store needs room for at least one account in memory.")
+        self.path = path
+        self.capacity = capacity
+        self.locks = None
+        self._resident: "collections.OrderedDict[str, Account]" = collections.OrderedDict()
+        # Ids only in the cold store, and the row versions of resident accounts that also have a row.
+        self._cold: typing.Set[str] = set()
+        self._stored_versions: typing.Dict[str, int] = {}
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=OFF")
+        self._connection.execute("PRAGMA synchronous=OFF")
+        self._connection.execute("DROP TABLE IF EXISTS accounts")
+        self._connection.execute("CREATE TABLE accounts (account_id TEXT PRIMARY KEY, version INTEGER NOT NULL, "
+                                 "balances BLOB NOT NULL, account BLOB NOT NULL)")
+
+    def bind(self, locks):
+        self.locks = locks
+
+    def get(self, account_id: str) -> typing.Optional[Account]:
+        account = self._resident.get(account_id)
+        if account is not None:
+            try:
+                self._resident.move_to_end(account_id)
+            except KeyError:
+                # Evicted in between, so nobody holds its lock. Readers may see it as of its eviction.
+                pass
+            return account
+        if account_id not in self._cold:
+            return None
+        with self._lock:
+            account = self._resident.get(account_id)
+            if account is None and account_id in self._cold:
+                # Lookups without the store lock must find the account in one tier or the other throughout.
+                account = self._read(account_id)
+                self._stored_versions[account_id] = account.version
+                self._resident[account_id] = account
+                self._cold.discard(account_id)
+                ACCOUNT_FAULTS.inc()
+                self._evict()
+            return account
+
+    def peek(self, account_id: str) -> typing.Optional[Account]:
+        account = self._resident.get(account_id)
+        if account is not None or account_id not in self._cold:
+            return account
+        with self._lock:
+            account = self._resident.get(account_id)
+            if account is None and account_id in self._cold:
+                account = self._read(account_id)
+            return account
+
+    def peek_balances(self, account_id: str) -> typing.Optional[BalanceSnapshot]:
+        account = self._resident.get(account_id)
+        if account is not None or account_id not in self._cold:
+            return account.balances if account is not None else None
+        with self._lock:
+            account = self._resident.get(account_id)
+            if account is not None:
+                return account.balances
+            if account_id not in self._cold:
+                return None
+            version, balances = self._connection.execute(
+                "SELECT version, balances FROM accounts WHERE account_id = ?", (account_id,)).fetchone()
+            return BalanceSnapshot(version, json.loads(balances))
+
+    def put(self, account: Account):
+        with self._lock:
+            self._resident[account.account_id] = account
+            self._resident.move_to_end(account.account_id)
+            stored = self._stored_versions.pop(account.account_id, None) is not None
+            if stored or account.account_id in self._cold:
+                self._cold.discard(account.account_id)
+                self._delete(account.account_id)
+            self._evict()
+
+    def pop(self, account_id: str, default=None) -> typing.Optional[Account]:
+        with self._lock:
+            account = self._resident.pop(account_id, None)
+            stored = self._stored_versions.pop(account_id, None) is not None
+            if account is None and account_id in self._cold:
+                account = self._read(account_id)
+                self._cold.discard(account_id)
+                stored = True
+            if stored:
+                self._delete(account_id)
+            return account if account is not None else default
+
+    def account_ids(self) -> typing.List[str]:
+        with self._lock:
+            return list(self._resident) + list(self._cold)
+
+    def resident(self) -> typing.List[Account]:
+        return list(self._resident.values())
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def __contains__(self, account_id: str) -> bool:
+        return account_id in self._resident or account_id in self._cold
+
+    def __len__(self):
+        return len(self._resident) + len(self._cold)
+
+    def _evict(self):
+        # Must be called while holding the store lock. Busy accounts go to the back of the order instead, taking their
+        # locks here could deadlock with a request that holds one while waiting on the store.
+        busy = 0
+        while len(self._resident) > self.capacity:
+            if busy >= len(self._resident):
+                logger.debug("Every account in memory is busy, %d are resident past the capacity of %d",
+                             len(self._resident), self.capacity)
+                return
+            account_id = next(iter(self._resident))
+            lock = self.locks[account_id] if self.locks is not None else None
+            if lock is not None and not lock.acquire(blocking=False):
+                self._resident.move_to_end(account_id)
+                busy += 1
+                continue
+            try:
+                account = self._resident[account_id]
+                written = self._stored_versions.pop(account_id, None) != account.version
+                if written:
+                    self._connection.execute(
+                        "INSERT OR REPLACE INTO accounts (account_id, version, balances, account) VALUES (?, ?, ?, ?)",
+                        (account_id, account.version, encode_fragment(dict(account.balances.balances)),
+                         encode_account(account)))
+                self._cold.add(account_id)
+                del self._resident[account_id]
+                ACCOUNT_EVICTIONS.inc(str(written).lower())
+            finally:
+                if lock is not None:
+                    lock.release()
+
+    def _read(self, account_id: str) -> Account:
+        version, encoded = self._connection.execute("SELECT version, account FROM accounts WHERE account_id = ?",
+                                                    (account_id,)).fetchone()
+        account, _ = decode_account(encoded)
+        account.publish_balances(version)
+        return account
+
+    def _delete(self, account_id: str):
+        self._connection.execute("DELETE FROM accounts WHERE account_id = ?", (account_id,))
+
+
+def create_account_store(hot_accounts: typing.Optional[int],
+                         directory: typing.Optional[str] = None) -> typing.Optional[AccountStore]:
+    # A tiered store holding `hot_accounts` in memory, or None to keep every account in memory. The cold store is
+    # put in a new temporary directory unless one is given.
+    if not hot_accounts:
+        return None
+    directory = directory or tempfile.mkdtemp(prefix="points-cold-")
+    return TieredAccountStore(os.path.join(directory, COLD_STORE_FILE), hot_accounts)
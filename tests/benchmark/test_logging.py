@@ -0,0 +1,84 @@
+import json
+import logging
+import logging.handlers
+import queue
+import time
+
+import pytest
+
+import app.app
+from app.logs import AUDIT, AsyncLogHandler, BinaryAuditSink, LOG_FORMAT
+from app.service import PointsService
+from tests.fixtures.benchmark import benchmark_sizes, best_rate
+
+logger = logging.getLogger(__name__)
+
+REQUESTS = min(benchmark_sizes()[0], 20000)
+
+
+class SlowFile:
+    # Log file whose flushes stall for 100us, like a busy disk or a pipe to a slow log shipper.
+    def __init__(self, log_file):
+        self.log_file = log_file
+
+    def write(self, text: str):
+        self.log_file.write(text)
+
+    def flush(self):
+        time.sleep(0.0001)
+        self.log_file.flush()
+
+
+@pytest.fixture
+def app_log_file(tmp_path):
+    # Sends the app's logs only to a file, as a deployed server would, instead of through pytest's capture.
+    app_logger = logging.getLogger("app")
+    saved = app_logger.level, app_logger.propagate, list(app_logger.handlers)
+    app_logger.setLevel(logging.INFO)
+    app_logger.propagate = False
+    app_logger.handlers = []
+    with open(tmp_path / "app.log", "w") as log_file:
+        yield app_logger, log_file
+    app_logger.level, app_logger.propagate, app_logger.handlers = saved
+
+
+class TestResource:
+
+    @pytest.mark.parametrize("handler, audit", [
+        ("stream", "log"), ("queue", "log"), ("slow_stream", "log"), ("slow_queue", "log"),
+        ("queue", "sample:0.01"), ("queue", "binary"), ("queue", "off"),
+    ])
+    def test_logging_throughput(self, benchmark_recorder, monkeypatch, tmp_path, app_log_file, handler, audit):
+        # Add and spend requests through the Flask app in a 9:1 mix while every log line is written to a file.
+        app_logger, log_file = app_log_file
+        stream_handler = logging.StreamHandler(SlowFile(log_file) if handler.startswith("slow") else log_file)
+        stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        listener = None
+        if handler.endswith("queue"):
+            log_queue = queue.SimpleQueue()
+            listener = logging.handlers.QueueListener(log_queue, stream_handler)
+            listener.start()
+            app_logger.addHandler(AsyncLogHandler(log_queue))
+        else:
+            app_logger.addHandler(stream_handler)
+        sink = BinaryAuditSink(str(tmp_path / "audit.bin")) if audit == "binary" else None
+        monkeypatch.setattr(AUDIT, "sink", sink)
+        monkeypatch.setattr(AUDIT, "sample_rate", {"sample:0.01": 0.01, "off": 0.0}.get(audit, 1.0))
+        monkeypatch.setattr(app.app, "points_service", PointsService())
+        client = app.app.app.test_client()
+        bodies = [json.dumps({"payer": f"PAYER-{index % 4}", "points": 100, "timestamp": "2020-01-01T00:00:00Z"})
+                  for index in range(REQUESTS)]
+
+        def requests():
+            for index, body in enumerate(bodies):
+                if index % 10 == 9:
+                    client.post("/points/benchmark/spend", data='{"points": 10}', content_type="application/json")
+                else:
+                    client.post("/points/benchmark/add", data=body, content_type="application/json")
+
+        rate = best_rate(requests, REQUESTS)
+        if listener is not None:
+            listener.stop()
+        if sink is not None:
+            sink.close()
+        benchmark_recorder.record(f"logging_throughput[{handler}-{audit}]", rate, "requests/s")
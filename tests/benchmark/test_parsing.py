@@ -0,0 +1,88 @@
+import json
+import logging
+import time
+
+import pytest
+
+import app.app
+import app.cache
+import app.schema
+from app.schema import AddPointsRequest, SpendPointsRequest
+from app.service import PointsService
+from tests.fixtures.benchmark import benchmark_sizes
+
+logger = logging.getLogger(__name__)
+
+REQUESTS = min(benchmark_sizes()[0], 10000)
+PAYERS = ["DANNON", "UNILEVER", "MILLER COORS", "KRAFT"]
+
+
+@pytest.fixture(autouse=True)
+def quiet_service_logging():
+    app_logger = logging.getLogger("app")
+    level = app_logger.level
+    app_logger.setLevel(logging.WARNING)
+    yield
+    app_logger.setLevel(level)
+
+
+@pytest.fixture(params=["pydantic", "fast"])
+def parsing(request, monkeypatch):
+    # "pydantic" turns the fast path off, validating every body with pydantic and encoding with json as before it.
+    if request.param == "pydantic":
+        monkeypatch.setattr(app.schema, "orjson", None)
+        monkeypatch.setattr(app.cache, "orjson", None)
+        for model in [AddPointsRequest, SpendPointsRequest]:
+            monkeypatch.setattr(model, "from_dict_fast", classmethod(lambda cls, dictionary: None))
+    app.schema.parse_timestamp.cache_clear()
+    return request.param
+
+
+def cpu_per_request(requests) -> float:
+    # Microseconds of process CPU time per request, the least disturbed of three runs.
+    best = float("inf")
+    for _ in range(3):
+        started = time.process_time()
+        requests()
+        best = min(best, time.process_time() - started)
+    return best / REQUESTS * 1e6
+
+
+class TestResource:
+
+    @pytest.mark.parametrize("route", ["add", "spend", "add_batch"])
+    def test_request_cpu(self, benchmark_recorder, monkeypatch, parsing, route):
+        # Flask requests with timestamps from one day of whole minutes, as a client reporting events would send.
+        monkeypatch.setattr(app.app, "points_service", PointsService())
+        client = app.app.app.test_client()
+        adds = [{"payer": PAYERS[index % 4], "points": 100, "timestamp": f"2020-11-02T{index // 60 % 24:02d}:"
+                 f"{index % 60:02d}:00Z"} for index in range(REQUESTS)]
+        client.post("/points/benchmark/add", json={"payer": "DANNON", "points": 10 ** 9,
+                                                   "timestamp": "2020-11-01T00:00:00Z"})
+        if route == "add":
+            bodies = [("/points/benchmark/add", json.dumps(add)) for add in adds]
+        elif route == "spend":
+            bodies = [("/points/benchmark/spend", json.dumps({"points": 10}))] * REQUESTS
+        else:
+            bodies = [("/points/benchmark/add/batch", json.dumps([add] * 10)) for add in adds]
+
+        def requests():
+            for path, body in bodies:
+                client.post(path, data=body, content_type="application/json")
+
+        benchmark_recorder.record(f"request_cpu[{route}-{parsing}]", cpu_per_request(requests), "us",
+                                  higher_is_better=False)
+
+    @pytest.mark.parametrize("model", [AddPointsRequest, SpendPointsRequest])
+    def test_parse_cpu(self, benchmark_recorder, parsing, model):
+        # Validating a decoded body and a JSON string body, as the Flask and double encoded clients send them.
+        body = {"payer": "DANNON", "points": 100, "timestamp": "2020-11-02T14:00:00Z"}
+        encoded = json.dumps(body)
+
+        def requests():
+            for _ in range(REQUESTS // 2):
+                model.from_dict_or_json(body)
+                model.from_dict_or_json(encoded)
+
+        benchmark_recorder.record(f"parse_cpu[{model.__name__}-{parsing}]", cpu_per_request(requests), "us",
+                                  higher_is_better=False)
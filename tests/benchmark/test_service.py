@@ -0,0 +1,447 @@
+import csv
+import datetime
+import logging
+import random
+import statistics
+import threading
+import time
+import tracemalloc
+import typing
+
+import pytest
+
+from app import handlers
+from app.idempotency import IdempotencyStore
+from app.importer import run_import
+from app.metrics import MetricsRegistry
+from app.persistence import Persistence
+from app.profiling import SamplingProfiler
+from app.service import PointsService
+from app.sharding import ShardedPointsService
+from app.tiering import TieredAccountStore
+from tests.fixtures.benchmark import benchmark_sizes, best_rate
+
+logger = logging.getLogger(__name__)
+
+START = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+PAYERS = ["DANNON", "UNILEVER", "MILLER COORS", "KRAFT"]
+SIZES = benchmark_sizes()
+
+
+@pytest.fixture(autouse=True)
+def quiet_service_logging():
+    # Per transaction info logging would dominate every measurement.
+    app_logger = logging.getLogger("app")
+    level = app_logger.level
+    app_logger.setLevel(logging.WARNING)
+    yield
+    app_logger.setLevel(level)
+
+
+def transactions(count: int, order: str, seed: int = 0):
+    seconds = list(range(count))
+    if order == "backdated":
+        seconds.reverse()
+    elif order == "random":
+        random.Random(seed).shuffle(seconds)
+    return [(PAYERS[second % len(PAYERS)], 10, START + datetime.timedelta(seconds=second)) for second in seconds]
+
+
+def loaded_service(account_id: str, count: int, compaction_threshold: typing.Optional[int] = None) -> PointsService:
+    service = PointsService(compaction_threshold=compaction_threshold)
+    batch = transactions(count, "random")
+    for start in range(0, count, 10000):
+        service.add_transactions(account_id, batch[start:start + 10000])
+    return service
+
+
+def spend_latencies(service: PointsService, account_id: str, spends: int = 1000) -> typing.List[float]:
+    # Up to `spends` spends of 25 points, fewer or smaller ones when they would take over half of the balance.
+    balance = sum(service.get_points_balances(account_id).values())
+    points = max(min(25, balance // 2), 1)
+    latencies = []
+    for _ in range(max(min(spends, balance // (2 * points)), 1)):
+        started = time.perf_counter()
+        service.spend_points(account_id, points)
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+    return latencies
+
+
+def spend_share(service: PointsService, account_id: str, share: float):
+    # Spends that share of the account's balance in one spend.
+    service.spend_points(account_id, int(sum(service.get_points_balances(account_id).values()) * share))
+
+
+def account_bytes(service: PointsService, account_id: str) -> int:
+    # Ledger, lot and archive bytes of an account.
+    account = service.get_account(account_id)
+    return (account.timestamp_sorted_transactions.nbytes() +
+            sum(payer_lots.lots.nbytes() for payer_lots in account.lots_by_payer.values()) +
+            sum(chunk.nbytes() for chunk in account.archive))
+
+
+class TestResource:
+
+    @pytest.mark.parametrize("size", SIZES)
+    @pytest.mark.parametrize("order", ["in_order", "backdated", "random"])
+    def test_add_throughput(self, benchmark_recorder, order, size):
+        batch = transactions(size, order)
+
+        def add():
+            service = PointsService()
+            for payer, points, timestamp in batch:
+                service.add_transaction("benchmark", payer, points, timestamp)
+
+        benchmark_recorder.record(f"add_throughput[{order}-{size}]", best_rate(add, size, repeats=1), "adds/s")
+
+    @pytest.mark.parametrize("size", SIZES)
+    @pytest.mark.parametrize("order", ["in_order", "random"])
+    def test_batch_add_throughput(self, benchmark_recorder, order, size):
+        batch = transactions(size, order)
+
+        def add():
+            service = PointsService()
+            for start in range(0, size, 1000):
+                service.add_transactions("benchmark", batch[start:start + 1000])
+
+        benchmark_recorder.record(f"batch_add_throughput[{order}-{size}]", best_rate(add, size, repeats=1),
+                                  "adds/s")
+
+    @pytest.mark.parametrize("size", SIZES)
+    def test_spend_latency(self, benchmark_recorder, size):
+        service = loaded_service("benchmark", size)
+        latencies = spend_latencies(service, "benchmark")
+        benchmark_recorder.record(f"spend_latency_p50[{size}]", statistics.median(latencies) * 1e6, "us",
+                                  higher_is_better=False)
+        benchmark_recorder.record(f"spend_latency_p99[{size}]", latencies[int(len(latencies) * 0.99)] * 1e6, "us",
+                                  higher_is_better=False)
+
+    @pytest.mark.parametrize("size", SIZES)
+    def test_compaction(self, benchmark_recorder, size):
+        # An account with 80% of its points spent, measured before and after compacting it.
+        service = loaded_service("benchmark", size)
+        spend_share(service, "benchmark", 0.8)
+        uncompacted_bytes = account_bytes(service, "benchmark")
+        uncompacted = spend_latencies(service, "benchmark", 200)
+        started = time.perf_counter()
+        service.compact_accounts()
+        compaction_seconds = time.perf_counter() - started
+        compacted_bytes = account_bytes(service, "benchmark")
+        compacted = spend_latencies(service, "benchmark", 200)
+        benchmark_recorder.record(f"compaction_time[{size}]", compaction_seconds * 1e3, "ms", higher_is_better=False)
+        benchmark_recorder.record(f"compaction_bytes_before[{size}]", uncompacted_bytes, "bytes",
+                                  higher_is_better=False)
+        benchmark_recorder.record(f"compaction_bytes_after[{size}]", compacted_bytes, "bytes",
+                                  higher_is_better=False)
+        benchmark_recorder.record(f"compaction_spend_p50_before[{size}]", statistics.median(uncompacted) * 1e6, "us",
+                                  higher_is_better=False)
+        benchmark_recorder.record(f"compaction_spend_p50_after[{size}]", statistics.median(compacted) * 1e6, "us",
+                                  higher_is_better=False)
+
+    @pytest.mark.parametrize("size", SIZES)
+    def test_backdated_adds_after_compaction(self, benchmark_recorder, size):
+        # Adds dated anywhere in the history of an account with 80% of its points spent and compacted, compacting
+        # when due as the server does. Each one restores only the few archived lots it can make spendable again.
+        service = loaded_service("benchmark", size, compaction_threshold=size // 2)
+        spend_share(service, "benchmark", 0.8)
+        service.compact_accounts()
+        generator = random.Random(0)
+        latencies = []
+        for _ in range(200):
+            timestamp = START + datetime.timedelta(seconds=generator.randrange(size))
+            started = time.perf_counter()
+            service.add_transaction("benchmark", generator.choice(PAYERS), 10, timestamp)
+            latencies.append(time.perf_counter() - started)
+        latencies.sort()
+        benchmark_recorder.record(f"backdated_add_compacted_p50[{size}]", statistics.median(latencies) * 1e6, "us",
+                                  higher_is_better=False)
+        benchmark_recorder.record(f"backdated_add_compacted_p99[{size}]", latencies[int(len(latencies) * 0.99)] * 1e6,
+                                  "us", higher_is_better=False)
+
+    @pytest.mark.parametrize("size", SIZES)
+    def test_balances_as_of(self, benchmark_recorder, size):
+        # Point-in-time balances at random times, then again once most points are spent and compacted.
+        service = loaded_service("benchmark", size)
+        generator = random.Random(0)
+        as_of = [START + datetime.timedelta(seconds=generator.randrange(size)) for _ in range(1000)]
+
+        def median_latency() -> float:
+            latencies = []
+            for timestamp in as_of:
+                started = time.perf_counter()
+                service.get_points_balances_as_of("benchmark", timestamp)
+                latencies.append(time.perf_counter() - started)
+            return statistics.median(latencies)
+
+        benchmark_recorder.record(f"balances_as_of_p50[{size}]", median_latency() * 1e6, "us",
+                                  higher_is_better=False)
+        service.spend_points("benchmark", size * 8)
+        service.compact_accounts()
+        benchmark_recorder.record(f"balances_as_of_compacted_p50[{size}]", median_latency() * 1e6, "us",
+                                  higher_is_better=False)
+
+    @pytest.mark.parametrize("size", SIZES)
+    def test_transaction_pages(self, benchmark_recorder, size):
+        # 100 transaction pages from random times, all payers and one payer, through the handler so encoding counts.
+        service = loaded_service("benchmark", size)
+        generator = random.Random(0)
+        starts = [(START + datetime.timedelta(seconds=generator.randrange(size))).isoformat() for _ in range(200)]
+        for name, query in [("transactions_page", {}), ("transactions_payer_page", {"payer": "KRAFT"})]:
+            latencies = []
+            for start in starts:
+                started = time.perf_counter()
+                handlers.get_account_transactions(service, "benchmark", {"from": start, "limit": "100", **query})
+                latencies.append(time.perf_counter() - started)
+            benchmark_recorder.record(f"{name}_p50[{size}]", statistics.median(latencies) * 1e6, "us",
+                                      higher_is_better=False)
+
+    @pytest.mark.parametrize("size", SIZES)
+    def test_tiered_accounts(self, benchmark_recorder, tmp_path, size):
+        # `size` accounts of 10 transactions each with room for 1% of them in memory. Adds to a hot set of accounts
+        # that fits are compared with an in-memory service, then accounts are read in random order to fault them in.
+        accounts = max(size // 10, 100)
+        store = TieredAccountStore(str(tmp_path / "cold.sqlite"), capacity=accounts // 100)
+        tiered = PointsService(account_store=store)
+        tracemalloc.start()
+        for account in range(accounts):
+            tiered.add_transactions(f"account-{account}", transactions(10, "random", account))
+        traced_bytes, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        hot = [f"account-{account}" for account in range(accounts - accounts // 200, accounts)]
+        in_memory = PointsService()
+        for account_id in hot:
+            in_memory.add_transactions(account_id, transactions(10, "random"))
+
+        def add(service: PointsService):
+            def run():
+                for second in range(10000):
+                    service.add_transaction(hot[second % len(hot)], "DANNON", 10,
+                                            START + datetime.timedelta(seconds=second))
+            return run
+
+        generator = random.Random(0)
+        cold = [f"account-{generator.randrange(accounts)}" for _ in range(1000)]
+        latencies = []
+        for account_id in cold:
+            started = time.perf_counter()
+            tiered.get_points_balances(account_id)
+            latencies.append(time.perf_counter() - started)
+        benchmark_recorder.record(f"tiered_hot_add_throughput[{size}]", best_rate(add(tiered), 10000), "adds/s")
+        benchmark_recorder.record(f"in_memory_hot_add_throughput[{size}]", best_rate(add(in_memory), 10000), "adds/s")
+        benchmark_recorder.record(f"tiered_fault_in_p50[{size}]", statistics.median(latencies) * 1e6, "us",
+                                  higher_is_better=False)
+        benchmark_recorder.record(f"tiered_bytes_per_account[{size}]", traced_bytes / accounts, "bytes",
+                                  higher_is_better=False)
+        store.close()
+
+    @pytest.mark.parametrize("size", SIZES)
+    def test_bulk_import(self, benchmark_recorder, tmp_path, size):
+        # A CSV of `size` rows in time order over size / 50 accounts, read and applied in batches of 100000 rows.
+        path = tmp_path / "history.csv"
+        generator = random.Random(0)
+        accounts = max(size // 50, 1)
+        with open(path, "w", newline="") as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(["account_id", "payer", "points", "timestamp"])
+            for second in range(size):
+                timestamp = START + datetime.timedelta(seconds=second)
+                writer.writerow([f"account-{generator.randrange(accounts)}", PAYERS[second % len(PAYERS)], 10,
+                                 timestamp.isoformat()])
+        rates = [run_import(PointsService(), [str(path)]).to_dict()["rows_per_second"] for _ in range(3)]
+        benchmark_recorder.record(f"bulk_import_throughput[{size}]", max(rates), "rows/s")
+
+    @pytest.mark.parametrize("size", SIZES)
+    @pytest.mark.parametrize("threads", [1, 8])
+    def test_concurrent_mixed_workload(self, benchmark_recorder, threads, size):
+        # Adds, spends and balance reads in an 8:1:1 mix over 64 accounts.
+        operations_per_thread = size // threads
+        service = PointsService()
+        barrier = threading.Barrier(threads + 1)
+
+        def operate(thread: int):
+            barrier.wait()
+            for operation in range(operations_per_thread):
+                account_id = f"account-{(thread * 7 + operation) % 64}"
+                if operation % 10 == 8:
+                    if service.has_account(account_id):
+                        service.spend_points(account_id, 5)
+                elif operation % 10 == 9:
+                    handlers.get_points_for_account(service, account_id)
+                else:
+                    service.add_transaction(account_id, PAYERS[operation % len(PAYERS)], 10,
+                                            START + datetime.timedelta(seconds=operation))
+
+        workers = [threading.Thread(target=operate, args=(thread,)) for thread in range(threads)]
+        for worker in workers:
+            worker.start()
+        barrier.wait()
+        started = time.perf_counter()
+        for worker in workers:
+            worker.join()
+        rate = threads * operations_per_thread / (time.perf_counter() - started)
+        benchmark_recorder.record(f"mixed_workload[{threads}_threads-{size}]", rate, "operations/s")
+
+    @pytest.mark.parametrize("size", SIZES)
+    def test_get_points(self, benchmark_recorder, size):
+        # GET /points over size / 10 accounts, first with a cold balance cache and then with a warm one.
+        accounts = max(size // 10, 1)
+        service = PointsService()
+        for account_number in range(accounts):
+            service.add_transactions(f"account-{account_number}",
+                                     [(payer, 10, START) for payer in PAYERS])
+        cold = best_rate(lambda: handlers.get_points(service, {}), accounts, repeats=1)
+        warm = best_rate(lambda: handlers.get_points(service, {}), accounts)
+        paged = best_rate(lambda: handlers.get_points(service, {"limit": "1000"}), min(accounts, 1000))
+        benchmark_recorder.record(f"get_points_cold[{accounts}_accounts]", cold, "accounts/s")
+        benchmark_recorder.record(f"get_points_warm[{accounts}_accounts]", warm, "accounts/s")
+        benchmark_recorder.record(f"get_points_page[{accounts}_accounts]", paged, "accounts/s")
+
+    @pytest.mark.parametrize("size", SIZES)
+    def test_payer_totals(self, benchmark_recorder, size):
+        # GET /payers against summing every account's balances, over size / 10 accounts.
+        accounts = max(size // 10, 1)
+        service = PointsService()
+        for account_number in range(accounts):
+            service.add_transactions(f"account-{account_number}", [(payer, 10, START) for payer in PAYERS])
+
+        def scan():
+            totals: typing.Dict[str, int] = {}
+            for _, balances in service.get_all_points_balances():
+                for payer, points in balances.items():
+                    totals[payer] = totals.get(payer, 0) + points
+
+        scanned = best_rate(scan, 1, repeats=1)
+        aggregated = best_rate(lambda: [handlers.get_payers(service) for _ in range(1000)], 1000)
+        benchmark_recorder.record(f"payer_totals_scan[{accounts}_accounts]", scanned, "reads/s")
+        benchmark_recorder.record(f"payer_totals[{accounts}_accounts]", aggregated, "reads/s")
+
+    @pytest.mark.parametrize("writers", [0, 4])
+    def test_balance_reads_under_writes(self, benchmark_recorder, writers):
+        # GET /points/<account_id> on one hot account while `writers` threads add to and spend from it.
+        service = PointsService()
+        service.add_transactions("hot", [(payer, 1000, START) for payer in PAYERS])
+        reads = 50000
+        stopping = threading.Event()
+        writes = [0] * writers
+
+        def write(writer: int):
+            while not stopping.is_set():
+                service.add_transaction("hot", PAYERS[writes[writer] % len(PAYERS)], 10, START)
+                service.spend_points("hot", 10)
+                writes[writer] += 2
+
+        workers = [threading.Thread(target=write, args=(writer,)) for writer in range(writers)]
+        for worker in workers:
+            worker.start()
+        started = time.perf_counter()
+        for _ in range(reads):
+            handlers.get_points_for_account(service, "hot")
+        elapsed = time.perf_counter() - started
+        stopping.set()
+        for worker in workers:
+            worker.join()
+        benchmark_recorder.record(f"balance_reads_under_writes[{writers}_writers]", reads / elapsed, "reads/s")
+        if writers:
+            benchmark_recorder.record(f"writes_under_balance_reads[{writers}_writers]", sum(writes) / elapsed,
+                                      "writes/s")
+
+    def test_idempotent_spends(self, benchmark_recorder, monkeypatch):
+        # Spends through the handlers without a key, with a new key each and retried with the key of a stored one.
+        monkeypatch.setattr(handlers, "IDEMPOTENCY", IdempotencyStore())
+        service = loaded_service("benchmark", 100000)
+        spends = 10000
+        body = {"points": 1}
+        keys = [f"spend-{index}" for index in range(spends)]
+        unkeyed = best_rate(lambda: [handlers.spend_points(service, "benchmark", body) for _ in range(spends)],
+                            spends, repeats=1)
+        keyed = best_rate(lambda: [handlers.spend_points(service, "benchmark", body, key) for key in keys],
+                          spends, repeats=1)
+        replayed = best_rate(lambda: [handlers.spend_points(service, "benchmark", body, key) for key in keys],
+                             spends)
+        benchmark_recorder.record("spend_unkeyed", unkeyed, "spends/s")
+        benchmark_recorder.record("spend_idempotency_key", keyed, "spends/s")
+        benchmark_recorder.record("spend_idempotent_replay", replayed, "spends/s")
+
+    def test_batch_spends(self, benchmark_recorder, tmp_path):
+        # Spends spread over 100 journaled accounts, one request each and in batches of 100 items.
+        persistence = Persistence(str(tmp_path / "data"))
+        service = persistence.recover()
+        account_ids = [f"account-{account}" for account in range(100)]
+        for account_id in account_ids:
+            service.add_transactions(account_id, [(payer, 10000, START) for payer in PAYERS])
+        spends = 1000
+        items = [{"account_id": account_ids[index % len(account_ids)], "points": 1} for index in range(spends)]
+        single = best_rate(lambda: [handlers.spend_points(service, item["account_id"], {"points": 1})
+                                    for item in items], spends, repeats=1)
+        batched = best_rate(lambda: [handlers.spend_points_batch(service, items[start:start + 100])
+                                     for start in range(0, spends, 100)], spends, repeats=1)
+        benchmark_recorder.record("journaled_single_spends", single, "spends/s")
+        benchmark_recorder.record("journaled_batch_spends", batched, "spends/s")
+        persistence.close()
+
+    def test_journaled_sharded_adds(self, benchmark_recorder, tmp_path):
+        # Single adds from 16 threads over 64 accounts, journaled in process and across 2 journaled shards. Writes
+        # queued on a shard share its group commits like they do in process.
+        threads, adds_per_thread = 16, 100
+
+        def add(service):
+            def operate(thread: int):
+                for add_number in range(adds_per_thread):
+                    service.add_transaction(f"account-{(thread * 7 + add_number) % 64}", "DANNON", 10, START)
+
+            workers = [threading.Thread(target=operate, args=(thread,)) for thread in range(threads)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+        persistence = Persistence(str(tmp_path / "in-process"), commit_latency=0.002)
+        service = persistence.recover()
+        in_process = best_rate(lambda: add(service), threads * adds_per_thread, repeats=1)
+        persistence.close()
+        sharded_service = ShardedPointsService(2, data_directory=str(tmp_path / "sharded"), commit_latency=0.002)
+        try:
+            sharded = best_rate(lambda: add(sharded_service), threads * adds_per_thread, repeats=1)
+        finally:
+            sharded_service.close()
+        benchmark_recorder.record("journaled_adds[in_process]", in_process, "adds/s")
+        benchmark_recorder.record("journaled_adds[2_shards]", sharded, "adds/s")
+
+    def test_sampling_profiler_overhead(self, benchmark_recorder):
+        # Spends through the handlers with the sampling profiler stopped and sampling at its default interval.
+        service = loaded_service("benchmark", 100000)
+        spends = 20000
+        body = {"points": 1}
+        stopped = best_rate(lambda: [handlers.spend_points(service, "benchmark", body) for _ in range(spends)],
+                            spends)
+        profiler = SamplingProfiler()
+        profiler.start()
+        try:
+            sampled = best_rate(lambda: [handlers.spend_points(service, "benchmark", body) for _ in range(spends)],
+                                spends)
+        finally:
+            profiler.stop()
+        benchmark_recorder.record("spend_profiler_stopped", stopped, "spends/s")
+        benchmark_recorder.record("spend_profiler_sampling", sampled, "spends/s")
+
+    @pytest.mark.parametrize("threads", [1, 8])
+    def test_metrics_recording(self, benchmark_recorder, threads):
+        # Histogram observations from several threads at once, each request makes two or three of them.
+        observations = 100000 // threads
+        registry = MetricsRegistry()
+        histogram = registry.histogram("benchmark_seconds", "Benchmark.", ["route"])
+
+        def observe():
+            for _ in range(observations):
+                histogram.observe(0.003, "/points")
+
+        def run():
+            workers = [threading.Thread(target=observe) for _ in range(threads)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+        benchmark_recorder.record(f"metrics_recording[{threads}_threads]", best_rate(run, threads * observations),
+                                  "observations/s")
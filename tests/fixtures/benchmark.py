@@ -0,0 +1,83 @@
+import datetime
+import json
+import logging
+import os
+import platform
+import time
+import typing
+
+import pytest
+
+logger = logging.getLogger(__name__)
+
+
+def benchmark_sizes() -> typing.List[int]:
+    # Data sizes the benchmark suite is parametrized over, e.g. BENCHMARK_SIZES=100000,1000000,5000000.
+    return [int(size) for size in os.environ.get("BENCHMARK_SIZES", "10000,100000").split(",")]
+
+
+def best_rate(run: typing.Callable[[], None], operations: int, repeats: int = 3) -> float:
+    # Operations per second of the fastest of `repeats` runs, the least disturbed by the rest of the machine.
+    best = float("inf")
+    for _ in range(repeats):
+        started = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - started)
+    return operations / best
+
+
+class BenchmarkRecorder:
+    """
+    Collects benchmark results, writes them to `results_path` as JSON and compares them to a baseline.
+
+    A result regresses when it is worse than the baseline's result of the same name by more than `threshold`, as a
+    fraction of the baseline. A baseline is a results file from an earlier run, results missing from it are only
+    recorded.
+    """
+
+    def __init__(self, results_path: str, baseline_path: typing.Optional[str] = None, threshold: float = 0.25):
+        self.results_path = results_path
+        self.threshold = threshold
+        self.baseline: typing.Dict[str, dict] = {}
+        if baseline_path:
+            with open(baseline_path) as baseline_file:
+                self.baseline = json.load(baseline_file)["results"]
+        self.results: typing.Dict[str, dict] = {}
+
+    def record(self, name: str, value: float, unit: str, higher_is_better: bool = True):
+        self.results[name] = {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+        baseline = self.baseline.get(name)
+        if baseline is None:
+            logger.info(f"Benchmark {name}: {value:.6g} {unit}")
+            return
+        change = (value - baseline["value"]) / baseline["value"]
+        logger.info(f"Benchmark {name}: {value:.6g} {unit}, baseline {baseline['value']:.6g} {unit} "
+                    f"({change:+.1%})")
+        regression = -change if higher_is_better else change
+        if regression > self.threshold:
+            pytest.fail(f"Benchmark {name} regressed {regression:.1%} against the baseline, more than the "
+                        f"{self.threshold:.0%} threshold: {value:.6g} {unit} against {baseline['value']:.6g} {unit}")
+
+    def save(self):
+        if not self.results:
+            return
+        report = {
+            "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "results": self.results,
+        }
+        with open(self.results_path, "w") as results_file:
+            json.dump(report, results_file, indent=2, sort_keys=True)
+        logger.info(f"Wrote {len(self.results)} benchmark results to {self.results_path}")
+
+
+@pytest.fixture(scope="session")
+def benchmark_recorder() -> BenchmarkRecorder:
+    # BENCHMARK_BASELINE points at an earlier results file to compare against, BENCHMARK_THRESHOLD is the allowed
+    # fractional regression.
+    recorder = BenchmarkRecorder(os.environ.get("BENCHMARK_RESULTS", "benchmark-results.json"),
+                                 os.environ.get("BENCHMARK_BASELINE"),
+                                 float(os.environ.get("BENCHMARK_THRESHOLD", "0.25")))
+    yield recorder
+    recorder.save()
@@ -1,6 +1,9 @@
+import os
 import pytest
 import uuid
 
+from app.service import PointsService
+
 
 @pytest.fixture
 def host() -> str:
@@ -17,6 +20,11 @@ def random_account_id() -> str:
     return str(uuid.uuid4())[:6]
 
 
+@pytest.fixture
+def points_service() -> PointsService:
+    return PointsService()
+
+
 @pytest.fixture
 def stress_threads() -> int:
     return 10
@@ -30,3 +38,9 @@ def stress_processes() -> int:
 @pytest.fixture
 def stress_calls() -> int:
     return 50
+
+
+@pytest.fixture
+def benchmark_transactions() -> int:
+    # Scale the in-process benchmarks up to millions of transactions with BENCHMARK_TRANSACTIONS.
+    return int(os.environ.get("BENCHMARK_TRANSACTIONS", "100000"))
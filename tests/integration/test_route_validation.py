@@ -31,4 +31,9 @@ class TestResource:
         response = requests.post(f"http://{host}:{port}/points/{random_account_id}/spend", json=json_data)
         assert response.status_code == 400
 
+    def test_add_points_batch_validation_error(self, host, port, random_account_id):
+        requests.delete(f"http://{host}:{port}/points/{random_account_id}")
+        json_data = json.dumps({"payer": "DANNON", "points": 1000, "timestamp": "2020-11-02T14:00:00Z"})
+        response = requests.post(f"http://{host}:{port}/points/{random_account_id}/add/batch", json=json_data)
+        assert response.status_code == 400
 
@@ -57,3 +57,158 @@ class TestResource:
         response = requests.post(f"http://{host}:{port}/points/{random_account_id}/spend", json=json_data)
         assert response.status_code == 404
         assert 'does not exist' in response.json()["message"]
+
+    def test_spend_points_batch(self, host, port, random_account_id):
+        requests.delete(f"http://{host}:{port}/points/{random_account_id}")
+        json_data = json.dumps({"payer": "DANNON", "points": 1000, "timestamp": "2020-11-02T14:00:00Z"})
+        requests.post(f"http://{host}:{port}/points/{random_account_id}/add", json=json_data)
+        json_data = json.dumps([
+            {"account_id": random_account_id, "points": 600},
+            {"account_id": random_account_id, "points": 600},
+            {"account_id": f"{random_account_id}-missing", "points": 10},
+            {"account_id": random_account_id, "points": "many"},
+            {"account_id": random_account_id, "points": 400}
+        ])
+        response = requests.post(f"http://{host}:{port}/points/spend/batch", json=json_data)
+        assert response.status_code == 200
+        assert response.json()[0] == [{'payer': 'DANNON', 'points': -600}]
+        assert response.json()[1]["status_code"] == 400
+        assert response.json()[2]["status_code"] == 404
+        assert response.json()[3] == {"message": "Bad Request", "status_code": 400}
+        assert response.json()[4] == [{'payer': 'DANNON', 'points': -400}]
+        response = requests.get(f"http://{host}:{port}/points/{random_account_id}")
+        assert response.json() == {"DANNON": 0}
+
+    def test_add_points_batch(self, host, port, random_account_id):
+        requests.delete(f"http://{host}:{port}/points/{random_account_id}")
+        json_data = json.dumps([
+            {"payer": "DANNON", "points": 1000, "timestamp": "2020-11-02T14:00:00Z"},
+            {"payer": "DANNON", "points": 0, "timestamp": "2020-11-02T14:00:00Z"},
+            {"payer": "UNILEVER", "points": "UNILEVER", "timestamp": "2020-11-02T14:00:00Z"},
+            {"payer": "UNILEVER", "points": 200, "timestamp": "2020-10-31T11:00:00Z"}
+        ])
+        response = requests.post(f"http://{host}:{port}/points/{random_account_id}/add/batch", json=json_data)
+        assert response.status_code == 200
+        assert response.json()[0] == {'payer': 'DANNON', 'points': 1000, 'timestamp': "'2020-11-02T14:00:00Z"}
+        assert response.json()[1]["status_code"] == 400
+        assert response.json()[2] == {"message": "Bad Request", "status_code": 400}
+        assert response.json()[3] == {'payer': 'UNILEVER', 'points': 200, 'timestamp': "'2020-10-31T11:00:00Z"}
+        response = requests.get(f"http://{host}:{port}/points/{random_account_id}")
+        assert response.json() == {"DANNON": 1000, "UNILEVER": 200}
+
+    def test_get_points_paginated(self, host, port):
+        requests.delete(f"http://{host}:{port}/points")
+        json_data = json.dumps({"payer": "DANNON", "points": 1000, "timestamp": "2020-11-02T14:00:00Z"})
+        for account_id in ["e", "b", "d", "a", "c"]:
+            requests.post(f"http://{host}:{port}/points/{account_id}/add", json=json_data)
+        response = requests.get(f"http://{host}:{port}/points", params={"limit": 2})
+        assert response.status_code == 200
+        assert response.json() == {"accounts": [{"account_id": "a", "points": {"DANNON": 1000}},
+                                                {"account_id": "b", "points": {"DANNON": 1000}}], "next": "b"}
+        response = requests.get(f"http://{host}:{port}/points", params={"limit": 2, "after": "d"})
+        assert response.json() == {"accounts": [{"account_id": "e", "points": {"DANNON": 1000}}], "next": None}
+        response = requests.get(f"http://{host}:{port}/points", params={"limit": 20000})
+        assert response.status_code == 400
+
+    def test_get_points_ndjson(self, host, port):
+        requests.delete(f"http://{host}:{port}/points")
+        json_data = json.dumps({"payer": "DANNON", "points": 1000, "timestamp": "2020-11-02T14:00:00Z"})
+        for account_id in ["b", "a", "c"]:
+            requests.post(f"http://{host}:{port}/points/{account_id}/add", json=json_data)
+        response = requests.get(f"http://{host}:{port}/points", params={"format": "ndjson", "after": "a"}, stream=True)
+        assert response.status_code == 200
+        assert response.headers["Content-Type"] == "application/x-ndjson"
+        assert [json.loads(line) for line in response.iter_lines()] == [
+            {"account_id": "b", "points": {"DANNON": 1000}}, {"account_id": "c", "points": {"DANNON": 1000}}
+        ]
+
+    def test_get_points_not_modified(self, host, port, random_account_id):
+        requests.delete(f"http://{host}:{port}/points/{random_account_id}")
+        json_data = json.dumps({"payer": "DANNON", "points": 1000, "timestamp": "2020-11-02T14:00:00Z"})
+        requests.post(f"http://{host}:{port}/points/{random_account_id}/add", json=json_data)
+        for url in [f"http://{host}:{port}/points/{random_account_id}", f"http://{host}:{port}/points"]:
+            response = requests.get(url)
+            etag = response.headers["ETag"]
+            response = requests.get(url, headers={"If-None-Match": etag})
+            assert response.status_code == 304
+            assert response.content == b""
+            requests.post(f"http://{host}:{port}/points/{random_account_id}/spend", json=json.dumps({"points": 1}))
+            response = requests.get(url, headers={"If-None-Match": etag})
+            assert response.status_code == 200
+            assert response.headers["ETag"] != etag
+
+    def test_get_metrics(self, host, port, random_account_id):
+        requests.get(f"http://{host}:{port}/points/{random_account_id}")
+        response = requests.get(f"http://{host}:{port}/metrics")
+        assert response.status_code == 200
+        assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+        assert "# TYPE points_http_request_duration_seconds histogram" in response.text
+        assert 'route="/points/<account_id>",method="GET",status="404"' in response.text
+        assert "points_accounts " in response.text
+
+    def test_spend_points_idempotency_key(self, host, port, random_account_id):
+        requests.delete(f"http://{host}:{port}/points/{random_account_id}")
+        json_data = json.dumps({"payer": "DANNON", "points": 1000, "timestamp": "2020-11-02T14:00:00Z"})
+        requests.post(f"http://{host}:{port}/points/{random_account_id}/add", json=json_data)
+        headers = {"Idempotency-Key": f"spend-{random_account_id}"}
+        for _ in range(3):
+            response = requests.post(f"http://{host}:{port}/points/{random_account_id}/spend",
+                                     json=json.dumps({"points": 100}), headers=headers)
+            assert response.status_code == 200
+            assert response.json() == [{'payer': 'DANNON', 'points': -100}]
+        response = requests.post(f"http://{host}:{port}/points/{random_account_id}/spend",
+                                 json=json.dumps({"points": 200}), headers=headers)
+        assert response.status_code == 422
+        response = requests.get(f"http://{host}:{port}/points/{random_account_id}")
+        assert response.json() == {"DANNON": 900}
+
+    def test_get_account_points_as_of(self, host, port, random_account_id):
+        requests.delete(f"http://{host}:{port}/points/{random_account_id}")
+        transactions = [("DANNON", 1000, "2020-10-30T14:00:00Z"), ("UNILEVER", 200, "2020-10-31T11:00:00Z"),
+                        ("DANNON", -200, "2020-11-02T14:00:00Z")]
+        for payer, points, timestamp in transactions:
+            json_data = json.dumps({"payer": payer, "points": points, "timestamp": timestamp})
+            requests.post(f"http://{host}:{port}/points/{random_account_id}/add", json=json_data)
+        response = requests.get(f"http://{host}:{port}/points/{random_account_id}?as_of=2020-11-01T00:00:00Z")
+        assert response.status_code == 200
+        assert response.json() == {"DANNON": 1000, "UNILEVER": 200}
+        response = requests.get(f"http://{host}:{port}/points/{random_account_id}?as_of=2020-11-02T14:00:00Z")
+        assert response.json() == {"DANNON": 800, "UNILEVER": 200}
+        response = requests.get(f"http://{host}:{port}/points/{random_account_id}?as_of=last-tuesday")
+        assert response.status_code == 400
+
+    def test_get_account_transactions(self, host, port, random_account_id):
+        requests.delete(f"http://{host}:{port}/points/{random_account_id}")
+        transactions = [("DANNON", 1000, "2020-11-02T14:00:00Z"), ("UNILEVER", 200, "2020-10-31T11:00:00Z"),
+                        ("DANNON", -200, "2020-10-31T15:00:00Z"), ("DANNON", 300, "2020-10-31T10:00:00Z")]
+        for payer, points, timestamp in transactions:
+            json_data = json.dumps({"payer": payer, "points": points, "timestamp": timestamp})
+            requests.post(f"http://{host}:{port}/points/{random_account_id}/add", json=json_data)
+        url = f"http://{host}:{port}/points/{random_account_id}/transactions"
+        response = requests.get(url, params={"payer": "DANNON", "limit": 2})
+        assert response.status_code == 200
+        assert response.json()["transactions"] == [
+            {"payer": "DANNON", "points": 300, "timestamp": "2020-10-31T10:00:00Z"},
+            {"payer": "DANNON", "points": -200, "timestamp": "2020-10-31T15:00:00Z"}
+        ]
+        response = requests.get(url, params={"payer": "DANNON", "limit": 2, "cursor": response.json()["next"]})
+        assert response.json() == {"transactions": [{"payer": "DANNON", "points": 1000,
+                                                     "timestamp": "2020-11-02T14:00:00Z"}], "next": None}
+        response = requests.get(url, params={"from": "2020-10-31T11:00:00Z", "to": "2020-11-02T14:00:00Z",
+                                             "format": "ndjson"}, stream=True)
+        assert [json.loads(line)["points"] for line in response.iter_lines()] == [200, -200]
+        response = requests.get(f"http://{host}:{port}/points/missing-{random_account_id}/transactions")
+        assert response.status_code == 404
+
+    def test_get_payers(self, host, port, random_account_id):
+        requests.delete(f"http://{host}:{port}/points/{random_account_id}")
+        payer = f"PAYER {random_account_id}"
+        for points, timestamp in [(1000, "2020-11-02T14:00:00Z"), (-200, "2020-11-02T15:00:00Z")]:
+            json_data = json.dumps({"payer": payer, "points": points, "timestamp": timestamp})
+            requests.post(f"http://{host}:{port}/points/{random_account_id}/add", json=json_data)
+        requests.post(f"http://{host}:{port}/points/{random_account_id}/spend", json=json.dumps({"points": 300}))
+        response = requests.get(f"http://{host}:{port}/payers")
+        assert response.status_code == 200
+        assert response.json()[payer] == {"available": 500, "spent": 500}
+        requests.delete(f"http://{host}:{port}/points/{random_account_id}")
+        assert payer not in requests.get(f"http://{host}:{port}/payers").json()
@@ -0,0 +1,98 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+pytest.importorskip("uvicorn")
+
+logger = logging.getLogger(__name__)
+
+SERVERS = {
+    "flask": [sys.executable, "-m", "flask", "run", "--with-threads", "--host", "127.0.0.1", "--port", "{port}"],
+    "asgi": [sys.executable, "-m", "uvicorn", "app.asgi:app", "--host", "127.0.0.1", "--port", "{port}",
+             "--log-level", "warning", "--no-access-log", "--backlog", "4096"],
+}
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def start_server(name: str, port: int) -> subprocess.Popen:
+    command = [argument.format(port=port) for argument in SERVERS[name]]
+    server = subprocess.Popen(command, env=dict(os.environ, FLASK_APP="app.app"),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError(f"{name} server did not start on port {port}")
+
+
+async def keep_alive_client(port: int, client: int, requests: int, latencies: list):
+    # One client posting adds to its own account with a balance read every tenth request, over a keep-alive
+    # connection when the server allows it. The werkzeug server closes the connection after every response.
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    add = json.dumps({"payer": "DANNON", "points": 10, "timestamp": "2020-11-01T14:00:00Z"}).encode("utf-8")
+    try:
+        for request in range(requests):
+            if request % 10 == 9:
+                head = f"GET /points/client-{client} HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n".encode("ascii")
+            else:
+                head = (f"POST /points/client-{client}/add HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+                        f"Content-Type: application/json\r\nContent-Length: {len(add)}\r\n\r\n").encode("ascii") + add
+            started = time.perf_counter()
+            writer.write(head)
+            headers = await reader.readuntil(b"\r\n\r\n")
+            status_code = int(headers.split(b" ", 2)[1])
+            length = next(int(line.split(b":", 1)[1]) for line in headers.split(b"\r\n")
+                          if line.lower().startswith(b"content-length:"))
+            await reader.readexactly(length)
+            if b"connection: close" in headers.lower():
+                writer.close()
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            latencies.append(time.perf_counter() - started)
+            assert status_code == 200
+    finally:
+        writer.close()
+
+
+async def run_clients(port: int, clients: int, requests_per_client: int) -> (float, list):
+    latencies = []
+    started = time.perf_counter()
+    await asyncio.gather(*(keep_alive_client(port, client, requests_per_client, latencies)
+                           for client in range(clients)))
+    return len(latencies) / (time.perf_counter() - started), sorted(latencies)
+
+
+class TestResource:
+
+    @pytest.mark.parametrize("clients", [16, 256, 1024])
+    def test_asgi_against_threaded_flask(self, clients, benchmark_transactions):
+        requests_per_client = max(benchmark_transactions // 10 // clients, 5)
+        results = {}
+        for name in SERVERS:
+            port = free_port()
+            server = start_server(name, port)
+            try:
+                throughput, latencies = asyncio.run(run_clients(port, clients, requests_per_client))
+            finally:
+                server.terminate()
+                server.wait(timeout=10)
+            results[name] = throughput, latencies[int(len(latencies) * 0.99)]
+        logger.info(f"{clients} keep-alive clients x {requests_per_client} requests: " + ", ".join(
+            f"{name} {throughput:.0f} requests/s p99 {p99 * 1000:.1f} ms"
+            for name, (throughput, p99) in results.items()))
+        assert results["asgi"][0] > results["flask"][0]
@@ -0,0 +1,44 @@
+import datetime
+import logging
+import time
+
+from app.handlers import encode_json, get_points_for_account
+from app.service import PointsService
+
+logger = logging.getLogger(__name__)
+
+START = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def polls_per_second(poll, account_ids, polls: int) -> float:
+    started = time.perf_counter()
+    for poll_number in range(polls):
+        poll(account_ids[poll_number % len(account_ids)])
+    return polls / (time.perf_counter() - started)
+
+
+class TestResource:
+
+    def test_balance_polls(self, benchmark_transactions):
+        service = PointsService()
+        account_ids = [f"account-{account_number}" for account_number in range(1000)]
+        logging.disable(logging.INFO)
+        try:
+            for account_id in account_ids:
+                service.add_transactions(account_id, [(f"PAYER-{payer}", 100, START) for payer in range(20)])
+            etags = {account_id: get_points_for_account(service, account_id)[0].etag for account_id in account_ids}
+            polls = benchmark_transactions
+            # The read path before the cache: copy the balances and encode them on every poll.
+            copied = polls_per_second(lambda account_id: encode_json(service.get_points_balances(account_id)),
+                                      account_ids, polls)
+            cached = polls_per_second(lambda account_id: get_points_for_account(service, account_id),
+                                      account_ids, polls)
+            not_modified = polls_per_second(
+                lambda account_id: get_points_for_account(service, account_id, etags[account_id]), account_ids, polls)
+        finally:
+            logging.disable(logging.NOTSET)
+        logger.info(f"{polls} balance polls of 20 payer accounts: copy and encode {copied:.0f}/s, "
+                    f"cached {cached:.0f}/s ({cached / copied:.1f}x), 304 {not_modified:.0f}/s "
+                    f"({not_modified / copied:.1f}x)")
+        assert cached > copied
+        assert not_modified > copied
@@ -0,0 +1,69 @@
+import datetime
+import logging
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+from app.locks import StripedLocks
+from app.service import PointsService
+
+logger = logging.getLogger(__name__)
+
+START = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class SetdefaultLocks(dict):
+    # The lock scheme before lock striping: a new lock per lookup, kept forever per account id.
+    def __getitem__(self, account_id: str):
+        return self.setdefault(account_id, multiprocessing.Lock())
+
+
+def adds_per_second(service: PointsService, threads: int, adds_per_thread: int, accounts: int) -> float:
+    barrier = threading.Barrier(threads + 1)
+
+    def add(thread: int):
+        barrier.wait()
+        for add_number in range(adds_per_thread):
+            account_id = f"account-{(thread + add_number) % accounts}"
+            service.add_transaction(account_id, "DANNON", 1, START + datetime.timedelta(seconds=add_number))
+
+    workers = [threading.Thread(target=add, args=(thread,)) for thread in range(threads)]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    return threads * adds_per_thread / (time.perf_counter() - started)
+
+
+class TestResource:
+
+    @pytest.mark.parametrize("threads", [1, 8, 64])
+    def test_lock_contention(self, threads, benchmark_transactions):
+        adds_per_thread = max(benchmark_transactions // 10 // threads, 1)
+        legacy_service, striped_service = PointsService(), PointsService()
+        legacy_service.account_locks = SetdefaultLocks()
+        logging.disable(logging.INFO)
+        try:
+            legacy = adds_per_second(legacy_service, threads, adds_per_thread, accounts=16)
+            striped = adds_per_second(striped_service, threads, adds_per_thread, accounts=16)
+        finally:
+            logging.disable(logging.NOTSET)
+        logger.info(f"{threads} threads over 16 accounts: setdefault locks {legacy:.0f} adds/s, "
+                    f"striped locks {striped:.0f} adds/s ({striped / legacy:.2f}x)")
+        assert striped > legacy
+
+    def test_churned_accounts_do_not_grow_locks(self):
+        service = PointsService()
+        logging.disable(logging.INFO)
+        try:
+            for account_number in range(5000):
+                service.add_transaction(f"churned-{account_number}", "DANNON", 1, START)
+                service.remove_account(f"churned-{account_number}")
+        finally:
+            logging.disable(logging.NOTSET)
+        assert len(service.account_locks) == StripedLocks.STRIPES
+        assert service.get_account_ids() == []
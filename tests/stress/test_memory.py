@@ -0,0 +1,71 @@
+import datetime
+import logging
+import random
+import tracemalloc
+
+import pytest
+
+from app.model import Account, Transaction
+from app.service import PointsService
+
+logger = logging.getLogger(__name__)
+
+PAYERS = ["DANNON", "UNILEVER", "MILLER COORS", "KRAFT"]
+
+
+class DictTransaction:
+    # The transaction layout before the columnar ledger: one object with a __dict__ per transaction.
+    def __init__(self, payer: str, points: int, timestamp: datetime.datetime):
+        self.payer = payer
+        self.points = points
+        self.timestamp = timestamp
+
+    def __lt__(self, other):
+        return self.timestamp < other.timestamp
+
+
+def random_transactions(count: int):
+    generator = random.Random(count)
+    start = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    for _ in range(count):
+        # Every parsed request has its own payer string and datetime objects.
+        payer = "".join(generator.choice(PAYERS))
+        yield payer, generator.randint(1, 1000), start + datetime.timedelta(seconds=generator.randint(0, 10 ** 8))
+
+
+def traced_bytes(build) -> int:
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        retained = build()
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del retained
+    return after - before
+
+
+class TestResource:
+
+    @pytest.mark.parametrize("transactions", [50000])
+    def test_bytes_per_transaction(self, transactions):
+        # Inputs are generated inside the traced builds so each layout is charged for what it keeps of them.
+        def build_dict_ledger():
+            return sorted(DictTransaction(*transaction) for transaction in random_transactions(transactions))
+
+        def build_columnar_ledger():
+            service = PointsService()
+            account = Account("memory")
+            for payer, points, timestamp in random_transactions(transactions):
+                service._add_transaction(account, Transaction(payer, points, timestamp))
+            return account
+
+        logging.disable(logging.INFO)
+        try:
+            dict_bytes = traced_bytes(build_dict_ledger) / transactions
+            columnar_bytes = traced_bytes(build_columnar_ledger) / transactions
+        finally:
+            logging.disable(logging.NOTSET)
+        logger.info(f"Bytes per transaction for {transactions} transactions: dict objects {dict_bytes:.1f}, "
+                    f"columnar ledger {columnar_bytes:.1f} ({dict_bytes / columnar_bytes:.1f}x smaller)")
+        assert columnar_bytes * 3 < dict_bytes
@@ -0,0 +1,76 @@
+import datetime
+import logging
+import random
+import threading
+import time
+
+from app.model import Transaction
+from app.persistence import Persistence
+
+logger = logging.getLogger(__name__)
+
+START = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+PAYERS = ["DANNON", "UNILEVER", "MILLER COORS", "KRAFT"]
+
+
+class TestResource:
+
+    def test_journaled_write_throughput(self, tmp_path, benchmark_transactions):
+        threads = 64
+        writes_per_thread = max(benchmark_transactions // 10 // threads, 1)
+        persistence = Persistence(str(tmp_path), commit_latency=0.002)
+        service = persistence.recover()
+
+        def write(thread: int):
+            for write_number in range(writes_per_thread):
+                service.add_transaction(f"account-{thread}", PAYERS[write_number % 4], 10,
+                                        START + datetime.timedelta(seconds=write_number))
+
+        workers = [threading.Thread(target=write, args=(thread,)) for thread in range(threads)]
+        logging.disable(logging.INFO)
+        try:
+            started = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - started
+        finally:
+            logging.disable(logging.NOTSET)
+            persistence.close()
+        writes = threads * writes_per_thread
+        logger.info(f"Journaled {writes} adds from {threads} threads with fsync group commit in {elapsed:.2f}s: "
+                    f"{writes / elapsed:.0f} adds/s")
+
+    def test_recovery_time(self, tmp_path, benchmark_transactions):
+        generator = random.Random(benchmark_transactions)
+        persistence = Persistence(str(tmp_path), commit_latency=0)
+        persistence.recover()
+        started = time.perf_counter()
+        for transaction_number in range(benchmark_transactions):
+            timestamp = START + datetime.timedelta(seconds=generator.randint(0, 10 ** 8))
+            transaction = Transaction(generator.choice(PAYERS), generator.randint(1, 1000), timestamp)
+            persistence.journal.append_transactions(f"account-{transaction_number % 1000}", [transaction])
+        persistence.close()
+        logger.info(f"Appended {benchmark_transactions} journal records in {time.perf_counter() - started:.2f}s")
+
+        logging.disable(logging.INFO)
+        try:
+            persistence = Persistence(str(tmp_path))
+            started = time.perf_counter()
+            service = persistence.recover()
+            replay_seconds = time.perf_counter() - started
+            balances = {account_id: service.get_points_balances(account_id) for account_id in service.get_account_ids()}
+            persistence.snapshot()
+            persistence.close()
+
+            started = time.perf_counter()
+            service = Persistence(str(tmp_path)).recover()
+            snapshot_seconds = time.perf_counter() - started
+            service.journal.close()
+        finally:
+            logging.disable(logging.NOTSET)
+        assert {account_id: service.get_points_balances(account_id)
+                for account_id in service.get_account_ids()} == balances
+        logger.info(f"Recovered {benchmark_transactions} transactions by write ahead log replay in "
+                    f"{replay_seconds:.2f}s and from a snapshot in {snapshot_seconds:.2f}s")
@@ -0,0 +1,58 @@
+import datetime
+import logging
+import os
+import threading
+import time
+
+import pytest
+
+from app.service import PointsService
+from app.sharding import ShardedPointsService
+
+logger = logging.getLogger(__name__)
+
+START = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def mixed_operations_per_second(service, threads: int, operations_per_thread: int) -> float:
+    barrier = threading.Barrier(threads + 1)
+
+    def operate(thread: int):
+        account_id = f"account-{thread}"
+        barrier.wait()
+        for operation in range(operations_per_thread):
+            # Batches of adds with a spend every tenth call, spread over one account per thread.
+            if operation % 10 == 9:
+                service.spend_points(account_id, 50)
+            else:
+                service.add_transactions(account_id, [("DANNON", 10, START + datetime.timedelta(seconds=second))
+                                                      for second in range(20)])
+
+    workers = [threading.Thread(target=operate, args=(thread,)) for thread in range(threads)]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    return threads * operations_per_thread / (time.perf_counter() - started)
+
+
+class TestResource:
+
+    @pytest.mark.parametrize("shards", sorted({1, 2, os.cpu_count() or 1}))
+    def test_sharded_throughput(self, shards, benchmark_transactions):
+        threads = 4 * shards
+        operations_per_thread = max(benchmark_transactions // 100 // threads, 10)
+        logging.disable(logging.INFO)
+        try:
+            in_process = mixed_operations_per_second(PointsService(), threads, operations_per_thread)
+            sharded_service = ShardedPointsService(shards)
+            try:
+                sharded = mixed_operations_per_second(sharded_service, threads, operations_per_thread)
+            finally:
+                sharded_service.close()
+        finally:
+            logging.disable(logging.NOTSET)
+        logger.info(f"{shards} shards on {os.cpu_count()} cpus with {threads} threads: in process "
+                    f"{in_process:.0f} operations/s, sharded {sharded:.0f} operations/s")
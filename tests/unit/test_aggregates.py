@@ -0,0 +1,89 @@
+import datetime
+import logging
+import random
+import threading
+
+import pytest
+
+from app.persistence import Persistence
+from app.service import PointsService
+from app.tiering import TieredAccountStore
+
+logger = logging.getLogger(__name__)
+
+START = datetime.datetime(2020, 11, 1, tzinfo=datetime.timezone.utc)
+PAYERS = ["DANNON", "UNILEVER", "MILLER COORS", "KRAFT"]
+
+
+def scanned_totals(service: PointsService):
+    # Payer totals summed from every account, as GET /points would have to.
+    totals = {}
+    for account_id in service.get_account_ids():
+        account = service.get_account(account_id)
+        for payer, available in account.available_points_by_payer.items():
+            total = totals.setdefault(payer, {"available": 0, "spent": 0})
+            total["available"] += available
+            total["spent"] += account.spent_points_by_payer[payer]
+    return {payer: total for payer, total in sorted(totals.items()) if total["available"] or total["spent"]}
+
+
+def operate(service: PointsService, generator: random.Random, steps: int):
+    for _ in range(steps):
+        account_id = f"account-{generator.randrange(6)}"
+        operation = generator.random()
+        timestamp = START + datetime.timedelta(minutes=generator.randint(-500, 500))
+        payer = generator.choice(PAYERS)
+        try:
+            if operation < 0.4:
+                service.add_transaction(account_id, payer, generator.randint(-20, 50) or 1, timestamp)
+            elif operation < 0.5:
+                service.add_transactions(account_id, [(payer, 10, timestamp), (payer, -5, timestamp)])
+            elif operation < 0.55:
+                service.import_transactions([(account_id, [(payer, 30, timestamp)])], audit=False)
+            elif operation < 0.85:
+                service.spend_points(account_id, generator.randint(1, 60))
+            elif operation < 0.9:
+                service.spend_points_batch([(account_id, [10, 20])])
+            else:
+                service.remove_account(account_id)
+        except Exception as exception:
+            logger.debug("Operation failed with %r", exception)
+
+
+class TestResource:
+
+    @pytest.mark.parametrize("seed", range(3))
+    def test_totals_match_accounts(self, seed):
+        service = PointsService(compaction_threshold=8)
+        operate(service, random.Random(seed), 500)
+        assert service.get_payer_totals() == scanned_totals(service)
+
+    def test_totals_under_concurrent_writers(self):
+        service = PointsService()
+        threads = [threading.Thread(target=operate, args=(service, random.Random(thread), 300)) for thread in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert service.get_payer_totals() == scanned_totals(service)
+
+    def test_totals_are_recovered(self, tmp_path):
+        persistence = Persistence(str(tmp_path / "data"), commit_latency=0.001)
+        service = persistence.recover()
+        generator = random.Random(0)
+        operate(service, generator, 200)
+        persistence.snapshot()
+        operate(service, generator, 200)
+        expected = service.get_payer_totals()
+        assert expected == scanned_totals(service)
+        persistence.close()
+
+        store = TieredAccountStore(str(tmp_path / "cold.sqlite"), capacity=2)
+        recovered = Persistence(str(tmp_path / "data"), account_store=store)
+        recovered_service = recovered.recover()
+        assert recovered_service.get_payer_totals() == expected
+        # Spilling and faulting accounts back in leaves the totals as they are.
+        operate(recovered_service, generator, 100)
+        assert recovered_service.get_payer_totals() == scanned_totals(recovered_service)
+        recovered.close()
+        store.close()
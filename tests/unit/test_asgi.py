@@ -0,0 +1,166 @@
+import asyncio
+import json
+import logging
+
+import pytest
+
+import app.app
+from app import handlers
+from app.asgi import PointsApplication
+from app.idempotency import IdempotencyStore
+from app.service import PointsService
+
+logger = logging.getLogger(__name__)
+
+
+async def asgi_exchange(application: PointsApplication, method: str, path: str, body=None, headers=()):
+    # Returns the response start message and the joined response body.
+    messages = [{"type": "http.request", "body": b"" if body is None else body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    path, _, query_string = path.partition("?")
+    scope = {"type": "http", "method": method, "path": path, "query_string": query_string.encode("latin-1"),
+             "scheme": "http", "client": ("127.0.0.1", 50000), "headers": list(headers)}
+    await application(scope, receive, send)
+    start, *response_bodies = sent
+    return start, b"".join(response_body["body"] for response_body in response_bodies)
+
+
+async def asgi_request(application: PointsApplication, method: str, path: str, body=None):
+    start, response_body = await asgi_exchange(application, method, path, body)
+    content_type = dict(start["headers"])[b"content-type"].decode("ascii")
+    return start["status"], decode_body(content_type, response_body)
+
+
+def decode_body(content_type: str, body: bytes):
+    # NDJSON bodies decode to the list of their lines' values.
+    if content_type == "application/x-ndjson":
+        return [json.loads(line) for line in body.splitlines()]
+    return json.loads(body) if body else None
+
+
+def call(application: PointsApplication, method: str, path: str, data=None):
+    body = None if data is None else json.dumps(data).encode("utf-8")
+    return asyncio.run(asgi_request(application, method, path, body))
+
+
+@pytest.fixture
+def flask_client(monkeypatch, points_service):
+    monkeypatch.setattr(app.app, "points_service", points_service)
+    return app.app.app.test_client()
+
+
+class TestResource:
+
+    def test_routes_match_flask(self, flask_client, random_account_id):
+        application = PointsApplication(PointsService())
+        requests = [
+            ("POST", f"/points/{random_account_id}/add", {"payer": "DANNON", "points": 1000,
+                                                          "timestamp": "2020-11-02T14:00:00Z"}),
+            ("POST", f"/points/{random_account_id}/add", {"payer": "UNILEVER", "points": 200,
+                                                          "timestamp": "2020-10-31T11:00:00Z"}),
+            ("POST", f"/points/{random_account_id}/add", {"payer": "DANNON", "points": 0,
+                                                          "timestamp": "2020-10-31T11:00:00Z"}),
+            ("POST", f"/points/{random_account_id}/add/batch", [{"payer": "MILLER COORS", "points": 10000,
+                                                                 "timestamp": "2020-11-01T14:00:00Z"},
+                                                                {"payer": "KRAFT"}]),
+            ("POST", f"/points/{random_account_id}/spend", {"points": 5000}),
+            ("POST", f"/points/{random_account_id}/spend", {"points": 50000}),
+            ("POST", f"/points/{random_account_id}/spend", {"points": "many"}),
+            ("POST", "/points/missing/spend", {"points": 10}),
+            ("POST", "/points/spend/batch", [{"account_id": random_account_id, "points": 100},
+                                             {"account_id": "missing", "points": 10},
+                                             {"account_id": random_account_id, "points": 50000},
+                                             {"points": 10}]),
+            ("POST", "/points/spend/batch", {"account_id": random_account_id, "points": 100}),
+            ("GET", f"/points/{random_account_id}", None),
+            ("GET", f"/points/{random_account_id}?as_of=2020-11-01T14:00:00Z", None),
+            ("GET", f"/points/{random_account_id}?as_of=yesterday", None),
+            ("GET", "/points/missing?as_of=2020-11-01T14:00:00Z", None),
+            ("GET", f"/points/{random_account_id}/transactions?limit=2&payer=DANNON", None),
+            ("GET", f"/points/{random_account_id}/transactions?from=2020-11-01T00:00:00Z&to=2021-01-01T00:00:00Z"
+                    f"&format=ndjson", None),
+            ("GET", f"/points/{random_account_id}/transactions?cursor=yesterday", None),
+            ("GET", "/points/missing/transactions", None),
+            ("GET", "/points/missing", None),
+            ("GET", "/points", None),
+            ("GET", "/points?limit=1", None),
+            ("GET", f"/points?after={random_account_id}", None),
+            ("GET", "/points?limit=0", None),
+            ("GET", "/points?format=ndjson", None),
+            ("GET", "/points?format=xml", None),
+            ("GET", "/payers", None),
+            ("DELETE", "/points/missing", None),
+            ("DELETE", f"/points/{random_account_id}", None),
+            ("DELETE", "/points", None),
+        ]
+        for method, path, data in requests:
+            flask_response = flask_client.open(path, method=method, json=data)
+            expected = (flask_response.status_code, decode_body(flask_response.mimetype, flask_response.data))
+            assert call(application, method, path, data) == expected, f"{method} {path}"
+
+    def test_etags(self, random_account_id):
+        application = PointsApplication(PointsService())
+        call(application, "POST", f"/points/{random_account_id}/add",
+             {"payer": "DANNON", "points": 1000, "timestamp": "2020-11-02T14:00:00Z"})
+
+        def get(path: str, if_none_match: bytes = None):
+            headers = [(b"if-none-match", if_none_match)] if if_none_match else []
+            start, body = asyncio.run(asgi_exchange(application, "GET", path, headers=headers))
+            return start["status"], dict(start["headers"]).get(b"etag"), body
+
+        for path in [f"/points/{random_account_id}", f"/points/{random_account_id}?cache=1", "/points"]:
+            status_code, etag, body = get(path)
+            assert status_code == 200 and etag and body
+            assert get(path, etag) == (304, etag, b"")
+            call(application, "POST", f"/points/{random_account_id}/spend", {"points": 1})
+            status_code, changed_etag, _ = get(path, etag)
+            assert status_code == 200 and changed_etag != etag
+
+    def test_unknown_routes_and_bad_json(self, random_account_id):
+        application = PointsApplication(PointsService())
+        assert call(application, "GET", "/accounts")[0] == 404
+        assert call(application, "GET", f"/points/{random_account_id}/spend")[0] == 405
+        status_code, response = asyncio.run(asgi_request(application, "POST", f"/points/{random_account_id}/add",
+                                                         b"{not json"))
+        assert (status_code, response) == (400, {"message": "Bad Request", "status_code": 400})
+
+    @pytest.mark.parametrize("offload", [False, True])
+    def test_concurrent_mutations_on_one_account(self, random_account_id, offload):
+        application = PointsApplication(PointsService(), offload=offload)
+        add = json.dumps({"payer": "DANNON", "points": 10, "timestamp": "2020-11-01T14:00:00Z"}).encode("utf-8")
+        spend = json.dumps({"points": 5}).encode("utf-8")
+
+        async def run():
+            await asyncio.gather(*(asgi_request(application, "POST", f"/points/{random_account_id}/add", add)
+                                   for _ in range(200)))
+            return await asyncio.gather(*(asgi_request(application, "POST", f"/points/{random_account_id}/spend",
+                                                       spend) for _ in range(500)))
+
+        spends = asyncio.run(run())
+        assert [status_code for status_code, _ in spends].count(200) == 200 * 10 // 5
+        assert call(application, "GET", f"/points/{random_account_id}") == (200, {"DANNON": 0})
+
+    @pytest.mark.parametrize("offload", [False, True])
+    def test_concurrent_retries_with_idempotency_key(self, monkeypatch, random_account_id, offload):
+        monkeypatch.setattr(handlers, "IDEMPOTENCY", IdempotencyStore())
+        application = PointsApplication(PointsService(), offload=offload)
+        call(application, "POST", f"/points/{random_account_id}/add",
+             {"payer": "DANNON", "points": 1000, "timestamp": "2020-11-01T14:00:00Z"})
+        spend = json.dumps({"points": 5}).encode("utf-8")
+
+        async def run():
+            return await asyncio.gather(*(asgi_exchange(application, "POST", f"/points/{random_account_id}/spend",
+                                                        spend, [(b"idempotency-key", b"retried")])
+                                          for _ in range(20)))
+
+        responses = asyncio.run(run())
+        assert {(start["status"], body) for start, body in responses} == \
+            {(200, b'[{"payer":"DANNON","points":-5}]\n')}
+        assert call(application, "GET", f"/points/{random_account_id}") == (200, {"DANNON": 995})
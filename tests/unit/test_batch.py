@@ -0,0 +1,44 @@
+import datetime
+import logging
+import random
+
+import pytest
+
+from app.ledger import Ledger
+from app.service import PointsService
+
+logger = logging.getLogger(__name__)
+
+PAYERS = ["DANNON", "UNILEVER", "MILLER COORS", "KRAFT"]
+
+
+def random_batch(generator: random.Random, size: int):
+    start = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    return [(generator.choice(PAYERS), generator.choice([-1, 1, 1, 1]) * generator.randint(1, 500),
+             start + datetime.timedelta(hours=generator.randint(0, 200))) for _ in range(size)]
+
+
+class TestResource:
+
+    @pytest.mark.parametrize("seed", range(10))
+    def test_batch_matches_single_adds(self, random_account_id, monkeypatch, seed):
+        monkeypatch.setattr(Ledger, "BLOCK_SIZE", 4)
+        generator = random.Random(seed)
+        batched, single = PointsService(), PointsService()
+        for batch_size in (1, 40, 3, 200, 2):
+            batch = random_batch(generator, batch_size)
+            transactions = batched.add_transactions(random_account_id, batch)
+            assert [(transaction.payer, transaction.points, transaction.timestamp)
+                    for transaction in transactions] == batch
+            for payer, points, timestamp in batch:
+                single.add_transaction(random_account_id, payer, points, timestamp)
+            assert batched.get_points_balances(random_account_id) == single.get_points_balances(random_account_id)
+            # Spend timestamps differ between the services, so ledgers are compared by order of sequences.
+            assert [entry[1:] for entry in batched.get_account(random_account_id).timestamp_sorted_transactions] == \
+                [entry[1:] for entry in single.get_account(random_account_id).timestamp_sorted_transactions]
+            spendable = sum(max(points, 0) for points in single.get_points_balances(random_account_id).values())
+            spend = generator.randint(0, spendable)
+            assert [(transaction.payer, transaction.points)
+                    for transaction in batched.spend_points(random_account_id, spend)] == \
+                [(transaction.payer, transaction.points)
+                 for transaction in single.spend_points(random_account_id, spend)]
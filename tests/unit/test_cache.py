@@ -0,0 +1,94 @@
+import datetime
+import json
+import logging
+import threading
+
+import pytest
+
+from app.cache import EncodedBalanceCache
+from app.handlers import etag_matches
+
+logger = logging.getLogger(__name__)
+
+START = datetime.datetime(2020, 11, 1, tzinfo=datetime.timezone.utc)
+
+
+class TestResource:
+
+    def test_cache_is_versioned_and_bounded(self):
+        cache = EncodedBalanceCache(capacity=2)
+        cache.put("a", 1, b"{}")
+        assert cache.get("a", 1) == b"{}"
+        assert cache.get("a", 2) is None
+        cache.put("a", 3, b'{"DANNON":1}')
+        cache.put("a", 2, b"stale")
+        assert cache.get("a", 3) == b'{"DANNON":1}'
+        cache.put("b", 1, b"{}")
+        cache.get("a", 3)
+        cache.put("c", 1, b"{}")
+        assert len(cache) == 2
+        assert cache.get("b", 1) is None
+        assert cache.get("a", 3) is not None
+        cache.discard("a")
+        assert cache.get("a", 3) is None
+
+    def test_versions_follow_balance_changes(self, points_service, random_account_id):
+        points_service.add_transaction(random_account_id, "DANNON", 300, START)
+        version, encoded = points_service.get_encoded_points_balances(random_account_id)
+        assert json.loads(encoded) == {"DANNON": 300}
+        assert points_service.get_encoded_points_balances(random_account_id) == (version, encoded)
+        assert points_service.balance_cache.hits == 1
+
+        points_service.spend_points(random_account_id, 100)
+        spent_version, encoded = points_service.get_encoded_points_balances(random_account_id)
+        assert spent_version > version
+        assert json.loads(encoded) == {"DANNON": 200}
+        points_service.add_transactions(random_account_id, [("UNILEVER", 50, START)])
+        assert points_service.get_points_balances_version(random_account_id) > spent_version
+        assert points_service.get_all_encoded_points_balances() == [
+            (random_account_id, *points_service.get_encoded_points_balances(random_account_id))
+        ]
+
+        # A recreated account never reuses the versions of the one it replaces.
+        points_service.remove_account(random_account_id)
+        assert points_service.get_encoded_points_balances(random_account_id) is None
+        points_service.add_transaction(random_account_id, "DANNON", 300, START)
+        assert points_service.get_points_balances_version(random_account_id) > spent_version
+
+    def test_reads_take_published_snapshots(self, points_service, random_account_id):
+        # Spends across several lots while balances are read: every read is a whole spend's balances with their own
+        # version, and no read waits on the account lock.
+        points_service.add_transactions(random_account_id, [(payer, 10, START + datetime.timedelta(minutes=minute))
+                                                            for minute, payer in enumerate(["DANNON", "KRAFT"] * 500)])
+        stopping = threading.Event()
+
+        def spend():
+            for _ in range(400):
+                points_service.spend_points(random_account_id, 25)
+            stopping.set()
+
+        spender = threading.Thread(target=spend)
+        spender.start()
+        reads = 0
+        while not stopping.is_set() or reads == 0:
+            version, encoded = points_service.get_encoded_points_balances(random_account_id)
+            assert (10000 - sum(json.loads(encoded).values())) % 25 == 0
+            assert sum(points_service.get_points_balances(random_account_id).values()) % 25 == 0
+            reads += 1
+        spender.join()
+        assert points_service.get_points_balances(random_account_id) == {"DANNON": 0, "KRAFT": 0}
+
+        snapshot = points_service.get_account(random_account_id).balances
+        with pytest.raises(TypeError):
+            snapshot.balances["DANNON"] = 10
+        with points_service.account_locks[random_account_id]:
+            assert points_service.get_points_balances_version(random_account_id) == snapshot.version
+            assert points_service.get_points_balances(random_account_id) == {"DANNON": 0, "KRAFT": 0}
+
+    def test_etag_matches(self):
+        assert etag_matches('"1f"', '"1f"')
+        assert etag_matches('W/"1f"', '"1f"')
+        assert etag_matches('"2a", "1f"', '"1f"')
+        assert etag_matches("*", '"1f"')
+        assert not etag_matches('"2a"', '"1f"')
+        assert not etag_matches(None, '"1f"')
@@ -0,0 +1,170 @@
+import datetime
+import logging
+import random
+
+import pytest
+
+import app.ledger
+from app.ledger import Ledger
+from app.model import NotEnoughPointsException, to_epoch_microseconds
+from app.service import PointsService
+
+logger = logging.getLogger(__name__)
+
+START = datetime.datetime(2020, 11, 1, tzinfo=datetime.timezone.utc)
+PAYERS = ["DANNON", "UNILEVER", "MILLER COORS", "KRAFT"]
+
+
+def history(service: PointsService, account_id: str):
+    return [(transaction.payer, transaction.points) for transaction in service.get_account(account_id).transactions()]
+
+
+class TestResource:
+
+    @pytest.mark.parametrize("seed", range(5))
+    def test_compaction_matches_uncompacted(self, monkeypatch, seed):
+        # The same random adds, backdated adds, negative adds, batches and spends against a service compacting at a
+        # tiny threshold and one never compacting.
+        monkeypatch.setattr(Ledger, "BLOCK_SIZE", 4)
+        generator = random.Random(seed)
+        compacted = PointsService(compaction_threshold=8)
+        uncompacted = PointsService()
+        for service in (compacted, uncompacted):
+            service.add_transaction("a", "DANNON", 100, START)
+        for step in range(600):
+            operation = generator.random()
+            # Every 10th add is backdated far enough to usually land behind the compaction horizon.
+            minutes = step + generator.randint(-600 if step % 10 == 0 else -30, 30)
+            timestamp = START + datetime.timedelta(minutes=minutes)
+            payer = generator.choice(PAYERS)
+            points = generator.randint(1, 50)
+            results = []
+            for service in (compacted, uncompacted):
+                try:
+                    if operation < 0.55:
+                        service.add_transaction("a", payer, points, timestamp)
+                        results.append(None)
+                    elif operation < 0.65:
+                        service.add_transactions("a", [(payer, points, timestamp), (PAYERS[step % 4], 5, timestamp)])
+                        results.append(None)
+                    elif operation < 0.7:
+                        if service.get_points_balances("a").get(payer, 0) >= 5:
+                            service.add_transaction("a", payer, -5, timestamp)
+                        results.append(None)
+                    else:
+                        results.append([(transaction.payer, transaction.points)
+                                        for transaction in service.spend_points("a", points)])
+                except NotEnoughPointsException:
+                    results.append("not enough")
+            assert results[0] == results[1]
+            assert compacted.get_points_balances("a") == uncompacted.get_points_balances("a")
+            if step % 100 == 99:
+                compacted.compact_accounts()
+        account = compacted.get_account("a")
+        # Every compaction merges into the one archive chunk.
+        assert len(account.archive) == 1 and len(account.archive[0]) == account.archived_entries
+        assert len(account.timestamp_sorted_transactions) < \
+            len(uncompacted.get_account("a").timestamp_sorted_transactions)
+        assert history(compacted, "a") == history(uncompacted, "a")
+        # Point-in-time balances count archived entries too.
+        for minutes in range(-700, 700, 7):
+            as_of = START + datetime.timedelta(minutes=minutes)
+            assert compacted.get_points_balances_as_of("a", as_of) == \
+                uncompacted.get_points_balances_as_of("a", as_of)
+        assert compacted.get_points_balances_as_of("a", datetime.datetime.now(datetime.timezone.utc)) == \
+            compacted.get_points_balances("a")
+        # Transaction history pages read archived entries too.
+        for payer in [None, "KRAFT"]:
+            key = (to_epoch_microseconds(START - datetime.timedelta(minutes=300)), 0)
+            end = to_epoch_microseconds(START + datetime.timedelta(minutes=300))
+            assert compacted.get_transactions_page("a", key, end, payer, 10000) == \
+                uncompacted.get_transactions_page("a", key, end, payer, 10000)
+
+    def test_backdated_add_restores_lots(self):
+        service = PointsService()
+        service.add_transaction("a", "DANNON", 100, START)
+        service.add_transaction("a", "UNILEVER", 100, START + datetime.timedelta(days=2))
+        service.spend_points("a", 100)
+        account = service.get_account("a")
+        assert service.compact_accounts() == 2
+        assert account.compaction_horizon is not None
+        assert [(timestamp, points) for timestamp, _, points, _ in account.timestamp_sorted_transactions] == \
+            [(timestamp, 100) for timestamp, _, _, _ in account.lots_by_payer["UNILEVER"].lots]
+
+        # Lands behind the spent DANNON lot, so the lot it now precedes has to be back for FIFO order. The spend stays
+        # archived.
+        service.add_transaction("a", "DANNON", 50, START - datetime.timedelta(days=1))
+        assert len(account.archive) == 1 and account.archived_entries == 1
+        assert [(payer, points) for _, _, points, payer in account.timestamp_sorted_transactions] == \
+            [(0, 50), (0, 100), (1, 100)]
+        assert [(transaction.payer, transaction.points) for transaction in service.spend_points("a", 100)] == \
+            [("DANNON", -50), ("UNILEVER", -50)]
+        assert service.get_points_balances("a") == {"DANNON": 0, "UNILEVER": 50}
+
+    def test_as_of_decompresses_one_archive_block(self, monkeypatch):
+        # Hundreds of compactions still leave one chunk to search, and a point in time inside it reads one block.
+        monkeypatch.setattr(Ledger, "BLOCK_SIZE", 4)
+        service = PointsService(compaction_threshold=8)
+        for minute in range(400):
+            service.add_transaction("a", PAYERS[minute % len(PAYERS)], 10, START + datetime.timedelta(minutes=minute))
+            service.spend_points("a", 5)
+            service.compact_accounts()
+        account = service.get_account("a")
+        assert len(account.archive) == 1 and len(account.archive[0].blocks) > 100
+
+        decompressed = []
+        decompress_columns = app.ledger.decompress_columns
+        monkeypatch.setattr(app.ledger, "decompress_columns",
+                            lambda chunk: decompressed.append(chunk) or decompress_columns(chunk))
+        balances = service.get_points_balances_as_of("a", START + datetime.timedelta(minutes=200, seconds=30))
+        assert len(decompressed) <= 1
+        # The spends are recorded at the current time, after every add.
+        assert balances == {payer: 10 * len(range(index, 201, len(PAYERS))) for index, payer in enumerate(PAYERS)}
+
+    def test_history_page_decompresses_blocks_it_spans(self, monkeypatch):
+        # A page inside the archive reads from the block its key falls in, and one after it reads no archive block.
+        monkeypatch.setattr(Ledger, "BLOCK_SIZE", 4)
+        service = PointsService(compaction_threshold=8)
+        for minute in range(400):
+            service.add_transaction("a", PAYERS[minute % len(PAYERS)], 10, START + datetime.timedelta(minutes=minute))
+            service.spend_points("a", 10)
+            service.compact_accounts()
+        archive = service.get_account("a").archive[0]
+        assert len(archive.blocks) > 100
+
+        decompressed = []
+        decompress_columns = app.ledger.decompress_columns
+        monkeypatch.setattr(app.ledger, "decompress_columns",
+                            lambda chunk: decompressed.append(chunk) or decompress_columns(chunk))
+        key = (to_epoch_microseconds(START + datetime.timedelta(minutes=200)), 0)
+        page = service.get_transactions_page("a", key, None, None, 10)
+        assert [points for _, _, points, _ in page] == [10] * 10
+        assert page[0][0] == key[0] and len(decompressed) <= 10 // 4 + 2
+
+        decompressed.clear()
+        assert service.get_transactions_page("a", (archive.maxes[-1] + 1, 0), None, None, 10) == []
+        assert decompressed == []
+
+    def test_backdated_add_restores_only_newest_lots(self, monkeypatch):
+        # Each payer has 100 spent lots of 10 points archived. A backdated lot of 25 points brings back the three
+        # newest lots of its own payer and leaves the rest archived, without compacting again.
+        monkeypatch.setattr(Ledger, "BLOCK_SIZE", 8)
+        service = PointsService(compaction_threshold=1000)
+        service.add_transactions("a", [(PAYERS[minute % 2], 10, START + datetime.timedelta(minutes=minute))
+                                       for minute in range(200)])
+        service.add_transaction("a", "KRAFT", 10, START + datetime.timedelta(days=1))
+        service.spend_points("a", 2000)
+        account = service.get_account("a")
+        archived = service.compact_accounts()
+        assert archived == account.archived_entries and len(account.timestamp_sorted_transactions) == 1
+        compacted_length = account.compacted_length
+
+        service.add_transaction("a", "UNILEVER", 25, START - datetime.timedelta(minutes=1))
+        assert account.archived_entries == archived - 3 and account.compacted_length == compacted_length
+        assert [(minute, payer) for minute, _, _, payer in account.timestamp_sorted_transactions] == \
+            [(to_epoch_microseconds(START - datetime.timedelta(minutes=1)), 1)] + \
+            [(to_epoch_microseconds(START + datetime.timedelta(minutes=minute)), 1) for minute in (195, 197, 199)] + \
+            [(to_epoch_microseconds(START + datetime.timedelta(days=1)), 2)]
+        # The newest 25 points of the payer's lots are spendable again, FIFO from the middle of the oldest one.
+        assert [(transaction.payer, transaction.points) for transaction in service.spend_points("a", 30)] == \
+            [("UNILEVER", -5), ("UNILEVER", -10), ("UNILEVER", -10), ("KRAFT", -5)]
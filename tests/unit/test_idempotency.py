@@ -0,0 +1,89 @@
+import logging
+import threading
+import time
+
+import pytest
+
+from app import handlers
+from app.idempotency import IdempotencyConflict, IdempotencyStore
+from app.service import PointsService
+
+logger = logging.getLogger(__name__)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def idempotency_store(monkeypatch):
+    store = IdempotencyStore()
+    monkeypatch.setattr(handlers, "IDEMPOTENCY", store)
+    return store
+
+
+class TestResource:
+
+    def test_store_expires_and_evicts(self):
+        clock = FakeClock()
+        store = IdempotencyStore(max_bytes=3 * (IdempotencyStore.ENTRY_OVERHEAD + 100), ttl=10.0, clock=clock)
+        scopes = [("spend_points", "account", f"key-{index}") for index in range(4)]
+        for scope in scopes[:3]:
+            assert store.claim(scope, b"request") is None
+            store.complete(scope, b"request", b"response", 200)
+        assert store.get(scopes[0], b"request").body == b"response"
+        with pytest.raises(IdempotencyConflict):
+            store.get(scopes[0], b"other request")
+
+        # The fourth response evicts the least recently used, which is the second since the first was just read.
+        store.claim(scopes[3], b"request")
+        store.complete(scopes[3], b"request", b"response", 200)
+        assert [store.get(scope, b"request") is not None for scope in scopes] == [True, False, True, True]
+
+        clock.now = 10.0
+        assert store.get(scopes[0], b"request") is None
+        assert store.claim(scopes[0], b"request") is None
+
+    def test_duplicates_wait_for_the_request_in_flight(self):
+        store = IdempotencyStore()
+        scope = ("add_points", "account", "key")
+        assert store.claim(scope, b"request") is None
+        with pytest.raises(IdempotencyConflict):
+            store.claim(scope, b"other request")
+        responses = []
+        waiters = [threading.Thread(target=lambda: responses.append(store.claim(scope, b"request")))
+                   for _ in range(4)]
+        for waiter in waiters:
+            waiter.start()
+        time.sleep(0.05)
+        assert responses == []
+        store.complete(scope, b"request", b"response", 200)
+        for waiter in waiters:
+            waiter.join()
+        assert [response.body for response in responses] == [b"response"] * 4
+
+        # A released scope goes to the next claim.
+        released = ("add_points", "account", "released")
+        store.claim(released, b"request")
+        store.release(released)
+        assert store.claim(released, b"request") is None
+
+    def test_retries_are_not_applied_again(self, idempotency_store, random_account_id):
+        service = PointsService()
+        add = {"payer": "DANNON", "points": 1000, "timestamp": "2020-11-02T14:00:00Z"}
+        for _ in range(2):
+            assert handlers.add_points(service, random_account_id, add, "add-1")[1] == 200
+        first = handlers.spend_points(service, random_account_id, {"points": 300}, "spend-1")
+        retried = handlers.spend_points(service, random_account_id, {"points": 300}, "spend-1")
+        assert first[1] == retried[1] == 200
+        assert first[0].body == retried[0].body == b'[{"payer":"DANNON","points":-300}]\n'
+        assert service.get_points_balances(random_account_id) == {"DANNON": 700}
+
+        assert handlers.spend_points(service, random_account_id, {"points": 5000}, "spend-2")[1] == 400
+        assert handlers.spend_points(service, random_account_id, {"points": 10}, "spend-2")[1] == 422
+        assert handlers.spend_points(service, random_account_id, {"points": 10}, "k" * 256)[1] == 400
+        assert service.get_points_balances(random_account_id) == {"DANNON": 700}
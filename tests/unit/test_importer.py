@@ -0,0 +1,120 @@
+import csv
+import datetime
+import gzip
+import json
+import logging
+import random
+
+import pytest
+
+from app.importer import RowReader, file_format, main, parse_timestamps, run_import
+from app.persistence import Persistence
+from app.service import PointsService
+
+logger = logging.getLogger(__name__)
+
+START = datetime.datetime(2020, 11, 1, tzinfo=datetime.timezone.utc)
+PAYERS = ["DANNON", "UNILEVER", "MILLER COORS", "KRAFT"]
+
+
+def history(count: int, seed: int = 0):
+    generator = random.Random(seed)
+    rows = []
+    for _ in range(count):
+        timestamp = START + datetime.timedelta(minutes=generator.randint(0, 5000))
+        rows.append((f"account-{generator.randrange(5)}", generator.choice(PAYERS), generator.randint(1, 100),
+                     timestamp))
+    return rows
+
+
+def write_csv(path, rows):
+    # Columns in a different order than the importer's, the header says which is which.
+    with open(path, "w", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["timestamp", "points", "payer", "account_id"])
+        for account_id, payer, points, timestamp in rows:
+            writer.writerow([timestamp.isoformat().replace("+00:00", "Z"), points, payer, account_id])
+
+
+def state(service: PointsService):
+    return {account_id: (service.get_points_balances(account_id),
+                         [(transaction.payer, transaction.points, transaction.timestamp)
+                          for transaction in service.get_account(account_id).transactions()])
+            for account_id in sorted(service.get_account_ids())}
+
+
+class TestResource:
+
+    @pytest.mark.parametrize("batch_rows", [1, 7, 1000])
+    def test_import_matches_adds(self, tmp_path, batch_rows):
+        rows = history(300)
+        write_csv(tmp_path / "history.csv", rows[:200])
+        with gzip.open(tmp_path / "history.ndjson.gz", "wt") as ndjson_file:
+            for account_id, payer, points, timestamp in rows[200:]:
+                ndjson_file.write(json.dumps({"account_id": account_id, "payer": payer, "points": points,
+                                              "timestamp": timestamp.isoformat()}) + "\n")
+        imported = PointsService()
+        report = run_import(imported, [str(tmp_path / "history.csv"), str(tmp_path / "history.ndjson.gz")],
+                            batch_rows=batch_rows).to_dict()
+        assert (report["imported"], report["rejected"]) == (300, 0)
+        assert report["batches"] == -(-300 // batch_rows)
+
+        added = PointsService()
+        for account_id, payer, points, timestamp in rows:
+            added.add_transaction(account_id, payer, points, timestamp)
+        assert state(imported) == state(added)
+
+    def test_rejected_rows_are_skipped(self, tmp_path):
+        lines = [
+            {"account_id": "a", "payer": "DANNON", "points": 100, "timestamp": "2020-11-01T00:00:00Z"},
+            {"account_id": "a", "payer": "DANNON", "points": 0, "timestamp": "2020-11-01T00:00:00Z"},
+            {"account_id": "a", "payer": "DANNON", "points": "many", "timestamp": "2020-11-01T00:00:00Z"},
+            {"account_id": "a", "payer": "DANNON", "points": 5, "timestamp": "yesterday"},
+            {"account_id": "b", "payer": None, "points": 5, "timestamp": "2020-11-01T00:00:00Z"},
+            ["b", "DANNON", 5, "2020-11-01T00:00:00Z"],
+            {"account_id": "b", "payer": "KRAFT", "points": -5, "timestamp": "1604188800"},
+        ]
+        with open(tmp_path / "history.jsonl", "w") as ndjson_file:
+            for line in lines:
+                ndjson_file.write(json.dumps(line) + "\n")
+            ndjson_file.write("{not json\n")
+        service = PointsService()
+        report = run_import(service, [str(tmp_path / "history.jsonl")]).to_dict()
+        assert (report["imported"], report["rejected"]) == (2, 6)
+        assert dict(service.get_all_points_balances()) == {"a": {"DANNON": 100}, "b": {"KRAFT": -5}}
+
+    def test_formats_and_timestamps(self, tmp_path):
+        assert file_format("history.csv.gz") == "csv"
+        assert file_format("history.ndjson") == "ndjson"
+        with pytest.raises(ValueError):
+            file_format("history.txt")
+        with open(tmp_path / "history.csv", "w") as csv_file:
+            csv_file.write("account_id,payer,points\na,DANNON,100\n")
+        with pytest.raises(ValueError):
+            list(RowReader([str(tmp_path / "history.csv")]).batches())
+        # ISO 8601 date and times take the fast path, the rest are parsed as the add routes parse them: a bare date
+        # is rejected and a run of digits is a unix timestamp even when fromisoformat would read it as a date.
+        assert parse_timestamps(["2020-11-01T00:00:00Z", "2020-11-01 00:00:00.000+00:00", "1604188800", "20201102",
+                                 "2020-11-02", "soon"]) == {
+            "2020-11-01T00:00:00Z": START, "2020-11-01 00:00:00.000+00:00": START, "1604188800": START,
+            "20201102": datetime.datetime(1970, 8, 22, 19, 25, 2, tzinfo=datetime.timezone.utc), "2020-11-02": None,
+            "soon": None
+        }
+
+    def test_main_imports_into_data_directory(self, tmp_path, monkeypatch, capsys):
+        rows = history(100)
+        write_csv(tmp_path / "history.csv", rows)
+        monkeypatch.setenv("POINTS_DATA_DIR", str(tmp_path / "data"))
+        monkeypatch.setenv("POINTS_SNAPSHOT_INTERVAL", "0")
+        main([str(tmp_path / "history.csv"), "--batch-rows", "30", "--json", str(tmp_path / "report.json")])
+        assert "Imported 100 rows in 4 batches" in capsys.readouterr().out
+        with open(tmp_path / "report.json") as report_file:
+            assert json.load(report_file)["imported"] == 100
+
+        persistence = Persistence(str(tmp_path / "data"))
+        recovered = persistence.recover()
+        added = PointsService()
+        for account_id, payer, points, timestamp in rows:
+            added.add_transaction(account_id, payer, points, timestamp)
+        assert state(recovered) == state(added)
+        persistence.close()
@@ -0,0 +1,54 @@
+import datetime
+import logging
+import random
+
+import pytest
+
+from app.index import SortedKeys
+
+logger = logging.getLogger(__name__)
+
+
+class TestResource:
+
+    @pytest.mark.parametrize("seed", range(5))
+    def test_sorted_keys_match_sorted_set(self, seed):
+        generator = random.Random(seed)
+        keys = SortedKeys(block_size=4)
+        expected = set()
+        for _ in range(1000):
+            key = f"account-{generator.randint(0, 200)}"
+            if generator.random() < 0.3:
+                keys.discard(key)
+                expected.discard(key)
+            else:
+                keys.add(key)
+                expected.add(key)
+        ordered = sorted(expected)
+        assert list(keys) == ordered
+        assert len(keys) == len(ordered)
+        assert keys.after(None, 7) == ordered[:7]
+        for cursor in [ordered[0], ordered[len(ordered) // 2], ordered[-1], "account-150x", "zzz", ""]:
+            remaining = [key for key in ordered if key > cursor]
+            assert keys.after(cursor, 10) == remaining[:10]
+            assert keys.after(cursor, len(ordered)) == remaining
+
+    def test_balance_pages_follow_account_changes(self, points_service):
+        logging.disable(logging.INFO)
+        try:
+            for account_number in range(50):
+                points_service.add_transaction(f"account-{account_number:02d}", "DANNON", account_number + 1,
+                                               datetime.datetime(2020, 11, 1))
+            points_service.remove_account("account-10")
+        finally:
+            logging.disable(logging.NOTSET)
+        pages = []
+        after = None
+        while True:
+            page = points_service.get_points_balances_page(after, 8)
+            if not page:
+                break
+            pages.append(page)
+            after = page[-1][0]
+        assert [len(page) for page in pages] == [8, 8, 8, 8, 8, 8, 1]
+        assert [balances for page in pages for balances in page] == sorted(points_service.get_all_points_balances())
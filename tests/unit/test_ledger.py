@@ -0,0 +1,179 @@
+import array
+import bisect
+import logging
+import random
+
+import pytest
+
+from app.ledger import COLUMN_TYPECODES, ArchiveChunk, FenwickTree, Ledger
+
+logger = logging.getLogger(__name__)
+
+
+def entry_columns(entries):
+    columns = tuple(array.array(typecode) for typecode in COLUMN_TYPECODES)
+    for entry in entries:
+        for column, value in zip(columns, entry):
+            column.append(value)
+    return columns
+
+
+class TestResource:
+
+    def test_fenwick_tree(self):
+        values = [3, 0, 5, 1, 0, 7, 2]
+        tree = FenwickTree(values)
+        assert [tree.prefix(index) for index in range(len(values) + 1)] == [0, 3, 3, 8, 9, 9, 16, 18]
+        tree.add(1, 4)
+        assert tree.prefix(2) == 7
+        assert tree.search(0) == (0, 0)
+        assert tree.search(3) == (1, 3)
+        assert tree.search(11) == (2, 7)
+        assert tree.search(12) == (3, 12)
+
+    @pytest.mark.parametrize("seed", range(5))
+    def test_ledger_matches_sorted_list(self, seed):
+        generator = random.Random(seed)
+        ledger = Ledger(block_size=4)
+        expected = []
+        # Entries moved back out of an archive come with older sequences than those already in the ledger.
+        for sequence in generator.sample(range(500), 500):
+            entry = (generator.randint(0, 100), sequence, generator.randint(0, 20), generator.randint(0, 3))
+            ledger.insert(*entry)
+            bisect.insort(expected, entry)
+        assert len(ledger) == len(expected)
+        assert list(ledger) == expected
+        assert ledger.total_points == sum(points for _, _, points, _ in expected)
+        assert ledger.nbytes() == 28 * len(expected)
+
+        running = 0
+        for entry in expected:
+            points = entry[2]
+            for target in range(running, running + points):
+                assert ledger.locate(target) == (entry, running + points - target)
+            running += points
+        assert ledger.locate(running) is None
+
+    @pytest.mark.parametrize("seed", range(5))
+    def test_payer_points_through(self, seed):
+        # Single inserts, merged batches and block splits all keep the payer index in step with the entries.
+        generator = random.Random(seed)
+        ledger = Ledger(block_size=4, payer_index=True)
+        expected = []
+        for sequence in range(0, 600, 3):
+            batch = sorted((generator.randint(0, 100), sequence + offset, generator.randint(-20, 20),
+                            generator.randint(0, 3)) for offset in range(generator.choice([1, 3])))
+            if len(batch) == 1:
+                ledger.insert(*batch[0])
+            else:
+                ledger.merge(batch)
+            expected.extend(batch)
+        expected.sort()
+        archive = ArchiveChunk.from_columns(ledger.to_columns(), block_size=8)
+        assert list(zip(*archive.columns())) == expected
+        for timestamp in range(-1, 102):
+            totals = {}
+            for entry_timestamp, _, points, payer in expected:
+                if entry_timestamp <= timestamp:
+                    totals[payer] = totals.get(payer, 0) + points
+            assert {payer: points for payer, points in ledger.payer_points_through(timestamp).items() if points} == \
+                {payer: points for payer, points in totals.items() if points}
+            assert {payer: points for payer, points in archive.payer_points_through(timestamp).items() if points} == \
+                {payer: points for payer, points in totals.items() if points}
+
+    @pytest.mark.parametrize("seed", range(5))
+    def test_entries_from(self, seed):
+        generator = random.Random(seed)
+        ledger = Ledger(block_size=4, payer_index=True)
+        expected = []
+        for sequence in range(300):
+            entry = (generator.randint(0, 50), sequence, generator.randint(-20, 20), generator.randint(0, 3))
+            ledger.insert(*entry)
+            bisect.insort(expected, entry)
+        archive = ArchiveChunk.from_columns(ledger.to_columns(), block_size=8)
+        for key in [(-1, 0), (0, 0), *((entry[0], entry[1] + offset) for entry in expected[::7] for offset in (0, 1)),
+                    (51, 0)]:
+            for payer in [None, 2, 7]:
+                matching = [entry for entry in expected if entry[:2] >= key and payer in (None, entry[3])]
+                assert list(ledger.entries_from(key, payer)) == matching
+                assert list(archive.entries_from(key, payer)) == matching
+
+    @pytest.mark.parametrize("seed", range(5))
+    def test_appended_batches(self, seed):
+        # Batches after the last entry top up the last block and add new ones, new payers included.
+        generator = random.Random(seed)
+        ledger = Ledger(block_size=4, payer_index=True)
+        expected = []
+        timestamp = 0
+        for sequence in range(0, 400, 10):
+            batch = []
+            for offset in range(generator.randint(1, 10)):
+                timestamp += generator.randint(0, 2)
+                payer = generator.randint(0, sequence // 50)
+                batch.append((timestamp, sequence + offset, generator.randint(1, 20), payer))
+            ledger.merge(batch)
+            expected.extend(batch)
+            assert list(ledger) == expected
+        assert len(ledger) == len(expected)
+        assert ledger.total_points == sum(points for _, _, points, _ in expected)
+        assert ledger.locate(sum(points for _, _, points, _ in expected[:-1])) == (expected[-1], expected[-1][2])
+        for through in range(-1, timestamp + 2, 7):
+            totals = {}
+            for entry_timestamp, _, points, payer in expected:
+                if entry_timestamp <= through:
+                    totals[payer] = totals.get(payer, 0) + points
+            assert {payer: points for payer, points in ledger.payer_points_through(through).items() if points} == \
+                totals
+
+    @pytest.mark.parametrize("seed", range(5))
+    def test_merged_archive_chunks(self, seed):
+        # Folds arriving after the chunk are appended to it, earlier ones rebuild it, and both read like one chunk
+        # built from every entry at once.
+        generator = random.Random(seed)
+        chunks = []
+        expected = []
+        timestamp = 0
+        for fold in range(30):
+            start = timestamp - generator.randint(0, 20) if fold % 5 == 4 else timestamp + 1
+            entries = sorted((start + generator.randint(0, 20), fold * 100 + offset, generator.randint(-20, 20) or 1,
+                              generator.randint(0, fold // 5)) for offset in range(generator.randint(1, 12)))
+            timestamp = max(timestamp, entries[-1][0])
+            chunks = [ArchiveChunk.merge(chunks, entry_columns(entries), block_size=4)]
+            expected = sorted(expected + entries)
+        chunk = chunks[0]
+        assert len(chunk) == len(expected) and list(zip(*chunk.columns())) == expected
+        rebuilt = ArchiveChunk.from_columns(entry_columns(expected), block_size=4)
+        for through in range(-20, timestamp + 2, 3):
+            assert {payer: points for payer, points in chunk.payer_points_through(through).items() if points} == \
+                {payer: points for payer, points in rebuilt.payer_points_through(through).items() if points}
+        for entry in expected[::5]:
+            for payer in [None, 1]:
+                assert list(chunk.entries_from(entry[:2], payer)) == list(rebuilt.entries_from(entry[:2], payer))
+
+    @pytest.mark.parametrize("seed", range(5))
+    def test_take_lots(self, seed):
+        # Taking a payer's newest lots leaves a chunk that reads like one built from the entries left.
+        generator = random.Random(seed)
+        expected = sorted((generator.randint(0, 200), sequence, generator.randint(-20, 20) or 1,
+                           generator.randint(0, 3)) for sequence in range(300))
+        chunk = ArchiveChunk.from_columns(entry_columns(expected), block_size=4)
+        for _ in range(20):
+            payer, timestamp, points = generator.randint(0, 4), generator.randint(0, 200), generator.randint(1, 60)
+            wanted, taken_points = [], 0
+            for entry in reversed(expected):
+                if taken_points >= points or entry[0] <= timestamp:
+                    break
+                if entry[3] == payer and entry[2] > 0:
+                    wanted.append(entry)
+                    taken_points += entry[2]
+            chunk, taken = chunk.take_lots(payer, timestamp, points)
+            assert taken == wanted[::-1]
+            expected = [entry for entry in expected if entry not in taken]
+            rebuilt = ArchiveChunk.from_columns(entry_columns(expected), block_size=4)
+            assert len(chunk) == len(expected) and list(zip(*chunk.columns())) == expected
+            assert {payer_id: total[-1] for payer_id, total in chunk.lot_totals.items()} == \
+                {payer_id: total[-1] for payer_id, total in rebuilt.lot_totals.items()}
+            for through in range(-1, 202, 5):
+                totals = chunk.payer_points_through(through)
+                assert {payer_id: total for payer_id, total in totals.items() if total} == \
+                    {payer_id: total for payer_id, total in rebuilt.payer_points_through(through).items() if total}
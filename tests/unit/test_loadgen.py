@@ -0,0 +1,58 @@
+import logging
+import time
+
+import pytest
+
+import app.app
+from app.loadgen import InProcessTarget, parse_mix, percentile, run_load
+
+logger = logging.getLogger(__name__)
+
+
+class SlowTarget:
+    # Takes a fixed time per request, like a server at capacity.
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+
+    def request(self, method: str, path: str, body: bytes) -> int:
+        time.sleep(self.seconds)
+        return 200
+
+
+class TestResource:
+
+    def test_parse_mix(self):
+        assert parse_mix("add=8,spend=1,get=1") == {"add": 8.0, "spend": 1.0, "get": 1.0}
+        assert parse_mix("spend") == {"spend": 1.0}
+        with pytest.raises(ValueError):
+            parse_mix("delete=1")
+        with pytest.raises(ValueError):
+            parse_mix("add=0")
+
+    def test_percentile(self):
+        values = list(range(1, 1001))
+        assert percentile(values, 50) == 500
+        assert percentile(values, 99) == 990
+        assert percentile(values, 99.9) == 999
+        assert percentile([7], 99.9) == 7
+
+    def test_queueing_delay_is_counted(self):
+        # Requests arrive every 10ms but take 20ms, so each waits longer than the last. A closed loop measurement
+        # would only see the 20ms service time. A stall of the sleeping sender delays every later response as well,
+        # so the service time is only compared with the response time rather than a fixed bound.
+        report = run_load(SlowTarget(0.02), {"get": 1}, rate=100, duration=0.5, accounts=1, concurrency=1).to_dict()
+        assert report["all"]["requests"] == 50
+        assert report["all"]["response_time_ms"]["p99"] > 400
+        assert report["all"]["service_time_ms"]["p99"] < report["all"]["response_time_ms"]["p99"] / 2
+
+    def test_in_process_target(self, monkeypatch, points_service):
+        monkeypatch.setattr(app.app, "points_service", points_service)
+        logging.disable(logging.INFO)
+        try:
+            report = run_load(InProcessTarget(app.app.app), {"add": 8, "spend": 1, "get": 1}, rate=200, duration=0.5,
+                              accounts=5, concurrency=4).to_dict()
+        finally:
+            logging.disable(logging.NOTSET)
+        assert report["all"]["statuses"] == {"200": 100}
+        assert set(report["operations"]) == {"add", "spend", "get"}
+        assert len(points_service.get_account_ids()) == 5
@@ -0,0 +1,64 @@
+import datetime
+import logging
+import queue
+
+import pytest
+
+from app.logs import AsyncLogHandler, BinaryAuditSink, TransactionAudit, create_transaction_audit, read_audit_log
+from app.logs import LOG_RECORDS_DROPPED, audit_logger
+from app.metrics import METRICS
+from app.model import Transaction
+
+logger = logging.getLogger(__name__)
+
+START = datetime.datetime(2020, 11, 1, tzinfo=datetime.timezone.utc)
+
+
+class TestResource:
+
+    def test_async_handler_defers_formatting_and_drops_when_full(self):
+        log_queue = queue.SimpleQueue()
+        handler = AsyncLogHandler(log_queue, capacity=2)
+        queued_logger = logging.getLogger("tests.async_handler")
+        queued_logger.propagate = False
+        queued_logger.addHandler(handler)
+        try:
+            dropped = METRICS.collect().get((LOG_RECORDS_DROPPED.name, ()), [0])[0]
+            for index in range(3):
+                queued_logger.warning("Record %d of %s", index, "three")
+            assert METRICS.collect()[(LOG_RECORDS_DROPPED.name, ())] == [dropped + 1]
+            record = log_queue.get_nowait()
+            assert (record.msg, record.args) == ("Record %d of %s", (0, "three"))
+            assert record.getMessage() == "Record 0 of three"
+            assert log_queue.qsize() == 1
+        finally:
+            queued_logger.removeHandler(handler)
+
+    def test_binary_audit_sink(self, tmp_path):
+        path = str(tmp_path / "audit.bin")
+        sink = BinaryAuditSink(path, buffer_size=64)
+        audit = TransactionAudit(sink=sink)
+        audit.record("a", [Transaction("DANNON", 300, START)])
+        audit.record("b", [Transaction("UNILEVER", 200, START), Transaction("DANNON", -100, START)])
+        sink.close()
+        records = list(read_audit_log(path))
+        assert [(account_id, [(t.payer, t.points, t.timestamp) for t in transactions])
+                for _, account_id, transactions in records] == [
+            ("a", [("DANNON", 300, START)]),
+            ("b", [("UNILEVER", 200, START), ("DANNON", -100, START)]),
+        ]
+
+    def test_sampled_audit(self, caplog, monkeypatch):
+        samples = iter([0.5, 0.05, 0.2])
+        monkeypatch.setattr("random.random", lambda: next(samples))
+        audit = create_transaction_audit("sample:0.1")
+        with caplog.at_level(logging.INFO, logger=audit_logger.name):
+            for points in [1, 2, 3]:
+                audit.record("a", [Transaction("DANNON", points, START)])
+        assert [record.args[1].points for record in caplog.records if record.name == audit_logger.name] == [2]
+        with caplog.at_level(logging.INFO, logger=audit_logger.name):
+            caplog.clear()
+            create_transaction_audit("off").record("a", [Transaction("DANNON", 1, START)])
+        assert not caplog.records
+        with pytest.raises(ValueError):
+            create_transaction_audit("syslog")
@@ -0,0 +1,81 @@
+import datetime
+import logging
+import threading
+
+from app.metrics import METRICS, MetricsRegistry, LEDGER_ENTRIES, SPEND_LOTS_VISITED, ACCOUNT_LOCK_WAIT_SECONDS
+from app.service import PointsService
+
+logger = logging.getLogger(__name__)
+
+START = datetime.datetime(2020, 11, 1, tzinfo=datetime.timezone.utc)
+
+
+def histogram_count(collection, name: str, *label_values: str) -> float:
+    # Observations recorded in a histogram cell, every bucket but the trailing sum.
+    return sum(collection.get((name, label_values), [0, 0])[:-1])
+
+
+class TestResource:
+
+    def test_threads_record_into_their_own_shards(self):
+        registry = MetricsRegistry()
+        requests = registry.counter("requests", "Requests.", ["route"])
+        latency = registry.histogram("latency_seconds", "Latency.", buckets=(0.1, 1.0))
+
+        def record():
+            for _ in range(1000):
+                requests.inc("/points")
+                latency.observe(0.5)
+
+        workers = [threading.Thread(target=record) for _ in range(8)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        requests.inc("/points", amount=5)
+        collection = registry.collect()
+        assert collection[("requests", ("/points",))] == [8005]
+        assert collection[("latency_seconds", ())] == [0, 8000, 0, 4000.0]
+        # Every worker has exited, its shard is folded into the retired total.
+        assert len(registry._shards) == 1
+        assert registry.collect() == collection
+
+    def test_render_prometheus_text(self):
+        registry = MetricsRegistry()
+        requests = registry.counter("requests_total", "Requests.", ["route"])
+        latency = registry.histogram("latency_seconds", "Latency.", buckets=(0.1, 1.0))
+        registry.gauge("accounts", "Accounts.")
+        requests.inc('/say "hi"')
+        latency.observe(0.05)
+        latency.observe(2)
+        collection = registry.collect()
+        collection[("accounts", ())] = [3]
+        assert registry.render(collection) == "\n".join([
+            "# HELP requests_total Requests.",
+            "# TYPE requests_total counter",
+            'requests_total{route="/say \\"hi\\""} 1',
+            "# HELP latency_seconds Latency.",
+            "# TYPE latency_seconds histogram",
+            'latency_seconds_bucket{le="0.1"} 1',
+            'latency_seconds_bucket{le="1"} 1',
+            'latency_seconds_bucket{le="+Inf"} 2',
+            "latency_seconds_sum 2.05",
+            "latency_seconds_count 2",
+            "# HELP accounts Accounts.",
+            "# TYPE accounts gauge",
+            "accounts 3",
+        ]) + "\n"
+
+    def test_service_metrics(self, random_account_id):
+        service = PointsService()
+        before = METRICS.collect()
+        service.add_transactions(random_account_id, [("DANNON", 100, START), ("UNILEVER", 100, START)])
+        service.spend_points(random_account_id, 150)
+        collection = service.collect_metrics()
+        for operation in ["add_transactions", "spend_points"]:
+            assert histogram_count(collection, ACCOUNT_LOCK_WAIT_SECONDS.name, operation) == \
+                histogram_count(before, ACCOUNT_LOCK_WAIT_SECONDS.name, operation) + 1
+        lots = collection[(SPEND_LOTS_VISITED.name, ())]
+        assert lots[-1] - before.get((SPEND_LOTS_VISITED.name, ()), [0])[-1] == 2
+        assert collection[("points_accounts", ())] == [1]
+        assert collection[(LEDGER_ENTRIES.name, ())][-1] == 4
@@ -0,0 +1,133 @@
+import datetime
+import logging
+import os
+import threading
+
+import pytest
+
+from app.model import NotEnoughPointsException
+from app.persistence import Persistence, numbered_files, SEGMENT_FILE, SNAPSHOT_FILE
+
+logger = logging.getLogger(__name__)
+
+START = datetime.datetime(2020, 11, 1, tzinfo=datetime.timezone.utc)
+
+
+def state(service):
+    return {account_id: (service.get_points_balances(account_id),
+                         [(transaction.payer, transaction.points, transaction.timestamp)
+                          for transaction in service.get_account(account_id).transactions()])
+            for account_id in service.get_account_ids()}
+
+
+class TestResource:
+
+    @pytest.fixture
+    def persistence(self, tmp_path):
+        persistence = Persistence(str(tmp_path), commit_latency=0.001)
+        yield persistence
+        persistence.close()
+
+    def test_recover_replays_write_ahead_log(self, tmp_path, persistence):
+        service = persistence.recover()
+        service.add_transaction("a", "DANNON", 1000, START)
+        service.add_transaction("a", "UNILEVER", 200, START - datetime.timedelta(days=1))
+        service.add_transaction("b", "DANNON", 300, START)
+        service.spend_points("a", 500)
+        service.add_transaction("c", "KRAFT", 10, START)
+        service.remove_account("c")
+        with pytest.raises(NotEnoughPointsException):
+            service.spend_points("b", 301)
+        expected = state(service)
+        persistence.close()
+
+        recovered = Persistence(str(tmp_path)).recover()
+        assert state(recovered) == expected
+        assert recovered.spend_points("a", 100)[0].payer == "DANNON"
+        recovered.journal.close()
+
+    def test_recover_from_snapshot_and_tail(self, tmp_path, persistence):
+        service = persistence.recover()
+        for day in range(50):
+            service.add_transaction("a", f"PAYER-{day % 3}", 100, START + datetime.timedelta(days=day % 7))
+        service.spend_points("a", 1234)
+        service.add_transaction("b", "DANNON", 100, START)
+        persistence.snapshot()
+        service.add_transaction("a", "PAYER-0", 5, START - datetime.timedelta(days=1))
+        service.spend_points("a", 50)
+        service.remove_account("b")
+        expected = state(service)
+        persistence.close()
+        assert [segment for segment, _ in numbered_files(str(tmp_path), SNAPSHOT_FILE)] == [1]
+        assert [segment for segment, _ in numbered_files(str(tmp_path), SEGMENT_FILE)] == [1]
+
+        recovered_persistence = Persistence(str(tmp_path))
+        recovered = recovered_persistence.recover()
+        assert state(recovered) == expected
+        # A second snapshot and recovery from it alone gives the same state.
+        recovered_persistence.snapshot()
+        recovered_persistence.close()
+        recovered = Persistence(str(tmp_path)).recover()
+        assert state(recovered) == expected
+        recovered.journal.close()
+
+    def test_recover_compacted_account(self, tmp_path):
+        persistence = Persistence(str(tmp_path), commit_latency=0.001, compaction_threshold=4)
+        service = persistence.recover()
+        for day in range(40):
+            service.add_transaction("a", f"PAYER-{day % 3}", 100, START + datetime.timedelta(days=day))
+            service.spend_points("a", 60)
+        assert service.get_account("a").archive
+        persistence.snapshot()
+        service.spend_points("a", 30)
+        expected = state(service)
+        persistence.close()
+        service.journal = None
+
+        recovered_persistence = Persistence(str(tmp_path), compaction_threshold=4)
+        recovered = recovered_persistence.recover()
+        assert state(recovered) == expected
+        assert recovered.get_account("a").archived_entries == service.get_account("a").archived_entries
+        for day in range(0, 40, 3):
+            as_of = START + datetime.timedelta(days=day)
+            assert recovered.get_points_balances_as_of("a", as_of) == service.get_points_balances_as_of("a", as_of)
+        # Spends continue from the same lot, and a backdated lot is spent first after expanding the archive.
+        assert [(transaction.payer, transaction.points) for transaction in recovered.spend_points("a", 10)] == \
+            [(transaction.payer, transaction.points) for transaction in service.spend_points("a", 10)]
+        recovered.add_transaction("a", "PAYER-0", 5, START)
+        assert recovered.spend_points("a", 5)[0].payer == "PAYER-0"
+        recovered_persistence.close()
+
+    def test_recover_ignores_torn_tail(self, tmp_path, persistence):
+        service = persistence.recover()
+        service.add_transaction("a", "DANNON", 1000, START)
+        service.add_transaction("a", "DANNON", 1000, START)
+        persistence.close()
+        _, path = numbered_files(str(tmp_path), SEGMENT_FILE)[-1]
+        with open(path, "r+b") as segment_file:
+            segment_file.truncate(os.path.getsize(path) - 3)
+
+        recovered_persistence = Persistence(str(tmp_path))
+        recovered = recovered_persistence.recover()
+        assert recovered.get_points_balances("a") == {"DANNON": 1000}
+        recovered.add_transaction("a", "DANNON", 1, START)
+        recovered_persistence.close()
+        recovered = Persistence(str(tmp_path)).recover()
+        assert recovered.get_points_balances("a") == {"DANNON": 1001}
+        recovered.journal.close()
+
+    def test_group_commit_shares_fsyncs(self, tmp_path, monkeypatch):
+        fsyncs = []
+        fsync = os.fsync
+        monkeypatch.setattr(os, "fsync", lambda descriptor: fsyncs.append(descriptor) or fsync(descriptor))
+        persistence = Persistence(str(tmp_path), commit_latency=0.05)
+        service = persistence.recover()
+        fsyncs.clear()
+        threads = [threading.Thread(target=service.add_transaction, args=(f"account-{index}", "DANNON", 1, START))
+                   for index in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        persistence.close()
+        assert len(fsyncs) < 20
@@ -0,0 +1,135 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+
+import pytest
+
+import app.app
+import app.profiling
+from app.config import profiling_enabled
+from app.asgi import PointsApplication
+from app.profiling import PROFILE_HEADER, SamplingProfiler, RequestProfile
+from app.service import PointsService
+from tests.unit.test_asgi import asgi_exchange
+
+logger = logging.getLogger(__name__)
+
+ADD_BODY = {"payer": "DANNON", "points": 1000, "timestamp": "2020-11-02T14:00:00Z"}
+
+
+def spin(stopping: threading.Event):
+    while not stopping.is_set():
+        sum(range(100))
+
+
+@pytest.fixture
+def flask_client(monkeypatch, points_service):
+    monkeypatch.setattr(app.app, "points_service", points_service)
+    monkeypatch.setattr(app.app, "profiling", True)
+    return app.app.app.test_client()
+
+
+class TestResource:
+
+    def test_sampler_collects_stacks(self):
+        profiler = SamplingProfiler()
+        stopping = threading.Event()
+        worker = threading.Thread(target=spin, args=(stopping,), name="Spinner-3")
+        worker.start()
+        profiler.start(0.001)
+        try:
+            while profiler.samples < 20:
+                time.sleep(0.005)
+        finally:
+            profiler.stop()
+            stopping.set()
+            worker.join()
+        status = profiler.status()
+        assert not status["running"] and status["interval"] == 0.001 and status["samples"] >= 20
+        lines = profiler.collapsed().splitlines()
+        # Thread counters are dropped, stacks run from the outermost frame and the sampler does not sample itself.
+        spinner = [line for line in lines if line.startswith("Spinner;")]
+        assert spinner and all(";spin (test_profiling.py:" in line for line in spinner)
+        assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+        assert not any("SamplingProfiler" in line for line in lines)
+        counts = [int(line.rsplit(" ", 1)[1]) for line in lines]
+        assert counts == sorted(counts, reverse=True)
+        # Restarting clears the previous samples.
+        profiler.start()
+        profiler.stop()
+        assert profiler.samples <= 1
+
+    def test_profiler_routes(self, flask_client):
+        assert flask_client.post("/admin/profiler", json={"running": True, "interval": 5}).status_code == 400
+        response = flask_client.post("/admin/profiler", json={"running": True, "interval": 0.001})
+        assert response.status_code == 200 and response.json["running"]
+        for _ in range(20):
+            flask_client.post("/points/profiled/add", json=ADD_BODY)
+        response = flask_client.post("/admin/profiler", json={"running": False})
+        assert response.status_code == 200 and not response.json["running"]
+        response = flask_client.get("/admin/profiler")
+        assert response.status_code == 200 and response.content_type == "text/plain; charset=utf-8"
+
+    def test_request_profile_flask(self, flask_client):
+        # Sorted by cumulative time the handler is always among the listed functions, however many are cut.
+        response = flask_client.post("/points/profiled/add", json=ADD_BODY, headers={PROFILE_HEADER: "cumulative"})
+        assert response.status_code == 200 and response.content_type == "text/plain; charset=utf-8"
+        text = response.get_data(as_text=True)
+        assert text.startswith("Request answered 200 in ") and "Ordered by: cumulative time" in text
+        assert "(add_points)" in text
+        # The request is applied as without the header, only its response body is replaced.
+        assert flask_client.get("/points/profiled").json == {"DANNON": 1000}
+        response = flask_client.post("/points/profiled/spend", json={"points": 5000}, headers={PROFILE_HEADER: "calls"})
+        assert response.status_code == 400 and "Ordered by: call count" in response.get_data(as_text=True)
+        response = flask_client.get("/points/profiled", headers={PROFILE_HEADER: "sideways"})
+        assert "Ordered by: cumulative time" in response.get_data(as_text=True)
+
+        other = RequestProfile.begin("")
+        try:
+            assert flask_client.get("/points/profiled", headers={PROFILE_HEADER: ""}).status_code == 429
+        finally:
+            other.finish()
+        assert flask_client.get("/points/profiled", headers={PROFILE_HEADER: ""}).status_code == 200
+
+    @pytest.mark.parametrize("offload", [False, True])
+    def test_request_profile_asgi(self, offload):
+        application = PointsApplication(PointsService(), offload=offload, profiling=True)
+        header = [(PROFILE_HEADER.lower().encode("ascii"), b"cumulative")]
+        body = b'{"payer": "DANNON", "points": 1000, "timestamp": "2020-11-02T14:00:00Z"}'
+        start, text = asyncio.run(asgi_exchange(application, "POST", "/points/profiled/add", body, header))
+        assert start["status"] == 200
+        assert dict(start["headers"])[b"content-type"] == b"text/plain; charset=utf-8"
+        assert b"Ordered by: cumulative time" in text and b"(add_points)" in text
+        start, text = asyncio.run(asgi_exchange(application, "GET", "/points/profiled"))
+        assert start["status"] == 200 and json.loads(text) == {"DANNON": 1000}
+
+        other = RequestProfile.begin("")
+        try:
+            start, _ = asyncio.run(asgi_exchange(application, "GET", "/points/profiled", headers=header))
+            assert start["status"] == 429
+        finally:
+            other.finish()
+
+    def test_profiling_disabled(self, flask_client, monkeypatch):
+        # Off by default, the routes are not found and the header does not change the response.
+        monkeypatch.delenv("POINTS_PROFILING", raising=False)
+        assert not profiling_enabled()
+        monkeypatch.setattr(app.app, "profiling", profiling_enabled())
+        response = flask_client.post("/points/profiled/add", json=ADD_BODY, headers={PROFILE_HEADER: ""})
+        assert response.status_code == 200 and response.json["points"] == 1000
+        for method in ("GET", "POST"):
+            response = flask_client.open("/admin/profiler", method=method, json={"running": True})
+            assert response.status_code == 404 and response.json == {"message": "Not Found", "status_code": 404}
+        assert not app.profiling.PROFILER.status()["running"]
+
+        application = PointsApplication(PointsService())
+        header = [(PROFILE_HEADER.lower().encode("ascii"), b"")]
+        start, text = asyncio.run(asgi_exchange(application, "GET", "/payers", headers=header))
+        assert start["status"] == 200 and json.loads(text) == {}
+        for method in ("GET", "POST", "PUT"):
+            start, text = asyncio.run(asgi_exchange(application, method, "/admin/profiler", b'{"running": true}'))
+            assert start["status"] == 404 and json.loads(text) == {"message": "Not Found", "status_code": 404}
+        monkeypatch.setenv("POINTS_PROFILING", "1")
+        assert profiling_enabled()
@@ -0,0 +1,64 @@
+import json
+import logging
+
+import pytest
+from pydantic import ValidationError
+
+from app.cache import encode_fragment
+from app.schema import AddPointsRequest, SpendPointsRequest
+
+logger = logging.getLogger(__name__)
+
+ADD_BODIES = [
+    {"payer": "DANNON", "points": 1000, "timestamp": "2020-11-02T14:00:00Z"},
+    {"payer": "DANNON", "points": -200, "timestamp": "2020-11-02T14:00:00+05:30", "note": "extra"},
+    {"payer": "DANNON", "points": 0, "timestamp": "2020-11-02 14:00:00"},
+    {"payer": "DANNON", "points": 1000, "timestamp": "2020-11-02T14:00:00Z0"},
+    {"payer": "DANNON", "points": 1000, "timestamp": "2020-02-30T14:00:00Z"},
+    {"payer": "DANNON", "points": 1000, "timestamp": 1604325600},
+    {"payer": "DANNON", "points": True, "timestamp": "2020-11-02T14:00:00Z"},
+    {"payer": "DANNON", "points": 10.0, "timestamp": "2020-11-02T14:00:00Z"},
+    {"payer": "DANNON", "points": "10", "timestamp": "2020-11-02T14:00:00Z"},
+    {"payer": "DANNON", "points": "DANNON", "timestamp": "2020-11-02T14:00:00Z"},
+    {"payer": 42, "points": 1000, "timestamp": "2020-11-02T14:00:00Z"},
+    {"payer": {}, "points": 1000, "timestamp": "2020-11-02T14:00:00Z"},
+    {"payer": None, "points": 1000, "timestamp": "2020-11-02T14:00:00Z"},
+    {"points": 1000, "timestamp": "2020-11-02T14:00:00Z"},
+    {"payer": "DANNON", "points": 10 ** 30, "timestamp": "2020-11-02T14:00:00Z"},
+    [{"payer": "DANNON", "points": 1000, "timestamp": "2020-11-02T14:00:00Z"}],
+    "DANNON",
+]
+SPEND_BODIES = [{"points": 5000}, {"points": -1}, {"points": "5000"}, {"points": "f1000"}, {"points": False},
+                {"points": 1.5}, {"points": 10 ** 30}, {}, [5000]]
+
+
+def outcome(parse, value):
+    # The parsed model's fields and text, or the validation errors.
+    try:
+        model = parse(value)
+    except ValidationError as error:
+        return "invalid", error.errors()
+    return model.dict(), repr(model), model.__fields_set__
+
+
+class TestResource:
+
+    @pytest.mark.parametrize("model, body", [(AddPointsRequest, body) for body in ADD_BODIES] +
+                             [(SpendPointsRequest, body) for body in SPEND_BODIES])
+    def test_fast_path_matches_pydantic(self, model, body):
+        # A string body is JSON text, as it always has been for `from_dict_or_json`.
+        encoded = json.dumps(body)
+        parse = model.parse_raw if isinstance(body, str) else model.parse_obj
+        assert outcome(model.from_dict_or_json, body) == outcome(parse, body)
+        assert outcome(model.from_dict_or_json, encoded) == outcome(model.parse_raw, encoded)
+
+    def test_encode_fragment_matches_json(self):
+        values = [
+            {"payer": "DANNON", "points": -100, "timestamp": "'2020-11-02T14:00:00Z"},
+            [{"b": 1, "a": [None, True, False]}, {"message": "quote \" slash \\ / tab \t newline \n \u0001 \u007f"}],
+            {"accounts": [], "next": None},
+            {"payer": "CAFÉ ☕ 𝄞", "points": 10},
+            {"points": 2 ** 70},
+        ]
+        for value in values:
+            assert encode_fragment(value) == json.dumps(value, sort_keys=True, separators=(",", ":")).encode("utf-8")
@@ -0,0 +1,115 @@
+import datetime
+import logging
+
+import pytest
+
+from app.model import AccountDoesntExistException, NotEnoughPointsException
+from app.sharding import ShardedPointsService, shard_for
+
+logger = logging.getLogger(__name__)
+
+START = datetime.datetime(2020, 11, 1, tzinfo=datetime.timezone.utc)
+
+
+@pytest.fixture(scope="module")
+def sharded_service():
+    service = ShardedPointsService(3, connections_per_shard=2)
+    yield service
+    service.close()
+
+
+class TestResource:
+
+    def test_accounts_are_partitioned(self, sharded_service):
+        account_ids = [f"account-{index}" for index in range(30)]
+        for account_id in account_ids:
+            sharded_service.add_transaction(account_id, "DANNON", 100, START)
+        assert {shard_for(account_id, 3) for account_id in account_ids} == {0, 1, 2}
+        assert sorted(sharded_service.get_account_ids()) == sorted(account_ids)
+        assert dict(sharded_service.get_all_points_balances()) == {
+            account_id: {"DANNON": 100} for account_id in account_ids
+        }
+        for account_id in account_ids:
+            sharded_service.remove_account(account_id)
+        assert sharded_service.get_account_ids() == []
+
+    def test_shard_calls_match_service(self, sharded_service, random_account_id):
+        sharded_service.add_transactions(random_account_id, [("DANNON", 300, START), ("UNILEVER", 200, START)])
+        transaction = sharded_service.add_transaction(random_account_id, "DANNON", 1000, START)
+        assert (transaction.payer, transaction.points, transaction.timestamp) == ("DANNON", 1000, START)
+        spends = sharded_service.spend_points(random_account_id, 400)
+        assert [(spend.payer, spend.points) for spend in spends] == [("DANNON", -300), ("UNILEVER", -100)]
+        assert sharded_service.has_account(random_account_id)
+        assert sharded_service.get_points_balances(random_account_id) == {"DANNON": 1000, "UNILEVER": 100}
+        with pytest.raises(NotEnoughPointsException):
+            sharded_service.spend_points(random_account_id, 5000)
+        sharded_service.remove_account(random_account_id)
+        with pytest.raises(AccountDoesntExistException):
+            sharded_service.spend_points(random_account_id, 1)
+
+    def test_balance_pages_merge_shards(self, sharded_service):
+        account_ids = [f"page-{index:02d}" for index in range(20)]
+        for account_id in account_ids:
+            sharded_service.add_transaction(account_id, "DANNON", 100, START)
+        assert sharded_service.get_points_balances_page(None, 5) == [
+            (account_id, {"DANNON": 100}) for account_id in account_ids[:5]
+        ]
+        assert [account_id for account_id, _ in sharded_service.get_points_balances_page("page-13", 50)] == \
+            account_ids[14:]
+        for account_id in account_ids:
+            sharded_service.remove_account(account_id)
+
+    def test_metrics_merge_shards(self, sharded_service):
+        account_ids = [f"metrics-{index}" for index in range(6)]
+        for account_id in account_ids:
+            sharded_service.add_transaction(account_id, "DANNON", 100, START)
+        collection = sharded_service.collect_metrics()
+        assert collection[("points_accounts", ())] == [6]
+        assert sum(collection[("points_account_lock_wait_seconds", ("add_transaction",))][:-1]) >= 6
+        for account_id in account_ids:
+            sharded_service.remove_account(account_id)
+
+    def test_compaction_fans_out(self, sharded_service):
+        account_ids = [f"compact-{index}" for index in range(6)]
+        for account_id in account_ids:
+            sharded_service.add_transaction(account_id, "DANNON", 100, START)
+            sharded_service.spend_points(account_id, 100)
+        key = ("points_ledger_entries_compacted_total", ())
+        compacted = sharded_service.collect_metrics().get(key, [0])[0]
+        assert sharded_service.compact_accounts() == 12
+        assert sharded_service.collect_metrics()[key] == [compacted + 12]
+        for account_id in account_ids:
+            sharded_service.remove_account(account_id)
+
+    def test_import_fans_out(self, sharded_service):
+        batches = [(f"import-{index}", [("DANNON", 100, START), ("KRAFT", 50 + index, START)]) for index in range(9)]
+        assert sharded_service.import_transactions(batches) == 18
+        assert {shard_for(account_id, 3) for account_id, _ in batches} == {0, 1, 2}
+        for account_id, _ in batches:
+            assert sharded_service.get_points_balances(account_id) == {"DANNON": 100,
+                                                                       "KRAFT": 50 + int(account_id[7:])}
+            sharded_service.remove_account(account_id)
+
+    def test_spend_batch_fans_out(self, sharded_service):
+        account_ids = [f"spend-batch-{index}" for index in range(6)]
+        for account_id in account_ids:
+            sharded_service.add_transaction(account_id, "DANNON", 100, START)
+        results = sharded_service.spend_points_batch([(account_id, [60, 60]) for account_id in account_ids] +
+                                                     [("spend-batch-missing", [1])])
+        assert [[type(result) if isinstance(result, Exception) else [(spend.payer, spend.points) for spend in result]
+                 for result in account_results] for account_results in results] == \
+            [[[("DANNON", -60)], NotEnoughPointsException]] * 6 + [[AccountDoesntExistException]]
+        for account_id in account_ids:
+            assert sharded_service.get_points_balances(account_id) == {"DANNON": 40}
+            sharded_service.remove_account(account_id)
+
+    def test_payer_totals_merge_shards(self, sharded_service):
+        account_ids = [f"payer-totals-{index}" for index in range(6)]
+        for account_id in account_ids:
+            sharded_service.add_transaction(account_id, "TOTALS", 100, START)
+            sharded_service.spend_points(account_id, 30)
+        assert {shard_for(account_id, 3) for account_id in account_ids} == {0, 1, 2}
+        assert sharded_service.get_payer_totals()["TOTALS"] == {"available": 420, "spent": 180}
+        for account_id in account_ids:
+            sharded_service.remove_account(account_id)
+        assert "TOTALS" not in sharded_service.get_payer_totals()
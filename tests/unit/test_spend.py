@@ -0,0 +1,121 @@
+import datetime
+import logging
+import random
+import typing
+
+import pytest
+
+from app.ledger import Ledger
+from app.model import AccountDoesntExistException, NotEnoughPointsException
+from app.service import PointsService
+
+logger = logging.getLogger(__name__)
+
+PAYERS = ["DANNON", "UNILEVER", "MILLER COORS", "KRAFT"]
+
+
+def scan_spend(transactions: typing.List[typing.Tuple[str, int, datetime.datetime]], points: int):
+    # The original full history scan spend, used as the reference breakdown.
+    spend_negation_by_payer: typing.Dict[str, int] = {}
+    for payer, transaction_points, _ in transactions:
+        spend_negation_by_payer.setdefault(payer, 0)
+        if transaction_points < 0:
+            spend_negation_by_payer[payer] -= transaction_points
+    points_to_spend = points
+    spends = []
+    for payer, transaction_points, _ in sorted(transactions, key=lambda transaction: transaction[2]):
+        if transaction_points > 0 and points_to_spend > 0:
+            spend_negation = spend_negation_by_payer[payer]
+            if spend_negation >= transaction_points:
+                spend_negation_by_payer[payer] -= transaction_points
+            else:
+                spend_negation_by_payer[payer] = 0
+                spend = -min(transaction_points - spend_negation, points_to_spend)
+                points_to_spend += spend
+                spends.append((payer, spend))
+    return spends if points_to_spend == 0 else None
+
+
+class TestResource:
+
+    def test_primary_spend(self, points_service, random_account_id):
+        def timestamp(value: str):
+            return datetime.datetime.fromisoformat(value).replace(tzinfo=datetime.timezone.utc)
+        points_service.add_transaction(random_account_id, "DANNON", 1000, timestamp("2020-11-02T14:00:00"))
+        points_service.add_transaction(random_account_id, "UNILEVER", 200, timestamp("2020-10-31T11:00:00"))
+        points_service.add_transaction(random_account_id, "DANNON", -200, timestamp("2020-10-31T15:00:00"))
+        points_service.add_transaction(random_account_id, "MILLER COORS", 10000, timestamp("2020-11-01T14:00:00"))
+        points_service.add_transaction(random_account_id, "DANNON", 300, timestamp("2020-10-31T10:00:00"))
+        spends = points_service.spend_points(random_account_id, 5000)
+        assert [(spend.payer, spend.points) for spend in spends] == [
+            ("DANNON", -100), ("UNILEVER", -200), ("MILLER COORS", -4700)
+        ]
+        assert points_service.get_points_balances(random_account_id) == {
+            "DANNON": 1000, "UNILEVER": 0, "MILLER COORS": 5300
+        }
+
+    def test_spend_not_enough_points_leaves_account_untouched(self, points_service, random_account_id):
+        points_service.add_transaction(random_account_id, "DANNON", 100, datetime.datetime(2020, 1, 1))
+        with pytest.raises(NotEnoughPointsException):
+            points_service.spend_points(random_account_id, 101)
+        with pytest.raises(NotEnoughPointsException):
+            points_service.spend_points(random_account_id, -1)
+        assert points_service.spend_points(random_account_id, 0) == []
+        assert points_service.get_points_balances(random_account_id) == {"DANNON": 100}
+
+    @pytest.mark.parametrize("seed", range(5))
+    def test_spend_batch_matches_single_spends(self, seed):
+        def outcome(result):
+            return type(result) if isinstance(result, Exception) else [(spend.payer, spend.points) for spend in result]
+
+        def single_outcome(account_id: str, points: int):
+            try:
+                return outcome(single.spend_points(account_id, points))
+            except (NotEnoughPointsException, AccountDoesntExistException) as exception:
+                return outcome(exception)
+
+        generator = random.Random(seed)
+        batched, single = PointsService(), PointsService()
+        account_ids = [f"account-{account}" for account in range(4)]
+        for service in (batched, single):
+            for account_id in account_ids[:3]:
+                for payer in PAYERS:
+                    service.add_transaction(account_id, payer, 500, datetime.datetime(2020, 1, 1))
+        for _ in range(10):
+            spends = [(account_id, [generator.choice([-1, 0, 50, 300, 900]) for _ in range(generator.randint(1, 4))])
+                      for account_id in generator.sample(account_ids, 3)]
+            expected = [[single_outcome(account_id, points) for points in spend_points]
+                        for account_id, spend_points in spends]
+            assert [[outcome(result) for result in account_results]
+                    for account_results in batched.spend_points_batch(spends)] == expected
+        assert dict(batched.get_all_points_balances()) == dict(single.get_all_points_balances())
+
+    @pytest.mark.parametrize("seed", range(20))
+    def test_spend_matches_history_scan(self, points_service, random_account_id, seed):
+        generator = random.Random(seed)
+        start = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+        history: typing.List[typing.Tuple[str, int, datetime.datetime]] = []
+        for _ in range(300):
+            if not history or generator.random() < 0.7:
+                payer = generator.choice(PAYERS)
+                # Mostly backdated adds with timestamp collisions and the occasional negative add.
+                points = generator.choice([-1, 1, 1, 1]) * generator.randint(1, 500)
+                timestamp = start + datetime.timedelta(hours=generator.randint(0, 200))
+                points_service.add_transaction(random_account_id, payer, points, timestamp)
+                history.append((payer, points, timestamp))
+            else:
+                points = generator.randint(0, 1500)
+                expected = scan_spend(history, points)
+                if expected is None:
+                    with pytest.raises(NotEnoughPointsException):
+                        points_service.spend_points(random_account_id, points)
+                    continue
+                spends = points_service.spend_points(random_account_id, points)
+                assert [(spend.payer, spend.points) for spend in spends] == expected
+                history.extend((spend.payer, spend.points, spend.timestamp) for spend in spends)
+
+    @pytest.mark.parametrize("seed", range(5))
+    def test_spend_matches_history_scan_across_ledger_blocks(self, points_service, random_account_id, monkeypatch,
+                                                              seed):
+        monkeypatch.setattr(Ledger, "BLOCK_SIZE", 2)
+        self.test_spend_matches_history_scan(points_service, random_account_id, seed)
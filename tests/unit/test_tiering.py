@@ -0,0 +1,162 @@
+import datetime
+import logging
+import random
+import threading
+
+import pytest
+
+import app.tiering
+from app.metrics import METRICS
+from app.model import Account, NotEnoughPointsException
+from app.persistence import Persistence
+from app.service import PointsService
+from app.tiering import ACCOUNT_EVICTIONS, TieredAccountStore
+
+logger = logging.getLogger(__name__)
+
+START = datetime.datetime(2020, 11, 1, tzinfo=datetime.timezone.utc)
+PAYERS = ["DANNON", "UNILEVER", "MILLER COORS", "KRAFT"]
+
+
+def state(service: PointsService):
+    # Spends are dated when they are made, so only the order of transactions is compared.
+    return {account_id: (service.get_points_balances(account_id),
+                         [(transaction.payer, transaction.points)
+                          for transaction in service.get_account(account_id).transactions()])
+            for account_id in sorted(service.get_account_ids())}
+
+
+def resident_ids(service: PointsService):
+    return {account.account_id for account in service.accounts.resident()}
+
+
+def evictions(written: bool) -> int:
+    return METRICS.collect().get((ACCOUNT_EVICTIONS.name, (str(written).lower(),)), [0])[0]
+
+
+class TestResource:
+
+    @pytest.fixture
+    def tiered_service(self, tmp_path):
+        store = TieredAccountStore(str(tmp_path / "cold.sqlite"), capacity=2)
+        yield PointsService(compaction_threshold=8, account_store=store)
+        store.close()
+
+    @pytest.mark.parametrize("seed", range(3))
+    def test_tiered_matches_in_memory(self, tiered_service, seed):
+        # The same adds, batches, spends and removals across more accounts than fit in memory.
+        generator = random.Random(seed)
+        in_memory = PointsService(compaction_threshold=8)
+        for step in range(500):
+            account_id = f"account-{generator.randrange(6)}"
+            operation = generator.random()
+            timestamp = START + datetime.timedelta(minutes=generator.randint(-500, 500))
+            payer = generator.choice(PAYERS)
+            points = generator.randint(1, 50)
+            results = []
+            for service in (tiered_service, in_memory):
+                try:
+                    if operation < 0.5:
+                        results.append(service.add_transaction(account_id, payer, points, timestamp).to_dict())
+                    elif operation < 0.6:
+                        results.append(len(service.add_transactions(account_id, [(payer, 10, timestamp)] * 3)))
+                    elif operation < 0.95:
+                        results.append([transaction.payer for transaction in service.spend_points(account_id, 20)])
+                    else:
+                        results.append(service.has_account(account_id) and service.remove_account(account_id))
+                except Exception as exception:
+                    results.append(type(exception))
+            assert results[0] == results[1], step
+            assert tiered_service.get_points_balances(account_id) == in_memory.get_points_balances(account_id)
+        assert len(tiered_service.accounts.resident()) <= 2
+        assert state(tiered_service) == state(in_memory)
+        assert sorted((account_id, balances) for account_id, _, balances in
+                      tiered_service.get_all_encoded_points_balances()) == \
+            sorted((account_id, balances) for account_id, _, balances in in_memory.get_all_encoded_points_balances())
+
+    def test_faults_keep_versions_and_skip_unchanged_rows(self, tiered_service):
+        for account_id in ["a", "b", "c"]:
+            tiered_service.add_transaction(account_id, "DANNON", 100, START)
+        assert "a" in tiered_service.accounts and "a" not in resident_ids(tiered_service)
+        version = tiered_service.get_points_balances_version("a")
+        unwritten = evictions(written=False)
+        # Reading "a" back and evicting it again unchanged does not rewrite it, peeking does not fault it in.
+        assert tiered_service.get_points_balances("a") == {"DANNON": 100}
+        assert tiered_service.get_points_balances_version("a") == version
+        tiered_service.get_points_balances("b")
+        tiered_service.get_points_balances("c")
+        assert evictions(written=False) == unwritten + 1
+        assert tiered_service.get_points_balances_page(None, 3)[0] == ("a", {"DANNON": 100})
+        assert "a" not in resident_ids(tiered_service)
+        tiered_service.remove_account("a")
+        assert "a" not in tiered_service.accounts and len(tiered_service.accounts) == 2
+        with pytest.raises(NotEnoughPointsException):
+            tiered_service.spend_points("b", 101)
+
+    def test_listings_read_cold_balances_without_decoding(self, tiered_service, monkeypatch):
+        for account_id in ["a", "b", "c", "d"]:
+            tiered_service.add_transaction(account_id, "DANNON", 100, START)
+            tiered_service.spend_points(account_id, 10)
+        expected = {account_id: tiered_service.get_points_balances_version(account_id) for account_id in "ab"}
+        tiered_service.get_points_balances("c")
+        tiered_service.get_points_balances("d")
+        assert resident_ids(tiered_service) == {"c", "d"}
+
+        def decode_account(*args, **kwargs):
+            raise AssertionError("listings decoded a cold account")
+
+        monkeypatch.setattr(app.tiering, "decode_account", decode_account)
+        listed = {account_id: (version, balances)
+                  for account_id, version, balances in tiered_service.get_all_encoded_points_balances()}
+        assert listed == {account_id: (expected.get(account_id, listed[account_id][0]), b'{"DANNON":90}')
+                          for account_id in "abcd"}
+        assert tiered_service.get_points_balances_page("a", 2) == [("b", {"DANNON": 90}), ("c", {"DANNON": 90})]
+        assert [page[:2] for page in tiered_service.get_encoded_points_balances_page(None, 2)] == \
+            [("a", expected["a"]), ("b", expected["b"])]
+        assert resident_ids(tiered_service) == {"c", "d"}
+
+    def test_busy_accounts_are_not_evicted(self, tiered_service):
+        tiered_service.add_transaction("busy", "DANNON", 100, START)
+        with tiered_service.account_locks["busy"]:
+            for account_id in ["a", "b", "c"]:
+                tiered_service.accounts.put(Account(account_id))
+            assert "busy" in resident_ids(tiered_service)
+        tiered_service.add_transaction("d", "DANNON", 100, START)
+        assert "busy" not in resident_ids(tiered_service)
+
+    def test_concurrent_adds_and_spends(self, tiered_service):
+        def operate(thread: int):
+            for step in range(200):
+                account_id = f"account-{(thread + step) % 8}"
+                tiered_service.add_transaction(account_id, PAYERS[step % 4], 10, START)
+                if step % 3 == 2:
+                    tiered_service.spend_points(account_id, 10)
+
+        threads = [threading.Thread(target=operate, args=(thread,)) for thread in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        balances = [sum(tiered_service.get_points_balances(f"account-{account}").values()) for account in range(8)]
+        assert sum(balances) == 8 * 200 * 10 - 8 * 66 * 10
+
+    def test_recover_into_tiered_store(self, tmp_path):
+        persistence = Persistence(str(tmp_path / "data"), commit_latency=0.001)
+        service = persistence.recover()
+        for account in range(10):
+            service.add_transaction(f"account-{account}", "DANNON", 100 + account, START)
+        persistence.snapshot()
+        service.spend_points("account-3", 50)
+        expected = state(service)
+        persistence.close()
+
+        store = TieredAccountStore(str(tmp_path / "cold.sqlite"), capacity=3)
+        recovered = Persistence(str(tmp_path / "data"), account_store=store)
+        assert state(recovered.recover()) == expected
+        assert len(store.resident()) == 3
+        recovered.snapshot()
+        recovered.close()
+        store.close()
+        in_memory = Persistence(str(tmp_path / "data"))
+        assert state(in_memory.recover()) == expected
+        in_memory.close()